@@ -13,6 +13,7 @@ from . import kata
 from . import kbs
 from . import knative
 from . import kubeadm
+from . import manifests
 from . import nydus
 from . import operator
 from . import ovmf
@@ -21,6 +22,7 @@ from . import registry
 from . import sc2
 from . import sev
 from . import skopeo
+from . import sudo
 
 from tasks.coconut import ns as coconut_ns
 
@@ -38,6 +40,7 @@ ns = Collection(
     kbs,
     knative,
     kubeadm,
+    manifests,
     nydus,
     operator,
     ovmf,
@@ -46,6 +49,7 @@ ns = Collection(
     sc2,
     sev,
     skopeo,
+    sudo,
 )
 
 ns.add_collection(coconut_ns, name="coconut")
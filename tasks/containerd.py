@@ -11,6 +11,7 @@ from tasks.util.env import (
     PROJ_ROOT,
     print_dotted_line,
 )
+from tasks.util.sudo import sudo_copy, sudo_mkdir, sudo_remove
 from tasks.util.toml import update_toml
 from tasks.util.versions import CONTAINERD_VERSION
 
@@ -77,22 +78,27 @@ def set_log_level(ctx, log_level):
     """.format(
         log_level=log_level
     )
-    update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+    # Only restart containerd if we have actually changed its config file
+    if update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str):
+        restart_containerd()
 
-    restart_containerd()
 
-
-def install(debug=False, clean=False):
+def install(debug=False, clean=False, build=True):
     """
     Install (and build) containerd from source
+
+    If `build` is False, we assume that the build image is already up-to-date
+    (e.g. because we have built it concurrently with other deployment steps)
     """
     print_dotted_line(f"Installing containerd (v{CONTAINERD_VERSION})")
 
+    # Build before stopping containerd, to keep the downtime short
+    if build:
+        do_build(debug=debug)
+
     if is_containerd_active():
         run("sudo service containerd stop", shell=True, check=True)
 
-    do_build(debug=debug)
-
     binary_names = [
         "containerd",
         "containerd-shim",
@@ -110,19 +116,16 @@ def install(debug=False, clean=False):
 
     # Clean-up all runtime files for a clean start
     if clean:
-        run("sudo rm -rf /var/lib/containerd", shell=True, check=True)
+        sudo_remove("/var/lib/containerd", recursive=True)
 
     # Configure the CNI (see containerd/scripts/setup/install-cni)
     cni_conf_file = "10-containerd-net.conflist"
     cni_dir = "/etc/cni/net.d"
-    run(f"sudo mkdir -p {cni_dir}", shell=True, check=True)
-    cp_cmd = "sudo cp {} {}".format(
-        join(CONF_FILES_DIR, cni_conf_file), join(cni_dir, cni_conf_file)
-    )
-    run(cp_cmd, shell=True, check=True)
+    sudo_mkdir(cni_dir)
+    sudo_copy(join(CONF_FILES_DIR, cni_conf_file), join(cni_dir, cni_conf_file))
 
     # Populate the default config gile
-    run(f"sudo mkdir -p {CONTAINERD_CONFIG_ROOT}", shell=True, check=True)
+    sudo_mkdir(CONTAINERD_CONFIG_ROOT)
     config_cmd = "containerd config default > {}".format(CONTAINERD_CONFIG_FILE)
     config_cmd = "sudo bash -c '{}'".format(config_cmd)
     run(config_cmd, shell=True, check=True)
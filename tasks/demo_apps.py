@@ -8,6 +8,7 @@ from tasks.util.env import (
     LOCAL_REGISTRY_URL,
     print_dotted_line,
 )
+from tasks.util.registry import mirror_images
 
 APP_LIST = {
     "helloworld-py": join(APPS_SOURCE_DIR, "helloworld-py"),
@@ -62,30 +63,19 @@ def build(ctx, app=None, nocache=False):
 def do_push_to_local_registry(debug=False):
     print_dotted_line("Pushing {} demo apps to local regsitry".format(len(APP_LIST)))
 
-    for app_name in APP_LIST:
-        docker_tag = get_docker_tag_for_app(app_name)
-        local_registry_tag = get_local_registry_tag_for_app(app_name)
-
-        result = run(f"docker pull {docker_tag}", shell=True, capture_output=True)
-        assert result.returncode == 0, result.stderr.decode("utf-8").strip()
-        if debug:
-            print(result.stdout.decode("utf-8").strip())
-
-        result = run(
-            f"docker tag {docker_tag} {local_registry_tag}",
-            shell=True,
-            capture_output=True,
-        )
-        assert result.returncode == 0, result.stderr.decode("utf-8").strip()
-        if debug:
-            print(result.stdout.decode("utf-8").strip())
-
-        result = run(
-            f"docker push {local_registry_tag}", shell=True, capture_output=True
-        )
-        assert result.returncode == 0, result.stderr.decode("utf-8").strip()
-        if debug:
-            print(result.stdout.decode("utf-8").strip())
+    mirrored_images = mirror_images(
+        [
+            (get_docker_tag_for_app(app_name), get_local_registry_tag_for_app(app_name))
+            for app_name in APP_LIST
+        ]
+    )
+    if debug:
+        for image_tag, mirrored_image in mirrored_images.items():
+            print(
+                "{}@{} ({:.1f} MB copied)".format(
+                    image_tag, mirrored_image.digest, mirrored_image.copied_bytes / 1e6
+                )
+            )
 
     print("Success!")
 
@@ -4,6 +4,7 @@ from shutil import rmtree
 from subprocess import run
 from tasks.util.env import BIN_DIR, CONF_FILES_DIR, print_dotted_line
 from tasks.util.network import download_binary, symlink_global_bin
+from tasks.util.sudo import sudo_copy, sudo_mkdir, sudo_remove
 from tasks.util.versions import K8S_VERSION, CNI_VERSION, CRICTL_VERSION
 
 
@@ -16,10 +17,10 @@ def install_cni(debug=False, clean=False):
     cni_dir = join(cni_root, "bin")
 
     if clean:
-        run("sudo rm -rf {}".format(cni_dir), shell=True, check=True)
+        sudo_remove(cni_dir, recursive=True)
 
     if not exists(cni_dir):
-        run("sudo mkdir -p {}".format(cni_dir), shell=True, check=True)
+        sudo_mkdir(cni_dir)
 
     cni_tar = "cni-plugins-linux-amd64-v{}.tgz".format(CNI_VERSION)
     cni_url = "https://github.com/containernetworking/plugins/releases/"
@@ -42,7 +43,7 @@ def install_cni(debug=False, clean=False):
         print(result.stdout.decode("utf-8").strip())
 
     # Remove the TAR
-    run("sudo rm {}".format(join(cni_dir, cni_tar)), shell=True, check=True)
+    sudo_remove(join(cni_dir, cni_tar))
 
 
 def install_crictl(debug=False):
@@ -119,21 +120,15 @@ def configure_kubelet_service(debug=False, clean=False):
     Configure the kubelet service
     """
     kubelet_service_dir = "/etc/systemd/system/kubelet.service.d"
-    run(f"sudo mkdir -p {kubelet_service_dir}", shell=True, check=True)
+    sudo_mkdir(kubelet_service_dir)
 
     # Copy conf file into place
     conf_file = join(CONF_FILES_DIR, "kubelet_service.conf")
-    systemd_conf_file = join(kubelet_service_dir, "10-kubeadm.conf")
-    run("sudo cp {} {}".format(conf_file, systemd_conf_file), shell=True, check=True)
+    sudo_copy(conf_file, join(kubelet_service_dir, "10-kubeadm.conf"))
 
     # Copy service file into place
     service_file = join(CONF_FILES_DIR, "kubelet.service")
-    systemd_service_file = "/etc/systemd/system/kubelet.service"
-    run(
-        "sudo cp {} {}".format(service_file, systemd_service_file),
-        shell=True,
-        check=True,
-    )
+    sudo_copy(service_file, "/etc/systemd/system/kubelet.service")
 
     # Enable the service
     result = run(
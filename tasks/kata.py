@@ -1,9 +1,13 @@
+from functools import partial
 from invoke import task
-from os.path import abspath, join
+from os import makedirs
+from os.path import abspath, dirname, exists, getsize, join
 from subprocess import run
 from tasks.util.containerd import restart_containerd
+from tasks.util.cpio import get_initrd_contents
 from tasks.util.env import (
     KATA_CONFIG_DIR,
+    KATA_IMG_DIR,
     KATA_IMAGE_TAG,
     KATA_ROOT,
     KATA_RUNTIMES,
@@ -11,13 +15,19 @@ from tasks.util.env import (
     PROJ_ROOT,
     SC2_RUNTIMES,
 )
+from tasks.util.initrd_cache import get_file_digest
 from tasks.util.kata import (
+    build_initrd,
+    build_initrd_legacy,
+    get_agent_ctr_path,
     replace_shim as replace_kata_shim,
     run_kata_workon_ctr,
     stop_kata_workon_ctr,
 )
+from tasks.util.sudo import sudo_remove
 from tasks.util.toml import read_value_from_toml, update_toml
 from tasks.util.versions import RUST_VERSION
+from time import time
 
 
 @task
@@ -121,7 +131,7 @@ def enable_annotation(ctx, annotation, runtime="qemu-snp-sc2"):
 
 @task
 def replace_shim(ctx, runtime="qemu-snp-sc2"):
-    replace_kata_shim(
+    containerd_changes = replace_kata_shim(
         dst_shim_binary=join(
             KATA_ROOT,
             "bin",
@@ -134,4 +144,126 @@ def replace_shim(ctx, runtime="qemu-snp-sc2"):
         sc2=runtime in SC2_RUNTIMES,
     )
 
-    restart_containerd()
+    if containerd_changes:
+        restart_containerd()
+
+
+@task
+def bench_initrd(ctx, num_runs=3, baseline=False, work_dir="/tmp/sc2-initrd-bench"):
+    """
+    Compare building our initrd by unpacking and re-packing it, with streaming
+    it through our cpio rewriter, and check that both produce the same files
+    """
+    agent_ctr_path = get_agent_ctr_path(sc2=not baseline)
+    builders = [
+        ("unpack/repack", "legacy", build_initrd_legacy),
+        # Bypass the initrd cache, so that we always measure a full build
+        ("streaming", "streaming", partial(build_initrd, use_cache=False)),
+    ]
+
+    # Keep the workon container running across runs, so that we do not
+    # measure its start-up time
+    makedirs(work_dir, exist_ok=True)
+    ctr_started = run_kata_workon_ctr()
+    results = {}
+    try:
+        for label, file_name, build_fn in builders:
+            initrd_path = join(work_dir, "{}.img".format(file_name))
+            results[label] = {"initrd_path": initrd_path, "times": []}
+            for _ in range(num_runs):
+                sudo_remove(initrd_path)
+                start_ts = time()
+                build_fn(initrd_path, agent_ctr_path)
+                results[label]["times"].append(time() - start_ts)
+    finally:
+        if ctr_started:
+            stop_kata_workon_ctr()
+
+    for label, _, _ in builders:
+        times = results[label]["times"]
+        print(
+            "{}: {:.2f} s/build (min: {:.2f} s, size: {} bytes)".format(
+                label,
+                sum(times) / len(times),
+                min(times),
+                getsize(results[label]["initrd_path"]),
+            )
+        )
+    print(
+        "Speed-up: {:.1f}x".format(
+            min(results["unpack/repack"]["times"]) / min(results["streaming"]["times"])
+        )
+    )
+
+    legacy_contents = get_initrd_contents(results["unpack/repack"]["initrd_path"])
+    contents = get_initrd_contents(results["streaming"]["initrd_path"])
+    mismatches = sorted(
+        [
+            name
+            for name in set(legacy_contents) | set(contents)
+            if legacy_contents.get(name) != contents.get(name)
+        ]
+    )
+    if len(mismatches) > 0:
+        print("ERROR: initrd contents differ in: {}".format(", ".join(mismatches)))
+        raise RuntimeError("Streaming and unpack/repack initrds differ!")
+
+    print("Both initrds have the same {} entries".format(len(contents)))
+
+
+@task
+def verify_initrd(
+    ctx,
+    baseline=False,
+    num_builds=2,
+    work_dir="/tmp/sc2-initrd-verify",
+    check_installed=False,
+):
+    """
+    Check that our initrd builds are reproducible: rebuild the initrd from
+    scratch (bypassing the initrd cache) and compare the digests of all the
+    builds
+
+    Pass `--check-installed` to also compare them with the currently installed
+    initrd. This only makes sense if it was built with the default options
+    (i.e. reproducible, gzip-compressed, not slim, and not with the legacy
+    builder), otherwise its digest differs by design.
+    """
+    agent_ctr_path = get_agent_ctr_path(sc2=not baseline)
+    installed_initrd_path = join(
+        KATA_IMG_DIR,
+        "kata-containers-initrd-confidential-sc2{}.img".format(
+            "-baseline" if baseline else ""
+        ),
+    )
+
+    ctr_started = run_kata_workon_ctr()
+    digests = {}
+    try:
+        for i in range(num_builds):
+            # Use a different path for each build, as the file name must not
+            # leak into the image
+            initrd_path = join(work_dir, str(i), "initrd.img")
+            sudo_remove(initrd_path)
+            makedirs(dirname(initrd_path), exist_ok=True)
+            build_initrd(initrd_path, agent_ctr_path, use_cache=False)
+            digests[f"build #{i}"] = get_file_digest(initrd_path)
+    finally:
+        if ctr_started:
+            stop_kata_workon_ctr()
+
+    if check_installed:
+        if not exists(installed_initrd_path):
+            print(f"ERROR: no installed initrd at {installed_initrd_path}")
+            raise RuntimeError("Installed initrd not found!")
+
+        digests[installed_initrd_path] = get_file_digest(installed_initrd_path)
+
+    for label, digest in digests.items():
+        print(f"{label}: sha256:{digest}")
+
+    if len(set(digests.values())) != 1:
+        print("ERROR: initrd builds are not reproducible!")
+        raise RuntimeError("Initrd digests differ!")
+
+    print("All {} initrds have the same digest".format(len(digests)))
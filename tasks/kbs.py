@@ -1,14 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 from invoke import task
+from os import urandom
 from os.path import exists, join
+from random import Random
+from shutil import rmtree
 from subprocess import run
 from tasks.util.env import GHCR_URL, GITHUB_ORG
 from tasks.util.kbs import (
+    DEFAULT_LAUNCH_POLICY_ID,
     SIMPLE_KBS_DIR,
     SIGNATURE_POLICY_NONE,
+    KbsResource,
+    KbsSecret,
+    LocalKbsStore,
     clear_kbs_db,
     get_kbs_db_ip,
     provision_launch_digest as do_provision_launch_digest,
 )
+from tasks.util.sev import get_allowed_launch_digest_inputs, get_launch_digests
+from tempfile import mkdtemp
+from time import time
 
 SIMPLE_KBS_SERVER_IMAGE_NAME = join(GHCR_URL, GITHUB_ORG, "simple-kbs-server:latest")
 COMPOSE_ENV = {"SIMPLE_KBS_IMAGE": SIMPLE_KBS_SERVER_IMAGE_NAME}
@@ -143,7 +154,9 @@ def get_db_ip(ctx):
 
 
 @task
-def provision_launch_digest(ctx, signature_policy=SIGNATURE_POLICY_NONE, clean=False):
+def provision_launch_digest(
+    ctx, signature_policy=SIGNATURE_POLICY_NONE, clean=False, all_digests=False
+):
     """
     Provision the KBS with the launch digest for the current node
 
@@ -163,7 +176,8 @@ def provision_launch_digest(ctx, signature_policy=SIGNATURE_POLICY_NONE, clean=F
 
     For launch digest, we manually generate the measure digest, and include it
     in the policy. If the FW digest is not exactly the one in the policy, boot
-    fails.
+    fails. Pass `--all-digests` to allow the digests of all the SEV runtimes,
+    modes, and vCPU counts we support (see `inv sev.precompute-launch-digests`)
     """
     # For the purposes of the demo, we hardcode the images we include in the
     # policy to be included in the signature policy
@@ -176,6 +190,86 @@ def provision_launch_digest(ctx, signature_policy=SIGNATURE_POLICY_NONE, clean=F
         f"registry.coco-csg.com/{GITHUB_ORG}/coco-knative-sidecar",
     ]
 
+    launch_digests = None
+    if all_digests:
+        launch_digests = sorted(
+            set(get_launch_digests(list(get_allowed_launch_digest_inputs().values())))
+        )
+
     do_provision_launch_digest(
-        images_to_sign, signature_policy=signature_policy, clean=clean
+        images_to_sign,
+        signature_policy=signature_policy,
+        clean=clean,
+        launch_digests=launch_digests,
     )
+
+
+@task
+def bench(ctx, counts="10,100,1000,10000", num_threads=8, num_lookups=2000):
+    """
+    Benchmark provisioning and looking-up KBS resources and secrets
+
+    We run the benchmark against the in-process KBS stand-in (LocalKbsStore).
+    For each count N, we provision a launch policy with N allowed digests, N
+    resources, and N secrets, and then look-up random resources and secrets
+    from many threads at once, like concurrently booting guests do.
+    """
+    print(
+        "{:>8} {:>16} {:>16} {:>16} {:>12} {:>12}".format(
+            "N",
+            "Provision (ms)",
+            "Provision (op/s)",
+            "Look-up (op/s)",
+            "p50 (ms)",
+            "p99 (ms)",
+        )
+    )
+
+    rand = Random(0)
+    for count in [int(c) for c in counts.split(",")]:
+        kbs_dir = mkdtemp(prefix="sc2-kbs-bench-")
+        try:
+            store = LocalKbsStore(kbs_dir=kbs_dir)
+            launch_digests = [urandom(48) for _ in range(count)]
+            resources = [
+                KbsResource(f"default/bench/{i}", f"bench-{i}.json", f'{{"i": {i}}}')
+                for i in range(count)
+            ]
+            secrets = [
+                KbsSecret(f"bench-secret-{i}", f"secret-{i}") for i in range(count)
+            ]
+
+            start_ts = time()
+            store.set_launch_policy(DEFAULT_LAUNCH_POLICY_ID, launch_digests)
+            store.create_resources(resources)
+            store.create_secrets(secrets)
+            provision_secs = time() - start_ts
+
+            def do_lookup(i):
+                lookup_start_ts = time()
+                launch_digest = launch_digests[i % count]
+                if i % 2 == 0:
+                    result = store.get_resource(resources[i % count].id, launch_digest)
+                else:
+                    result = store.get_secret(secrets[i % count].id, launch_digest)
+                assert result is not None, "Error looking-up KBS resource!"
+                return time() - lookup_start_ts
+
+            indices = [rand.randrange(count * 2) for _ in range(num_lookups)]
+            start_ts = time()
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                latencies = sorted(pool.map(do_lookup, indices))
+            lookup_secs = time() - start_ts
+        finally:
+            rmtree(kbs_dir)
+
+        print(
+            "{:>8} {:>16.1f} {:>16.0f} {:>16.0f} {:>12.2f} {:>12.2f}".format(
+                count,
+                provision_secs * 1e3,
+                (2 * count + 1) / provision_secs,
+                num_lookups / lookup_secs,
+                latencies[len(latencies) // 2] * 1e3,
+                latencies[int(len(latencies) * 0.99)] * 1e3,
+            )
+        )
@@ -1,3 +1,4 @@
+from base64 import b64encode
 from invoke import task
 from os.path import join
 from tasks.util.env import CONF_FILES_DIR, LOCAL_REGISTRY_URL, print_dotted_line
@@ -6,13 +7,20 @@ from tasks.util.knative import (
     patch_autoscaler as do_patch_autoscaler,
     replace_sidecar as do_replace_sidecar,
 )
-from tasks.util.kubeadm import run_kubectl_command, wait_for_pods_in_ns
+from tasks.util.k8s_api import get_k8s_client
+from tasks.util.kubeadm import (
+    PodReadinessSpec,
+    run_kubectl_command,
+    wait_for_pods,
+)
+from tasks.util.manifests import get_manifest
 from tasks.util.registry import (
     HOST_CERT_DIR,
     HOST_CERT_PATH,
     K8S_SECRET_NAME,
 )
-from tasks.util.versions import KNATIVE_VERSION
+from tasks.util.trace import span
+from tasks.util.versions import KNATIVE_VERSION, METALLB_VERSION
 from time import sleep
 
 # Namespaces
@@ -20,6 +28,7 @@ KNATIVE_EVENTING_NAMESPACE = "knative-eventing"
 KNATIVE_SERVING_NAMESPACE = "knative-serving"
 KOURIER_NAMESPACE = "kourier-system"
 ISTIO_NAMESPACE = "istio-system"
+METALLB_NAMESPACE = "metallb-system"
 
 # URLs
 KNATIVE_SERVING_BASE_URL = "https://github.com/knative/serving/releases/download"
@@ -28,78 +37,74 @@ KNATIVE_EVENTING_BASE_URL = "https://github.com/knative/eventing/releases/downlo
 KNATIVE_EVENTING_BASE_URL += "/knative-v{}".format(KNATIVE_VERSION)
 KOURIER_BASE_URL = "https://github.com/knative/net-kourier/releases/download"
 KOURIER_BASE_URL += "/knative-v{}".format(KNATIVE_VERSION)
+ISTIO_BASE_URL = "https://github.com/knative/net-istio/releases/download"
+ISTIO_BASE_URL += "/knative-v{}".format(KNATIVE_VERSION)
+METALLB_URL = "https://raw.githubusercontent.com/metallb/metallb"
+METALLB_URL += f"/v{METALLB_VERSION}/config/manifests/metallb-native.yaml"
 
 
 def install_kourier(debug=False):
-    kube_cmd = "apply -f {}".format(join(KOURIER_BASE_URL, "kourier.yaml"))
+    """
+    Deploy Kourier, and return the pods that we need to wait on before
+    configuring it
+    """
+    kube_cmd = "apply -f {}".format(
+        get_manifest(join(KOURIER_BASE_URL, "kourier.yaml"))
+    )
     run_kubectl_command(kube_cmd, capture_output=not debug)
 
-    # Wait for all components to be ready
-    wait_for_pods_in_ns(
-        KNATIVE_SERVING_NAMESPACE,
-        label="app=net-kourier-controller",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KOURIER_NAMESPACE,
-        label="app=3scale-kourier-gateway",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
+    return [
+        PodReadinessSpec(KNATIVE_SERVING_NAMESPACE, "app=net-kourier-controller", 1),
+        PodReadinessSpec(KOURIER_NAMESPACE, "app=3scale-kourier-gateway", 1),
+    ]
+
 
+def configure_kourier():
     # Configure Knative Serving to use Kourier
-    kube_cmd = [
-        "patch configmap/config-network",
-        "--namespace {}".format(KNATIVE_SERVING_NAMESPACE),
-        "--type merge",
-        "--patch",
-        '\'{"data":{"ingress-class":"kourier.ingress.networking.knative.dev"}}\'',
-    ]
-    kube_cmd = " ".join(kube_cmd)
-    run_kubectl_command(kube_cmd, capture_output=not debug)
+    get_k8s_client().patch(
+        "configmaps",
+        "config-network",
+        {"data": {"ingress-class": "kourier.ingress.networking.knative.dev"}},
+        namespace=KNATIVE_SERVING_NAMESPACE,
+    )
 
 
 def install_istio(debug=False):
-    istio_base_url = (
-        "https://github.com/knative/net-istio/releases/download/knative-v{}".format(
-            KNATIVE_VERSION
-        )
-    )
-    istio_url = join(istio_base_url, "istio.yaml")
+    istio_url = get_manifest(join(ISTIO_BASE_URL, "istio.yaml"))
     kube_cmd = "apply -l knative.dev/crd-install=true -f {}".format(istio_url)
     run_kubectl_command(kube_cmd, capture_output=not debug)
 
     run_kubectl_command("apply -f {}".format(istio_url), capture_output=not debug)
     run_kubectl_command(
-        "apply -f {}".format(join(istio_base_url, "net-istio.yaml")),
+        "apply -f {}".format(get_manifest(join(ISTIO_BASE_URL, "net-istio.yaml"))),
         capture_output=not debug,
     )
-    wait_for_pods_in_ns(KNATIVE_SERVING_NAMESPACE, 6)
-    wait_for_pods_in_ns(ISTIO_NAMESPACE, 6)
+    wait_for_pods(
+        [
+            PodReadinessSpec(KNATIVE_SERVING_NAMESPACE, None, 6),
+            PodReadinessSpec(ISTIO_NAMESPACE, None, 6),
+        ]
+    )
 
 
 def install_metallb(debug=False):
     """
-    Install the MetalLB load balancer
+    Deploy the MetalLB load balancer, and return the pods that we need to wait
+    on before configuring it
     """
-    # First deploy the load balancer
-    metalb_version = "0.13.11"
-    metalb_url = "https://raw.githubusercontent.com/metallb/metallb/"
-    metalb_url += "v{}/config/manifests/metallb-native.yaml".format(metalb_version)
-    kube_cmd = "apply -f {}".format(metalb_url)
+    kube_cmd = "apply -f {}".format(get_manifest(METALLB_URL))
     run_kubectl_command(kube_cmd, capture_output=not debug)
-    wait_for_pods_in_ns(
-        "metallb-system",
-        label="component=controller",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        "metallb-system", label="component=speaker", expected_num_of_pods=1, debug=debug
-    )
 
-    # Second, configure the IP address pool and L2 advertisement
+    return [
+        PodReadinessSpec(METALLB_NAMESPACE, "component=controller", 1),
+        PodReadinessSpec(METALLB_NAMESPACE, "component=speaker", 1),
+    ]
+
+
+def configure_metallb(debug=False):
+    """
+    Configure the IP address pool and L2 advertisement for MetalLB
+    """
     metallb_conf_file = join(CONF_FILES_DIR, "metallb_config.yaml")
     run_kubectl_command(
         "apply -f {}".format(metallb_conf_file), capture_output=not debug
@@ -119,139 +124,113 @@ def install(skip_push=False, debug=False):
         f"Installing Knative (v{KNATIVE_VERSION}) with {net_layer} as net layer"
     )
 
-    # Knative requires a functional LoadBalancer, so we use MetaLB
-    install_metallb(debug=debug)
-
-    # -----
-    # Install Knative Serving
-    # -----
-
-    # Create the knative CRDs
-    kube_cmd = "apply -f {}".format(join(KNATIVE_SERVING_BASE_URL, "serving-crds.yaml"))
-    run_kubectl_command(kube_cmd, capture_output=not debug)
-
-    # Install the core serving components
-    kube_cmd = "apply -f {}".format(join(KNATIVE_SERVING_BASE_URL, "serving-core.yaml"))
-    run_kubectl_command(kube_cmd, capture_output=not debug)
-
-    # Wait for the core components to be ready
-    wait_for_pods_in_ns(
-        KNATIVE_SERVING_NAMESPACE,
-        label="app=activator",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_SERVING_NAMESPACE,
-        label="app=autoscaler",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_SERVING_NAMESPACE,
-        label="app=controller",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_SERVING_NAMESPACE,
-        label="app=webhook",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
+    # We deploy all the components that do not depend on each other first, and
+    # then wait for all of them to be ready at once. This way, the images for
+    # MetalLB, Knative Serving, and Knative Eventing are pulled concurrently
 
-    # -----
-    # Install Knative Eventing
-    # -----
+    # Knative requires a functional LoadBalancer, so we use MetaLB
+    with span("knative-deploy-core"):
+        pod_specs = install_metallb(debug=debug)
 
-    # Create the knative CRDs
-    kube_cmd = "apply -f {}".format(
-        join(KNATIVE_EVENTING_BASE_URL, "eventing-crds.yaml")
-    )
-    run_kubectl_command(kube_cmd, capture_output=not debug)
+        # -----
+        # Install Knative Serving
+        # -----
 
-    # Install the core serving components
-    kube_cmd = "apply -f {}".format(
-        join(KNATIVE_EVENTING_BASE_URL, "eventing-core.yaml")
-    )
-    run_kubectl_command(kube_cmd, capture_output=not debug)
+        # Create the knative CRDs
+        kube_cmd = "apply -f {}".format(
+            get_manifest(join(KNATIVE_SERVING_BASE_URL, "serving-crds.yaml"))
+        )
+        run_kubectl_command(kube_cmd, capture_output=not debug)
 
-    # Wait for the core components to be ready
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="app=eventing-controller",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="app=eventing-webhook",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="sinks.knative.dev/sink=job-sink",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
+        # Install the core serving components
+        kube_cmd = "apply -f {}".format(
+            get_manifest(join(KNATIVE_SERVING_BASE_URL, "serving-core.yaml"))
+        )
+        run_kubectl_command(kube_cmd, capture_output=not debug)
 
-    # Install non-core eventing components
-    kube_cmd = "apply -f {}".format(
-        join(KNATIVE_EVENTING_BASE_URL, "in-memory-channel.yaml")
-    )
-    run_kubectl_command(kube_cmd, capture_output=not debug)
+        pod_specs += [
+            PodReadinessSpec(KNATIVE_SERVING_NAMESPACE, f"app={app}", 1)
+            for app in ["activator", "autoscaler", "controller", "webhook"]
+        ]
 
-    kube_cmd = "apply -f {}".format(
-        join(KNATIVE_EVENTING_BASE_URL, "mt-channel-broker.yaml")
-    )
-    run_kubectl_command(kube_cmd, capture_output=not debug)
+        # -----
+        # Install Knative Eventing
+        # -----
 
-    # Wait for non-core components to be ready
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="app.kubernetes.io/component=imc-controller",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="app.kubernetes.io/component=imc-dispatcher",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="app.kubernetes.io/component=broker-controller",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="app.kubernetes.io/component=broker-filter",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        KNATIVE_EVENTING_NAMESPACE,
-        label="app.kubernetes.io/component=broker-ingress",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
+        # Create the knative CRDs
+        kube_cmd = "apply -f {}".format(
+            get_manifest(join(KNATIVE_EVENTING_BASE_URL, "eventing-crds.yaml"))
+        )
+        run_kubectl_command(kube_cmd, capture_output=not debug)
 
-    # -----
-    # Install a networking layer
-    # -----
+        # Install the core eventing components
+        kube_cmd = "apply -f {}".format(
+            get_manifest(join(KNATIVE_EVENTING_BASE_URL, "eventing-core.yaml"))
+        )
+        run_kubectl_command(kube_cmd, capture_output=not debug)
+
+        pod_specs += [
+            PodReadinessSpec(KNATIVE_EVENTING_NAMESPACE, "app=eventing-controller", 1),
+            PodReadinessSpec(KNATIVE_EVENTING_NAMESPACE, "app=eventing-webhook", 1),
+            PodReadinessSpec(
+                KNATIVE_EVENTING_NAMESPACE, "sinks.knative.dev/sink=job-sink", 1
+            ),
+        ]
+
+    # Wait for MetalLB, and the core serving and eventing components
+    with span("knative-wait-core", num_pod_specs=len(pod_specs)):
+        wait_for_pods(pod_specs, debug=debug)
+
+    # Now that MetalLB's webhook is up, we can configure it
+    with span("knative-deploy-extra"):
+        configure_metallb(debug=debug)
+
+        # Install non-core eventing components
+        kube_cmd = "apply -f {}".format(
+            get_manifest(join(KNATIVE_EVENTING_BASE_URL, "in-memory-channel.yaml"))
+        )
+        run_kubectl_command(kube_cmd, capture_output=not debug)
 
-    # Install a networking layer
-    if net_layer == "istio":
-        net_layer_ns = ISTIO_NAMESPACE
-        net_layer_service_name = "istio-ingressgateway"
-        install_istio(debug)
-    elif net_layer == "kourier":
-        net_layer_ns = KOURIER_NAMESPACE
-        net_layer_service_name = "kourier"
-        install_kourier(debug)
+        kube_cmd = "apply -f {}".format(
+            get_manifest(join(KNATIVE_EVENTING_BASE_URL, "mt-channel-broker.yaml"))
+        )
+        run_kubectl_command(kube_cmd, capture_output=not debug)
+
+        pod_specs = [
+            PodReadinessSpec(
+                KNATIVE_EVENTING_NAMESPACE,
+                f"app.kubernetes.io/component={component}",
+                1,
+            )
+            for component in [
+                "imc-controller",
+                "imc-dispatcher",
+                "broker-controller",
+                "broker-filter",
+                "broker-ingress",
+            ]
+        ]
+
+        # -----
+        # Install a networking layer
+        # -----
+
+        # Install a networking layer
+        if net_layer == "istio":
+            net_layer_ns = ISTIO_NAMESPACE
+            net_layer_service_name = "istio-ingressgateway"
+            install_istio(debug)
+        elif net_layer == "kourier":
+            net_layer_ns = KOURIER_NAMESPACE
+            net_layer_service_name = "kourier"
+            pod_specs += install_kourier(debug)
+
+    # Wait for the non-core eventing components and the networking layer
+    with span("knative-wait-extra", num_pod_specs=len(pod_specs)):
+        wait_for_pods(pod_specs, debug=debug)
+
+        if net_layer == "kourier":
+            configure_kourier()
 
     # Update the Serving's ConfigMap to support running CoCo
     knative_configmap = join(CONF_FILES_DIR, "knative_config.yaml")
@@ -260,57 +239,65 @@ def install(skip_push=False, debug=False):
     )
 
     # Get Knative's external IP
-    ip_cmd = [
-        "--namespace {}".format(net_layer_ns),
-        "get service {}".format(net_layer_service_name),
-        "-o jsonpath='{.status.loadBalancer.ingress[0].ip}'",
-    ]
-    ip_cmd = " ".join(ip_cmd)
-    expected_ip_len = 4
-    actual_ip = run_kubectl_command(ip_cmd, capture_output=True)
-    actual_ip_len = len(actual_ip.split("."))
-    while actual_ip_len != expected_ip_len:
-        if not debug:
-            print("Waiting for kourier external IP to be assigned by the LB...")
-
-        sleep(3)
-        actual_ip = run_kubectl_command(ip_cmd, capture_output=True)
-        actual_ip_len = len(actual_ip.split("."))
+    with span("knative-external-ip"):
+
+        def get_external_ip():
+            service = get_k8s_client().get(
+                "services", net_layer_service_name, namespace=net_layer_ns
+            )
+            ingress = service["status"].get("loadBalancer", {}).get("ingress", [])
+            return ingress[0].get("ip", "") if len(ingress) > 0 else ""
+
+        expected_ip_len = 4
+        actual_ip_len = len(get_external_ip().split("."))
+        while actual_ip_len != expected_ip_len:
+            if not debug:
+                print("Waiting for kourier external IP to be assigned by the LB...")
+
+            sleep(3)
+            actual_ip_len = len(get_external_ip().split("."))
 
     # Deploy a DNS
-    kube_cmd = "apply -f {}".format(
-        join(KNATIVE_SERVING_BASE_URL, "serving-default-domain.yaml")
-    )
-    run_kubectl_command(kube_cmd, capture_output=not debug)
-    wait_for_pods_in_ns(
-        KNATIVE_SERVING_NAMESPACE,
-        label="app=default-domain",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
+    with span("knative-default-domain"):
+        kube_cmd = "apply -f {}".format(
+            get_manifest(join(KNATIVE_SERVING_BASE_URL, "serving-default-domain.yaml"))
+        )
+        run_kubectl_command(kube_cmd, capture_output=not debug)
+        wait_for_pods(
+            [PodReadinessSpec(KNATIVE_SERVING_NAMESPACE, "app=default-domain", 1)],
+            debug=debug,
+        )
 
     # -----
     # Patch Knative components
     # -----
 
     # Replace the sidecar to use an image we control
-    do_replace_sidecar(skip_push=skip_push, quiet=not debug)
-
-    # Patch the auto-scaler
-    do_patch_autoscaler(debug=debug)
-
-    # Create a k8s secret with the credentials to support pulling images from
-    # a local registry with a self-signed certificate
-    kube_cmd = (
-        "-n knative-serving create secret generic {} --from-file=ca.crt={}".format(
-            K8S_SECRET_NAME, HOST_CERT_PATH
+    with span("knative-patch"):
+        do_replace_sidecar(skip_push=skip_push, quiet=not debug)
+
+        # Patch the auto-scaler
+        do_patch_autoscaler(debug=debug)
+
+        # Create a k8s secret with the credentials to support pulling images from
+        # a local registry with a self-signed certificate
+        with open(HOST_CERT_PATH, "rb") as fh:
+            ca_cert_b64 = b64encode(fh.read()).decode("utf-8")
+        get_k8s_client().create(
+            "secrets",
+            {
+                "apiVersion": "v1",
+                "kind": "Secret",
+                "metadata": {"name": K8S_SECRET_NAME},
+                "type": "Opaque",
+                "data": {"ca.crt": ca_cert_b64},
+            },
+            namespace=KNATIVE_SERVING_NAMESPACE,
         )
-    )
-    run_kubectl_command(kube_cmd, capture_output=not debug)
 
-    # Patch the controller deployment to mount the certificate to avoid
-    # having to specify it in every service definition
-    do_configure_self_signed_certs(HOST_CERT_DIR, K8S_SECRET_NAME, debug=debug)
+        # Patch the controller deployment to mount the certificate to avoid
+        # having to specify it in every service definition
+        do_configure_self_signed_certs(HOST_CERT_DIR, K8S_SECRET_NAME, debug=debug)
 
     print("Success!")
 
@@ -324,12 +311,14 @@ def uninstall():
     """
     # Delete DNS services
     kube_cmd = "delete -f {}".format(
-        join(KNATIVE_SERVING_BASE_URL, "serving-default-domain.yaml")
+        get_manifest(join(KNATIVE_SERVING_BASE_URL, "serving-default-domain.yaml"))
     )
     run_kubectl_command(kube_cmd)
 
     # Delete networking layer
-    kube_cmd = "delete -f {}".format(join(KOURIER_BASE_URL, "kourier.yaml"))
+    kube_cmd = "delete -f {}".format(
+        get_manifest(join(KOURIER_BASE_URL, "kourier.yaml"))
+    )
     run_kubectl_command(kube_cmd)
 
     # Delete all components in the knative-serving namespace
@@ -339,7 +328,7 @@ def uninstall():
 
     # Delete CRDs
     kube_cmd = "delete -f {}".format(
-        join(KNATIVE_SERVING_BASE_URL, "serving-crds.yaml")
+        get_manifest(join(KNATIVE_SERVING_BASE_URL, "serving-crds.yaml"))
     )
     run_kubectl_command(kube_cmd)
 
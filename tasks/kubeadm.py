@@ -1,5 +1,5 @@
 from os import getegid, geteuid, makedirs
-from os.path import exists
+from os.path import exists, join
 from shutil import rmtree
 from subprocess import run
 from tasks.util.env import (
@@ -9,14 +9,23 @@ from tasks.util.env import (
     KUBEADM_KUBECONFIG_FILE,
     print_dotted_line,
 )
+from tasks.util.k8s_api import get_k8s_client
 from tasks.util.kubeadm import (
     get_node_name,
+    PodReadinessSpec,
     run_kubectl_command,
-    wait_for_pods_in_ns,
+    wait_for_pods,
 )
+from tasks.util.manifests import get_manifest
+from tasks.util.sudo import sudo_chown, sudo_copy
+from tasks.util.trace import span
 from tasks.util.versions import CALICO_VERSION, K8S_VERSION
 from time import sleep
 
+CALICO_BASE_URL = "https://raw.githubusercontent.com/projectcalico/calico"
+CALICO_BASE_URL += f"/v{CALICO_VERSION}/manifests"
+CALICO_MANIFESTS = ["tigera-operator.yaml", "custom-resources.yaml"]
+
 
 def create(debug=False):
     """
@@ -26,95 +35,91 @@ def create(debug=False):
 
     # Start the cluster
     kubeadm_cmd = "sudo kubeadm init --config {}".format(K8S_ADMIN_FILE)
-    if debug:
-        run(kubeadm_cmd, shell=True, check=True)
-    else:
-        out = run(kubeadm_cmd, shell=True, capture_output=True)
-        assert out.returncode == 0, "Error running cmd: {} (error: {})".format(
-            kubeadm_cmd, out.stderr
-        )
+    with span("kubeadm-init", cmd=kubeadm_cmd):
+        if debug:
+            run(kubeadm_cmd, shell=True, check=True)
+        else:
+            out = run(kubeadm_cmd, shell=True, capture_output=True)
+            assert out.returncode == 0, "Error running cmd: {} (error: {})".format(
+                kubeadm_cmd, out.stderr
+            )
 
     if not exists(K8S_CONFIG_DIR):
         makedirs(K8S_CONFIG_DIR)
 
     # Copy the config file locally and change permissions
-    cp_cmd = "sudo cp /etc/kubernetes/admin.conf {}".format(KUBEADM_KUBECONFIG_FILE)
-    run(cp_cmd, shell=True, check=True)
-    chown_cmd = "sudo chown {}:{} {}".format(
-        geteuid(), getegid(), KUBEADM_KUBECONFIG_FILE
-    )
-    run(chown_cmd, shell=True, check=True)
+    sudo_copy("/etc/kubernetes/admin.conf", KUBEADM_KUBECONFIG_FILE)
+    sudo_chown(KUBEADM_KUBECONFIG_FILE, geteuid(), getegid())
 
     # Wait for the node to be in ready state
-    def get_node_state():
-        # We could use a jsonpath format here, but couldn't quite work it out
-        out = run_kubectl_command("get nodes --no-headers", capture_output=True).split(
-            " "
-        )
-        out = [_ for _ in out if len(_) > 0]
-        return out[1]
+    with span("wait-node-ready"):
 
-    expected_node_state = "Ready"
-    actual_node_state = get_node_state()
-    while expected_node_state != actual_node_state:
-        if debug:
-            print("Waiting for node to be ready...")
+        def is_node_ready():
+            nodes = get_k8s_client().list("nodes")
+            if len(nodes) == 0:
+                return False
+
+            conditions = nodes[0]["status"].get("conditions", [])
+            return any(
+                c["type"] == "Ready" and c["status"] == "True" for c in conditions
+            )
+
+        while not is_node_ready():
+            if debug:
+                print("Waiting for node to be ready...")
 
-        sleep(3)
-        actual_node_state = get_node_state()
+            sleep(3)
 
-    # Untaint the node so that pods can be scheduled on it
+    # Untaint the node so that pods can be scheduled on it. A merge patch
+    # replaces the whole list of taints, so we patch it with all the taints
+    # we want to keep
     node_name = get_node_name()
-    for role in ["control-plane"]:
-        node_label = "node-role.kubernetes.io/{}:NoSchedule-".format(role)
-        taint_cmd = "taint nodes {} {}".format(node_name, node_label)
-        run_kubectl_command(taint_cmd, capture_output=not debug)
+    untainted_keys = ["node-role.kubernetes.io/{}".format(r) for r in ["control-plane"]]
+    node = get_k8s_client().get("nodes", node_name)
+    taints = [
+        taint
+        for taint in node["spec"].get("taints", [])
+        if taint["key"] not in untainted_keys or taint["effect"] != "NoSchedule"
+    ]
 
     # In addition, make sure the node has the worker label (required by CoCo)
-    node_label = "node.kubernetes.io/worker="
-    run_kubectl_command(
-        "label node {} {}".format(node_name, node_label), capture_output=not debug
+    get_k8s_client().patch(
+        "nodes",
+        node_name,
+        {
+            "metadata": {"labels": {"node.kubernetes.io/worker": ""}},
+            "spec": {"taints": taints if len(taints) > 0 else None},
+        },
     )
 
     # Configure Calico
-    calico_url = "https://raw.githubusercontent.com/projectcalico/calico"
-    calico_url += f"/v{CALICO_VERSION}/manifests"
-    run_kubectl_command(
-        f"create -f {calico_url}/tigera-operator.yaml", capture_output=not debug
-    )
-    run_kubectl_command(
-        f"create -f {calico_url}/custom-resources.yaml", capture_output=not debug
-    )
-    wait_for_pods_in_ns(
-        "calico-system",
-        label="app.kubernetes.io/name=csi-node-driver",
-        debug=debug,
-        expected_num_of_pods=1,
-    )
-    wait_for_pods_in_ns(
-        "calico-system",
-        label="app.kubernetes.io/name=calico-typha",
-        debug=debug,
-        expected_num_of_pods=1,
-    )
-    wait_for_pods_in_ns(
-        "calico-system",
-        label="app.kubernetes.io/name=calico-node",
-        debug=debug,
-        expected_num_of_pods=1,
-    )
-    wait_for_pods_in_ns(
-        "calico-system",
-        label="app.kubernetes.io/name=calico-kube-controllers",
-        expected_num_of_pods=1,
-        debug=debug,
-    )
-    wait_for_pods_in_ns(
-        "calico-apiserver",
-        label="app.kubernetes.io/name=calico-apiserver",
-        debug=debug,
-        expected_num_of_pods=2,
-    )
+    with span("calico"):
+        for calico_manifest in CALICO_MANIFESTS:
+            run_kubectl_command(
+                "create -f {}".format(
+                    get_manifest(join(CALICO_BASE_URL, calico_manifest))
+                ),
+                capture_output=not debug,
+            )
+        wait_for_pods(
+            [
+                PodReadinessSpec(
+                    "calico-system", f"app.kubernetes.io/name={calico_app}", 1
+                )
+                for calico_app in [
+                    "csi-node-driver",
+                    "calico-typha",
+                    "calico-node",
+                    "calico-kube-controllers",
+                ]
+            ]
+            + [
+                PodReadinessSpec(
+                    "calico-apiserver", "app.kubernetes.io/name=calico-apiserver", 2
+                )
+            ],
+            debug=debug,
+        )
 
     print("Success!")
 
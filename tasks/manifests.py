@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+from invoke import task
+from os.path import join
+from tasks.knative import (
+    ISTIO_BASE_URL,
+    KNATIVE_EVENTING_BASE_URL,
+    KNATIVE_SERVING_BASE_URL,
+    KOURIER_BASE_URL,
+    METALLB_URL,
+)
+from tasks.kubeadm import CALICO_BASE_URL, CALICO_MANIFESTS
+from tasks.operator import CC_RUNTIME_URL, OPERATOR_RELEASE_URL
+from tasks.util.env import MANIFESTS_CACHE_DIR
+from tasks.util.manifests import get_kustomize_manifest, get_manifest
+
+MANIFESTS_PREFETCH_NUM_WORKERS = 8
+
+
+def get_all_manifest_urls():
+    """
+    Return all the manifest URLs that we apply when deploying SC2
+    """
+    knative_urls = [
+        join(KNATIVE_SERVING_BASE_URL, manifest)
+        for manifest in [
+            "serving-crds.yaml",
+            "serving-core.yaml",
+            "serving-default-domain.yaml",
+        ]
+    ]
+    knative_urls += [
+        join(KNATIVE_EVENTING_BASE_URL, manifest)
+        for manifest in [
+            "eventing-crds.yaml",
+            "eventing-core.yaml",
+            "in-memory-channel.yaml",
+            "mt-channel-broker.yaml",
+        ]
+    ]
+    # We prefetch both Knative net layers, so that we can deploy either
+    knative_urls.append(join(KOURIER_BASE_URL, "kourier.yaml"))
+    knative_urls += [
+        join(ISTIO_BASE_URL, manifest) for manifest in ["istio.yaml", "net-istio.yaml"]
+    ]
+
+    calico_urls = [join(CALICO_BASE_URL, manifest) for manifest in CALICO_MANIFESTS]
+
+    return knative_urls + calico_urls + [METALLB_URL]
+
+
+@task
+def prefetch(ctx, refresh=False):
+    """
+    Populate the manifest cache, so that we can deploy SC2 offline
+    """
+    sources = [(get_manifest, url) for url in get_all_manifest_urls()]
+    sources += [
+        (get_kustomize_manifest, url) for url in [OPERATOR_RELEASE_URL, CC_RUNTIME_URL]
+    ]
+
+    with ThreadPoolExecutor(max_workers=MANIFESTS_PREFETCH_NUM_WORKERS) as pool:
+        futures = [
+            (url, pool.submit(get_fn, url, refresh=refresh)) for get_fn, url in sources
+        ]
+        for url, future in futures:
+            print(f"{url} -> {future.result()}")
+
+    print(f"Cached {len(sources)} manifests in {MANIFESTS_CACHE_DIR}")
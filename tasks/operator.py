@@ -1,15 +1,29 @@
 from os.path import join
 from tasks.util.env import CONTAINERD_CONFIG_FILE, KATA_CONFIG_DIR, print_dotted_line
 from tasks.util.kubeadm import (
+    get_runtime_class_handlers,
+    PodReadinessSpec,
     run_kubectl_command,
+    wait_for_pods,
     wait_for_pods_in_ns,
 )
+from tasks.util.manifests import get_kustomize_manifest
 from tasks.util.toml import read_value_from_toml
 from tasks.util.versions import COCO_VERSION
 from time import sleep
 
 OPERATOR_GITHUB_URL = "github.com/confidential-containers/operator"
 OPERATOR_NAMESPACE = "confidential-containers-system"
+OPERATOR_RELEASE_URL = join(
+    OPERATOR_GITHUB_URL, "config", "release?ref=v{}".format(COCO_VERSION)
+)
+CC_RUNTIME_URL = join(
+    OPERATOR_GITHUB_URL,
+    "config",
+    "samples",
+    "ccruntime",
+    "default?ref=v{}".format(COCO_VERSION),
+)
 
 
 def install(debug=False):
@@ -20,10 +34,10 @@ def install(debug=False):
 
     # Install the operator from the confidential-containers/operator
     # release tag
-    operator_url = join(
-        OPERATOR_GITHUB_URL, "config", "release?ref=v{}".format(COCO_VERSION)
+    operator_manifest = get_kustomize_manifest(OPERATOR_RELEASE_URL)
+    run_kubectl_command(
+        "apply -f {}".format(operator_manifest), capture_output=not debug
     )
-    run_kubectl_command("apply -k {}".format(operator_url), capture_output=not debug)
     wait_for_pods_in_ns(
         OPERATOR_NAMESPACE,
         expected_num_of_pods=1,
@@ -40,22 +54,21 @@ def install_cc_runtime(debug=False):
     """
     print_dotted_line("Install CoCo runtimes")
 
-    cc_runtime_url = join(
-        OPERATOR_GITHUB_URL,
-        "config",
-        "samples",
-        "ccruntime",
-        "default?ref=v{}".format(COCO_VERSION),
+    cc_runtime_manifest = get_kustomize_manifest(CC_RUNTIME_URL)
+    run_kubectl_command(
+        "create -f {}".format(cc_runtime_manifest), capture_output=not debug
+    )
+
+    wait_for_pods(
+        [
+            PodReadinessSpec(OPERATOR_NAMESPACE, pod_label, 1)
+            for pod_label in [
+                "name=cc-operator-pre-install-daemon",
+                "name=cc-operator-daemon-install",
+            ]
+        ],
+        debug=debug,
     )
-    run_kubectl_command("create -k {}".format(cc_runtime_url), capture_output=not debug)
-
-    for pod_label in [
-        "name=cc-operator-pre-install-daemon",
-        "name=cc-operator-daemon-install",
-    ]:
-        wait_for_pods_in_ns(
-            OPERATOR_NAMESPACE, expected_num_of_pods=1, label=pod_label, debug=debug
-        )
 
     # We check that the registered runtime classes are the same ones
     # we expect. We deliberately hardcode the following list
@@ -68,8 +81,7 @@ def install_cc_runtime(debug=False):
         "kata-qemu-sev",
         "kata-qemu-snp",
     ]
-    run_class_cmd = "get runtimeclass -o jsonpath='{.items..handler}'"
-    runtime_classes = run_kubectl_command(run_class_cmd, capture_output=True).split(" ")
+    runtime_classes = get_runtime_class_handlers()
     while len(expected_runtime_classes) != len(runtime_classes):
         if debug:
             print(
@@ -79,9 +91,7 @@ def install_cc_runtime(debug=False):
             )
 
         sleep(5)
-        runtime_classes = run_kubectl_command(run_class_cmd, capture_output=True).split(
-            " "
-        )
+        runtime_classes = get_runtime_class_handlers()
 
     # The operator may report all runtime classes as created, but still be in
     # the process of modifying the config files. If we make progress without
@@ -119,21 +129,13 @@ def uninstall():
     """
     Uninstall the operator
     """
-    operator_url = join(
-        OPERATOR_GITHUB_URL, "config", "release?ref=v{}".format(COCO_VERSION)
+    run_kubectl_command(
+        "delete -f {}".format(get_kustomize_manifest(OPERATOR_RELEASE_URL))
     )
-    run_kubectl_command("delete -k {}".format(operator_url))
 
 
 def uninstall_cc_runtime():
     """
     Un-install the CoCo runtimes from the k8s cluster
     """
-    cc_runtime_url = join(
-        OPERATOR_GITHUB_URL,
-        "config",
-        "samples",
-        "ccruntime",
-        "default?ref=v{}".format(COCO_VERSION),
-    )
-    run_kubectl_command("delete -k {}".format(cc_runtime_url))
+    run_kubectl_command("delete -f {}".format(get_kustomize_manifest(CC_RUNTIME_URL)))
@@ -1,11 +1,32 @@
 from invoke import task
-from os.path import join
-from subprocess import run
+from os import makedirs
+from os.path import exists, getsize, join
+from shlex import split as shlex_split
+from subprocess import Popen, TimeoutExpired, run
+from tasks.util.cpio import INITRD_CODECS
 from tasks.util.env import KATA_ROOT, KATA_CONFIG_DIR, PROJ_ROOT
+from tasks.util.initrd_cache import get_file_digest
+from tasks.util.kata import (
+    INITRD_ALLOWLIST_FILE,
+    build_initrd,
+    get_agent_ctr_path,
+    run_kata_workon_ctr,
+    stop_kata_workon_ctr,
+)
+from tasks.util.qemu import QEMU_STANDALONE_SERIAL_LOG, get_standalone_qemu_cmd
+from tasks.util.sudo import sudo_remove
 from tasks.util.toml import read_value_from_toml
+from time import sleep, time
 
 QEMU_IMAGE_TAG = "qemu-build"
 
+# The kernel logs this line right before exec-ing the init process in the
+# initrd (we boot with the `debug` log level)
+QEMU_INIT_LOG_LINE = "Run /init as init process"
+QEMU_BOOT_TIMEOUT_SECS = 120
+QEMU_BOOT_POLL_PERIOD_SECS = 0.05
+QEMU_STOP_TIMEOUT_SECS = 10
+
 
 @task
 def build(ctx, qemu_datadir=join(KATA_ROOT, "share", "kata-qemu")):
@@ -40,38 +61,147 @@ def build(ctx, qemu_datadir=join(KATA_ROOT, "share", "kata-qemu")):
 
 
 @task
-def standalone(ctx):
+def standalone(ctx, initrd=None):
     """
     Invoke a standalone (non-)confidential VM using QEMU
 
     So far, only non-confidential VMs work. Note that the /init process in the
     default `initrd` is the Kata Agent, so the VM will not hang in the agent
-    init. It is still useful to assert that the VM can boot.
+    init. It is still useful to assert that the VM can boot. Pass `--initrd`
+    to boot a different initrd than the one in the Kata config.
     """
-    conf_file_path = join(KATA_CONFIG_DIR, "configuration-qemu.toml")
-    qemu_path = join(KATA_ROOT, "bin", "qemu-system-x86_64-csg")
-    fw_path = join(KATA_ROOT, "share", "ovmf", "OVMF.fd")
-    kernel_path = join(KATA_ROOT, "share", "kata-containers", "vmlinuz-5.19.2-109cc+")
-
-    # Prepare QEMU command line
-    qemu_cmd = [
-        "sudo",
-        qemu_path,
-        "-machine q35,accel=kvm",
-        "-m 2048M,slots=10,maxmem=257720M",
-        "-kernel {}".format(kernel_path),
-        '-append "console=ttyS0 root=/dev/sda2 debug"',
-        "-initrd {}".format(
-            read_value_from_toml(conf_file_path, "hypervisor.qemu.initrd")
-        ),
-        "-no-user-config",
-        "-nodefaults",
-        "-nographic",
-        "--no-reboot",
-        "-drive if=pflash,format=raw,readonly=on,file={}".format(fw_path),
-        "--serial file:/tmp/qemu-serial-direct.log",
-    ]
-    qemu_cmd = " ".join(qemu_cmd)
+    if initrd is None:
+        conf_file_path = join(KATA_CONFIG_DIR, "configuration-qemu.toml")
+        initrd = read_value_from_toml(conf_file_path, "hypervisor.qemu.initrd")
 
+    qemu_cmd = get_standalone_qemu_cmd(initrd)
     print(qemu_cmd)
     run(qemu_cmd, shell=True, check=True)
+
+
+def stop_qemu(qemu_proc, serial_log_path=QEMU_STANDALONE_SERIAL_LOG):
+    """
+    Stop a standalone VM that we started with `sudo` in its own session
+
+    Signalling the `sudo` process is not enough, as it does not forward the
+    signals that it gets from its parent's process group, so we signal the
+    whole (root-owned) process group instead. `sudo` may also run QEMU in a
+    different process group, so we also signal any process with our serial
+    log in its command line. We escalate to SIGKILL if QEMU does not exit
+    """
+    for signal in ["TERM", "KILL"]:
+        run(
+            f"sudo kill -{signal} -{qemu_proc.pid}",
+            shell=True,
+            capture_output=True,
+        )
+        run(
+            # The bracket stops the pattern from matching our own `sudo`
+            f"sudo pkill -{signal} -f '[f]ile:{serial_log_path}'",
+            shell=True,
+            capture_output=True,
+        )
+        try:
+            qemu_proc.wait(timeout=QEMU_STOP_TIMEOUT_SECS)
+            return
+        except TimeoutExpired:
+            print(f"WARNING: QEMU did not exit after SIG{signal}")
+
+    qemu_proc.wait()
+
+
+def time_to_init(initrd_path, timeout_secs=QEMU_BOOT_TIMEOUT_SECS):
+    """
+    Boot a standalone VM with an initrd, and return the time (in seconds)
+    until the kernel hands over to the init process in the initrd
+    """
+    sudo_remove(QEMU_STANDALONE_SERIAL_LOG)
+    start_ts = time()
+    qemu_proc = Popen(
+        shlex_split(get_standalone_qemu_cmd(initrd_path)), start_new_session=True
+    )
+    try:
+        while time() - start_ts < timeout_secs:
+            if exists(QEMU_STANDALONE_SERIAL_LOG):
+                with open(QEMU_STANDALONE_SERIAL_LOG, "r", errors="replace") as fh:
+                    if QEMU_INIT_LOG_LINE in fh.read():
+                        return time() - start_ts
+
+            if qemu_proc.poll() is not None:
+                print(
+                    "ERROR: QEMU exited before running init (see {})".format(
+                        QEMU_STANDALONE_SERIAL_LOG
+                    )
+                )
+                raise RuntimeError("VM failed to boot!")
+
+            sleep(QEMU_BOOT_POLL_PERIOD_SECS)
+    finally:
+        stop_qemu(qemu_proc)
+
+    print(f"ERROR: timed-out waiting for init (see {QEMU_STANDALONE_SERIAL_LOG})")
+    raise RuntimeError("Timed-out booting VM!")
+
+
+@task
+def bench_initrd(
+    ctx,
+    codecs=",".join(INITRD_CODECS),
+    num_runs=3,
+    baseline=False,
+    work_dir="/tmp/sc2-initrd-codecs",
+):
+    """
+    Compare the initrd variants that we can build (full or slim, and each
+    compression codec) by booting each of them in a standalone VM
+
+    For each variant, we report the image size, the time to hash the image
+    (i.e. what the launch measurement pays for the initrd), and the time
+    from starting QEMU until the kernel runs the init process (which includes
+    decompressing and unpacking the initrd).
+    """
+    codecs = codecs.split(",")
+    agent_ctr_path = get_agent_ctr_path(sc2=not baseline)
+    makedirs(work_dir, exist_ok=True)
+
+    variants = []
+    ctr_started = run_kata_workon_ctr()
+    try:
+        for codec in codecs:
+            for slim in [False, True]:
+                label = "{}-{}".format(codec, "slim" if slim else "full")
+                initrd_path = join(work_dir, f"{label}.img")
+                build_initrd(
+                    initrd_path,
+                    agent_ctr_path,
+                    use_cache=False,
+                    codec=codec,
+                    allowlist_file=INITRD_ALLOWLIST_FILE if slim else None,
+                )
+                variants.append((label, initrd_path))
+    finally:
+        if ctr_started:
+            stop_kata_workon_ctr()
+
+    header = "{:<16} {:>12} {:>12} {:>16}".format(
+        "Variant", "Size (MB)", "Hash (ms)", "Time-to-init (s)"
+    )
+    print(header)
+    print("-" * len(header))
+    for label, initrd_path in variants:
+        hash_times = []
+        init_times = []
+        for _ in range(num_runs):
+            start_ts = time()
+            get_file_digest(initrd_path)
+            hash_times.append(time() - start_ts)
+            init_times.append(time_to_init(initrd_path))
+
+        print(
+            "{:<16} {:>12.1f} {:>12.1f} {:>16.2f}".format(
+                label,
+                getsize(initrd_path) / 1e6,
+                sum(hash_times) / num_runs * 1e3,
+                sum(init_times) / num_runs,
+            )
+        )
@@ -1,8 +1,12 @@
 from invoke import task
 from tasks.util.containerd import restart_containerd
 from tasks.util.registry import (
+    REGISTRY_MIRRORS,
+    get_mirror_stats,
     start as start_registry,
+    start_mirrors as do_start_mirrors,
     stop as stop_registry,
+    stop_mirrors as do_stop_mirrors,
 )
 
 
@@ -11,8 +15,8 @@ def start(ctx, debug=False, clean=False):
     """
     Configure a local container registry reachable from CoCo guests in K8s
     """
-    start_registry(debug=debug, clean=clean)
-    restart_containerd()
+    if start_registry(debug=debug, clean=clean):
+        restart_containerd()
 
 
 @task
@@ -24,3 +28,68 @@ def stop(ctx, debug=False):
     to the steps that are not idempotent (e.g. creating a k8s secret).
     """
     stop_registry(debug=debug)
+
+
+@task
+def start_mirrors(ctx, debug=False):
+    """
+    Start pull-through cache registries for the upstream registries we pull
+    images from (e.g. docker.io or ghcr.io), and make containerd use them
+
+    To start them as part of `inv sc2.deploy`, set SC2_REGISTRY_MIRRORS=on.
+    """
+    if do_start_mirrors(debug=debug):
+        restart_containerd()
+
+
+@task
+def stop_mirrors(ctx, debug=False):
+    """
+    Stop the pull-through cache registries, keeping their cached images
+    """
+    do_stop_mirrors(debug=debug)
+
+
+@task
+def mirror_stats(ctx):
+    """
+    Print the cache hit and miss statistics of the registry mirrors
+    """
+    print(
+        "{:<12} {:<10} {:>10} {:>10} {:>10} {:>10} {:>14} {:>14}".format(
+            "Registry",
+            "Kind",
+            "Requests",
+            "Hits",
+            "Misses",
+            "Hit rate",
+            "Upstream (MB)",
+            "Served (MB)",
+        )
+    )
+    for mirror in REGISTRY_MIRRORS:
+        try:
+            stats = get_mirror_stats(mirror)
+        except OSError as e:
+            print(f"{mirror.host:<12} ERROR: {e}")
+            continue
+
+        for kind in ["manifests", "blobs"]:
+            kind_stats = stats.get(kind, {})
+            requests = kind_stats.get("Requests", 0)
+            print(
+                "{:<12} {:<10} {:>10} {:>10} {:>10} {:>10} {:>14.1f} {:>14.1f}".format(
+                    mirror.host,
+                    kind,
+                    requests,
+                    kind_stats.get("Hits", 0),
+                    kind_stats.get("Misses", 0),
+                    (
+                        "{:.0%}".format(kind_stats.get("Hits", 0) / requests)
+                        if requests > 0
+                        else "-"
+                    ),
+                    kind_stats.get("BytesPulled", 0) / 1e6,
+                    kind_stats.get("BytesPushed", 0) / 1e6,
+                )
+            )
@@ -1,9 +1,14 @@
+from functools import partial
 from invoke import task
 from os import makedirs
 from os.path import exists, join
 from subprocess import run
-from tasks.containerd import install as containerd_install
+from tasks.containerd import (
+    do_build as containerd_build,
+    install as containerd_install,
+)
 from tasks.demo_apps import (
+    APP_LIST as DEMO_APPS,
     do_push_to_local_registry as push_demo_apps_to_local_registry,
 )
 from tasks.k8s import install as k8s_tooling_install
@@ -14,7 +19,9 @@ from tasks.operator import (
     install as operator_install,
     install_cc_runtime as operator_install_cc_runtime,
 )
+from tasks.util.checkpoint import DeployState, remove_deploy_state
 from tasks.util.containerd import restart_containerd
+from tasks.util.dag import DAG_DEFAULT_NUM_WORKERS, DagNode, run_dag
 from tasks.util.env import (
     COCO_ROOT,
     CONF_FILES_DIR,
@@ -24,8 +31,12 @@ from tasks.util.env import (
     KATA_ROOT,
     KATA_IMAGE_TAG,
     KATA_IMG_DIR,
+    K8S_ADMIN_FILE,
+    LOCAL_REGISTRY_URL,
     PROJ_ROOT,
     SC2_CONFIG_DIR,
+    SC2_DEPLOY_STATE_FILE,
+    SC2_DEPLOY_TRACE_FILE,
     SC2_DEPLOYMENT_FILE,
     SC2_RUNTIMES,
     VM_CACHE_SIZE,
@@ -35,17 +46,51 @@ from tasks.util.kata import (
     replace_agent as replace_kata_agent,
     replace_shim as replace_kata_shim,
 )
-from tasks.util.kubeadm import run_kubectl_command
+from tasks.util.kubeadm import get_runtime_class_handlers, run_kubectl_command
 from tasks.util.registry import (
     HOST_CERT_DIR,
+    generate_certs as generate_registry_certs,
+    is_registry_mirrors_enabled,
     start as start_local_registry,
+    start_mirrors as start_registry_mirrors,
     stop as stop_local_registry,
 )
-from tasks.util.toml import update_toml
-from tasks.util.versions import COCO_VERSION, KATA_VERSION
+from tasks.util.sudo import sudo_copy, sudo_remove
+from tasks.util.toml import TomlTransaction
+from tasks.util.trace import print_trace_summary, reset_trace, write_trace
+from tasks.util.versions import (
+    CALICO_VERSION,
+    CNI_VERSION,
+    COCO_VERSION,
+    CONTAINERD_VERSION,
+    CRICTL_VERSION,
+    K8S_VERSION,
+    K9S_VERSION,
+    KATA_VERSION,
+    KNATIVE_VERSION,
+    METALLB_VERSION,
+    REGISTRY_VERSION,
+)
 from time import sleep
 
 
+VM_CACHE_DIR = join(PROJ_ROOT, "vm-cache")
+
+
+def build_vm_cache(debug=False):
+    """
+    Build the VM cache server
+    """
+    if debug:
+        print("Building VM cache wrapper...")
+    result = run(
+        "cargo build --release", cwd=VM_CACHE_DIR, shell=True, capture_output=True
+    )
+    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+    if debug:
+        print(result.stdout.decode("utf-8").strip())
+
+
 def install_sc2_runtime(debug=False):
     """
     This script installs SC2 as a different runtime class
@@ -53,62 +98,65 @@ def install_sc2_runtime(debug=False):
     # Copy containerd shim (and patch if needed)
     src_ctrd_path = f"{KATA_ROOT}/bin/containerd-shim-kata-v2"
     dst_ctrd_path = f"{KATA_ROOT}/bin/containerd-shim-kata-sc2-v2"
-    run(f"sudo cp {src_ctrd_path} {dst_ctrd_path}", shell=True, check=True)
+    sudo_copy(src_ctrd_path, dst_ctrd_path)
 
-    # Modify containerd to add a new runtime class
-    if debug:
-        print("Patching containerd...")
-    for sc2_runtime in SC2_RUNTIMES:
-        # Update containerd to point the SC2 runtime to the right shim
-        updated_toml_str = """
-        [plugins."io.containerd.grpc.v1.cri".containerd.runtimes.kata-{runtime_name}]
-        runtime_type = "io.containerd.kata-{runtime_name}.v2"
-        privileged_without_host_devices = true
-        pod_annotations = [ "io.katacontainers.*",]
-        snapshotter = "nydus"
-        runtime_path = "{ctrd_path}"
-        """.format(
-            runtime_name=sc2_runtime, ctrd_path=dst_ctrd_path
-        )
-        update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+    # Modify containerd to add a new runtime class, and copy (and patch) the
+    # Kata configuration files. We batch all TOML changes in a single
+    # transaction, so that we write each file only once
+    with TomlTransaction() as txn:
+        if debug:
+            print("Patching containerd...")
+        for sc2_runtime in SC2_RUNTIMES:
+            # Update containerd to point the SC2 runtime to the right shim
+            updated_toml_str = """
+            [plugins."io.containerd.grpc.v1.cri".containerd.runtimes.kata-{runtime_name}]
+            runtime_type = "io.containerd.kata-{runtime_name}.v2"
+            privileged_without_host_devices = true
+            pod_annotations = [ "io.katacontainers.*",]
+            snapshotter = "nydus"
+            runtime_path = "{ctrd_path}"
+            """.format(
+                runtime_name=sc2_runtime, ctrd_path=dst_ctrd_path
+            )
+            txn.update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
 
-    # Copy configuration file from the corresponding source file (and patch
-    # if needed)
-    if debug:
-        print("Patching configuration files...")
-    for sc2_runtime in SC2_RUNTIMES:
-        if "snp" in sc2_runtime:
-            src_conf_path = join(KATA_CONFIG_DIR, "configuration-qemu-snp.toml")
-        elif "qemu-tdx" in sc2_runtime:
-            src_conf_path = join(KATA_CONFIG_DIR, "configuration-qemu-tdx.toml")
-        dst_conf_path = join(KATA_CONFIG_DIR, f"configuration-{sc2_runtime}.toml")
-        run(f"sudo cp {src_conf_path} {dst_conf_path}", shell=True, check=True)
-
-        # Patch config file to enable VM cache
-        # FIXME: we need to update the default_memory to be able to run the
-        # Knative chaining test. This will change when memory hot-plugging
-        # is supported
-        updated_toml_str = """
-        [factory]
-        vm_cache_number = {vm_cache_number}
-
-        [hypervisor.qemu]
-        hot_plug_vfio = "root-port"
-        pcie_root_port = 2
-        default_memory = 6144
-        """.format(
-            vm_cache_number=VM_CACHE_SIZE
-        )
-        update_toml(dst_conf_path, updated_toml_str)
-
-        # Update containerd to point the SC2 runtime to the right config
-        updated_toml_str = """
-        [plugins."io.containerd.grpc.v1.cri".containerd.runtimes.kata-{runtime_name}.options]
-        ConfigPath = "{conf_path}"
-        """.format(
-            runtime_name=sc2_runtime, conf_path=dst_conf_path
-        )
-        update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+        # Copy configuration file from the corresponding source file (and
+        # patch if needed)
+        if debug:
+            print("Patching configuration files...")
+        for sc2_runtime in SC2_RUNTIMES:
+            if "snp" in sc2_runtime:
+                src_conf_path = join(KATA_CONFIG_DIR, "configuration-qemu-snp.toml")
+            elif "qemu-tdx" in sc2_runtime:
+                src_conf_path = join(KATA_CONFIG_DIR, "configuration-qemu-tdx.toml")
+            dst_conf_path = join(KATA_CONFIG_DIR, f"configuration-{sc2_runtime}.toml")
+            sudo_copy(src_conf_path, dst_conf_path)
+
+            # Patch config file to enable VM cache
+            # FIXME: we need to update the default_memory to be able to run the
+            # Knative chaining test. This will change when memory hot-plugging
+            # is supported
+            updated_toml_str = """
+            [factory]
+            vm_cache_number = {vm_cache_number}
+
+            [hypervisor.qemu]
+            hot_plug_vfio = "root-port"
+            pcie_root_port = 2
+            default_memory = 6144
+            """.format(
+                vm_cache_number=VM_CACHE_SIZE
+            )
+            txn.update_toml(dst_conf_path, updated_toml_str)
+
+            # Update containerd to point the SC2 runtime to the right config
+            updated_toml_str = """
+            [plugins."io.containerd.grpc.v1.cri".containerd.runtimes.kata-{runtime_name}.options]
+            ConfigPath = "{conf_path}"
+            """.format(
+                runtime_name=sc2_runtime, conf_path=dst_conf_path
+            )
+            txn.update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
 
     # Install runttime class on kubernetes
     if debug:
@@ -127,8 +175,7 @@ def install_sc2_runtime(debug=False):
         "kata-qemu-tdx",
         "kata-qemu-tdx-sc2",
     ]
-    run_class_cmd = "get runtimeclass -o jsonpath='{.items..handler}'"
-    runtime_classes = run_kubectl_command(run_class_cmd, capture_output=True).split(" ")
+    runtime_classes = get_runtime_class_handlers()
     while len(expected_runtime_classes) != len(runtime_classes):
         if debug:
             print(
@@ -138,9 +185,7 @@ def install_sc2_runtime(debug=False):
             )
 
         sleep(5)
-        runtime_classes = run_kubectl_command(run_class_cmd, capture_output=True).split(
-            " "
-        )
+        runtime_classes = get_runtime_class_handlers()
 
     # Replace the agent in the initrd
     if debug:
@@ -163,101 +208,65 @@ def install_sc2_runtime(debug=False):
 
     # ---------- VM Cache ---------
 
-    vm_cache_dir = join(PROJ_ROOT, "vm-cache")
-
-    # Build the VM cache server
-    if debug:
-        print("Building VM cache wrapper...")
-    result = run(
-        "cargo build --release", cwd=vm_cache_dir, shell=True, capture_output=True
-    )
-    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
-    if debug:
-        print(result.stdout.decode("utf-8").strip())
-
-    # Run the VM cache server in the background
+    # Run the VM cache server in the background (note that we build it as a
+    # separate deployment step)
     if debug:
         print("Running VM cache wrapper in background mode...")
     run(
         "sudo -E target/release/vm-cache background > /dev/null 2>&1",
-        cwd=vm_cache_dir,
+        cwd=VM_CACHE_DIR,
         shell=True,
     )
 
 
-@task(default=True)
-def deploy(ctx, debug=False, clean=False):
+def clean_host(debug=False):
     """
-    Deploy an SC2-enabled bare-metal Kubernetes cluster
+    Remove all the state that previous deployments may have left behind
     """
-    # Fail-fast if deployment exists
-    if exists(SC2_DEPLOYMENT_FILE):
-        print(f"ERROR: SC2 already deployed (file {SC2_DEPLOYMENT_FILE} exists)")
-        print("ERROR: only remove deployment file if you know what you are doing!")
-        raise RuntimeError("SC2 already deployed!")
-
-    if clean:
-        # Remove all directories that we populate and modify
-        for nuked_dir in [COCO_ROOT, CONTAINERD_CONFIG_ROOT, HOST_CERT_DIR, KATA_ROOT]:
-            if debug:
-                print(f"WARNING: nuking {nuked_dir}")
-            run(f"sudo rm -rf {nuked_dir}", shell=True, check=True)
-
-        # Purge VM cache for a very-clean start
-        vm_cache_dir = join(PROJ_ROOT, "vm-cache")
-        result = run(
-            "sudo target/release/vm-cache prune",
-            cwd=vm_cache_dir,
-            shell=True,
-            capture_output=True,
-        )
-        assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+    # Remove all directories that we populate and modify
+    for nuked_dir in [COCO_ROOT, CONTAINERD_CONFIG_ROOT, HOST_CERT_DIR, KATA_ROOT]:
         if debug:
-            print(result.stdout.decode("utf-8").strip())
-
-        # Purge containerd for a very-clean start
-        purge_containerd_dir = join(PROJ_ROOT, "tools", "purge-containerd")
-        result = run(
-            "cargo build --release && sudo target/release/purge-containerd",
-            cwd=purge_containerd_dir,
-            shell=True,
-            capture_output=True,
-        )
-        assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
-        if debug:
-            print(result.stdout.decode("utf-8").strip())
-
-    # Disable swap
-    run("sudo swapoff -a", shell=True, check=True)
-
-    # Build and install containerd
-    containerd_install(debug=debug, clean=clean)
-
-    # Install k8s tooling (including k9s)
-    k8s_tooling_install(debug=debug, clean=clean)
-    k9s_install(debug=debug)
+            print(f"WARNING: nuking {nuked_dir}")
+        sudo_remove(nuked_dir, recursive=True)
 
-    # Create a single-node k8s cluster
-    k8s_create(debug=debug)
-
-    # Install the CoCo operator as well as the CC-runtimes
-    operator_install(debug=debug)
-    operator_install_cc_runtime(debug=debug)
+    # Purge VM cache for a very-clean start
+    result = run(
+        "sudo target/release/vm-cache prune",
+        cwd=VM_CACHE_DIR,
+        shell=True,
+        capture_output=True,
+    )
+    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+    if debug:
+        print(result.stdout.decode("utf-8").strip())
 
-    # Start a local docker registry (must happen before knative installation,
-    # as we rely on it to host our sidecar image)
-    start_local_registry(debug=debug, clean=clean)
+    # Purge containerd for a very-clean start
+    purge_containerd_dir = join(PROJ_ROOT, "tools", "purge-containerd")
+    result = run(
+        "cargo build --release && sudo target/release/purge-containerd",
+        cwd=purge_containerd_dir,
+        shell=True,
+        capture_output=True,
+    )
+    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+    if debug:
+        print(result.stdout.decode("utf-8").strip())
 
-    # Install Knative
-    knative_install(debug=debug)
 
-    # Apply general patches to the Kata Agent (and initrd), making sure we
-    # have the latest patched version
+def pull_kata_image(debug=False):
     print_dotted_line(f"Pulling latest Kata image (v{KATA_VERSION})")
     result = run(f"docker pull {KATA_IMAGE_TAG}", shell=True, capture_output=True)
     assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
     if debug:
         print(result.stdout.decode("utf-8").strip())
+    print("Success!")
+
+
+def install_baseline_agent(debug=False):
+    """
+    Apply general patches to the Kata Agent (and initrd)
+    """
+    print_dotted_line(f"Patching Kata agent (v{KATA_VERSION})")
     replace_kata_agent(
         dst_initrd_path=join(
             KATA_IMG_DIR, "kata-containers-initrd-confidential-sc2-baseline.img"
@@ -267,24 +276,217 @@ def deploy(ctx, debug=False, clean=False):
     )
     print("Success!")
 
-    # Install sc2 runtime with patches
-    print_dotted_line(f"Installing SC2 (v{COCO_VERSION})")
-    install_sc2_runtime(debug=debug)
-    print("Success!")
 
-    # Once we are done with installing components, restart containerd
-    restart_containerd(debug=debug)
+def get_deploy_phase_inputs():
+    """
+    Get the inputs that determine the result of each deployment phase. When
+    resuming a deployment, we re-run a phase if any of its inputs has changed
+    (see tasks.util.checkpoint)
 
-    # Push demo apps to local registry for easy testing
-    push_demo_apps_to_local_registry(debug=debug)
+    Some inputs depend on the environment (e.g. SC2_REGISTRY_MIRRORS), so we
+    evaluate them every time we build the deployment graph
+    """
+    return {
+        "containerd-build": [
+            CONTAINERD_VERSION,
+            join(PROJ_ROOT, "docker", "containerd.dockerfile"),
+        ],
+        "containerd": [
+            CONTAINERD_VERSION,
+            join(CONF_FILES_DIR, "10-containerd-net.conflist"),
+        ],
+        "k8s-tooling": [
+            CNI_VERSION,
+            CRICTL_VERSION,
+            K8S_VERSION,
+            join(CONF_FILES_DIR, "kubelet.service"),
+            join(CONF_FILES_DIR, "kubelet_service.conf"),
+        ],
+        "k9s": [K9S_VERSION],
+        "kata-image": [KATA_IMAGE_TAG],
+        "vm-cache-build": [VM_CACHE_DIR],
+        "registry-certs": [join(CONF_FILES_DIR, "openssl.cnf")],
+        "k8s-cluster": [CALICO_VERSION, K8S_VERSION, K8S_ADMIN_FILE],
+        "coco-operator": [COCO_VERSION],
+        "registry-mirrors": [REGISTRY_VERSION, is_registry_mirrors_enabled()],
+        "registry": [LOCAL_REGISTRY_URL, REGISTRY_VERSION],
+        "knative": [
+            KNATIVE_VERSION,
+            METALLB_VERSION,
+            join(CONF_FILES_DIR, "knative_config.yaml"),
+            join(CONF_FILES_DIR, "metallb_config.yaml"),
+        ],
+        "demo-apps": sorted(DEMO_APPS),
+        "baseline-agent": [KATA_IMAGE_TAG],
+        "sc2-runtime": [COCO_VERSION, VM_CACHE_SIZE]
+        + [join(CONF_FILES_DIR, f"{r}_runtimeclass.yaml") for r in SC2_RUNTIMES],
+    }
+
+
+def get_deploy_dag(debug=False, clean=False):
+    """
+    Get the graph of steps to deploy SC2
+
+    Each step only lists the steps it strictly depends on, so that we can
+    overlap independent steps (mostly downloads and builds). Note that, on
+    top of data dependencies, we also order steps that would otherwise
+    interfere with each other:
+    - Starting the registry restarts docker, so it must follow all the steps
+      that build or pull docker images.
+    - The registry mirrors, the CoCo operator, the local registry, and the SC2
+      runtime all edit containerd's config file, so they must not run
+      concurrently.
+    - Both agent replacements share the Kata work-on container and the same
+      temporary directories.
+    """
 
-    # Finally, create a deployment file (right now, it is empty)
-    if not exists(SC2_CONFIG_DIR):
-        makedirs(SC2_CONFIG_DIR)
-    result = run(f"touch {SC2_DEPLOYMENT_FILE}", shell=True, capture_output=True)
-    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
-    if debug:
-        print(result.stdout.decode("utf-8").strip())
+    def prepare():
+        if clean:
+            clean_host(debug=debug)
+
+    def install_operator():
+        operator_install(debug=debug)
+        operator_install_cc_runtime(debug=debug)
+
+    def install_sc2():
+        print_dotted_line(f"Installing SC2 (v{COCO_VERSION})")
+        install_sc2_runtime(debug=debug)
+        print("Success!")
+
+    def install_registry_mirrors():
+        # Optionally, pull all the cluster's images through local caches
+        if is_registry_mirrors_enabled():
+            if start_registry_mirrors(debug=debug):
+                restart_containerd(debug=debug)
+
+    def create_deployment_file():
+        # Finally, create a deployment file (right now, it is empty)
+        makedirs(SC2_CONFIG_DIR, exist_ok=True)
+        open(SC2_DEPLOYMENT_FILE, "a").close()
+
+    nodes = [
+        DagNode("prepare", prepare, []),
+        # Downloads and builds that do not depend on each other
+        DagNode(
+            "containerd-build", partial(containerd_build, debug=debug), ["prepare"]
+        ),
+        DagNode(
+            "k8s-tooling",
+            partial(k8s_tooling_install, debug=debug, clean=clean),
+            ["prepare"],
+        ),
+        DagNode("k9s", partial(k9s_install, debug=debug), ["prepare"]),
+        DagNode("kata-image", partial(pull_kata_image, debug=debug), ["prepare"]),
+        DagNode("vm-cache-build", partial(build_vm_cache, debug=debug), ["prepare"]),
+        DagNode(
+            "registry-certs", partial(generate_registry_certs, debug=debug), ["prepare"]
+        ),
+        # Build and install containerd. Installing containerd briefly stops it,
+        # so we wait for any in-flight image pulls to finish first
+        DagNode(
+            "containerd",
+            partial(containerd_install, debug=debug, clean=clean, build=False),
+            ["containerd-build", "kata-image"],
+        ),
+        # Start the registry mirrors before we pull any cluster images
+        DagNode("registry-mirrors", install_registry_mirrors, ["containerd"]),
+        # Create a single-node k8s cluster
+        DagNode(
+            "k8s-cluster",
+            partial(k8s_create, debug=debug),
+            ["containerd", "k8s-tooling", "registry-mirrors"],
+        ),
+        # Install the CoCo operator as well as the CC-runtimes
+        DagNode("coco-operator", install_operator, ["k8s-cluster"]),
+        # Start a local docker registry (must happen before knative
+        # installation, as we rely on it to host our sidecar image)
+        DagNode(
+            "registry",
+            partial(start_local_registry, debug=debug, clean=clean),
+            ["registry-certs", "coco-operator", "containerd-build", "kata-image"],
+        ),
+        # Install Knative
+        DagNode("knative", partial(knative_install, debug=debug), ["registry"]),
+        # Push demo apps to local registry for easy testing
+        DagNode(
+            "demo-apps",
+            partial(push_demo_apps_to_local_registry, debug=debug),
+            ["registry"],
+        ),
+        # The baseline agent embeds the registry's certificate, and patches
+        # the initrd installed by the operator
+        DagNode(
+            "baseline-agent",
+            partial(install_baseline_agent, debug=debug),
+            ["kata-image", "registry"],
+        ),
+        # Install sc2 runtime with patches
+        DagNode("sc2-runtime", install_sc2, ["baseline-agent", "vm-cache-build"]),
+        # Once we are done with installing components, restart containerd
+        DagNode(
+            "containerd-restart",
+            partial(restart_containerd, debug=debug),
+            ["sc2-runtime", "knative"],
+        ),
+        DagNode(
+            "deployment-file",
+            create_deployment_file,
+            ["containerd-restart", "demo-apps"],
+        ),
+    ]
+
+    phase_inputs = get_deploy_phase_inputs()
+    return [node._replace(inputs=phase_inputs.get(node.name, ())) for node in nodes]
+
+
+@task(default=True)
+def deploy(
+    ctx, debug=False, clean=False, resume=False, num_workers=DAG_DEFAULT_NUM_WORKERS
+):
+    """
+    Deploy an SC2-enabled bare-metal Kubernetes cluster
+
+    Use --resume to pick up an interrupted (or failed) deployment, skipping
+    the phases that have already completed and whose inputs have not changed.
+    """
+    if resume and clean:
+        print("ERROR: can not resume a clean deployment")
+        raise RuntimeError("Incompatible flags: --resume and --clean")
+
+    # Fail-fast if deployment exists
+    if not resume and exists(SC2_DEPLOYMENT_FILE):
+        print(f"ERROR: SC2 already deployed (file {SC2_DEPLOYMENT_FILE} exists)")
+        print("ERROR: only remove deployment file if you know what you are doing!")
+        raise RuntimeError("SC2 already deployed!")
+
+    # Disable swap
+    run("sudo swapoff -a", shell=True, check=True)
+
+    # Trace the deployment timeline, and keep the trace even if we fail
+    reset_trace()
+    try:
+        run_dag(
+            get_deploy_dag(debug=debug, clean=clean),
+            num_workers=int(num_workers),
+            state=DeployState(SC2_DEPLOY_STATE_FILE, resume=resume),
+        )
+    finally:
+        write_trace(SC2_DEPLOY_TRACE_FILE)
+        print(f"Wrote deployment trace to: {SC2_DEPLOY_TRACE_FILE}")
+
+
+@task
+def trace_summary(ctx, trace_file=SC2_DEPLOY_TRACE_FILE, num_spans=10, baseline=None):
+    """
+    Print the slowest steps in a deployment trace (optionally vs a baseline)
+
+    The trace file is in Chrome's trace-event format, so it can also be loaded
+    in chrome://tracing or https://ui.perfetto.dev. To compare deployments,
+    copy a previous trace somewhere, and pass it as --baseline.
+    """
+    print_trace_summary(
+        trace_file, num_spans=int(num_spans), baseline_trace_file=baseline
+    )
 
 
 @task
@@ -294,10 +496,9 @@ def destroy(ctx, debug=False):
     """
     # Stop VM cache server (must happen before k8s_destroy to make sure all
     # our config files are there)
-    vm_cache_dir = join(PROJ_ROOT, "vm-cache")
     result = run(
         "sudo target/release/vm-cache stop",
-        cwd=vm_cache_dir,
+        cwd=VM_CACHE_DIR,
         shell=True,
         capture_output=True,
     )
@@ -317,3 +518,6 @@ def destroy(ctx, debug=False):
     assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
     if debug:
         print(result.stdout.decode("utf-8").strip())
+
+    # Remove the record of completed deployment phases
+    remove_deploy_state(SC2_DEPLOY_STATE_FILE)
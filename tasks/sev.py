@@ -1,14 +1,53 @@
 from invoke import task
-from tasks.util.sev import get_launch_digest as do_get_launch_digest
+from tasks.util.kbs import set_launch_measurement_policy
+from tasks.util.sev import (
+    get_allowed_launch_digest_inputs,
+    get_launch_digest as do_get_launch_digest,
+    get_launch_digests,
+)
+from time import time
 
 
 @task
-def get_launch_digest(ctx, mode="sev"):
+def get_launch_digest(ctx, mode="sev", no_cache=False):
     """
     Calculate the SEV launch digest from the CoCo configuration file
 
     To calculate the launch digest we use the sev-snp-measure tool:
     https://github.com/virtee/sev-snp-measure
+
+    We cache launch digests across runs, and only re-calculate them when a
+    measured input changes. Pass `--no-cache` to always re-calculate it.
     """
-    ld = do_get_launch_digest(mode)
+    ld = do_get_launch_digest(mode, use_cache=not no_cache)
     print("Calculated measurement:", ld.hex())
+
+
+@task
+def precompute_launch_digests(ctx, num_workers=None, provision=False):
+    """
+    Calculate the launch digests for all the SEV runtimes, modes, and vCPU
+    counts that we allow, and (optionally) provision the KBS with them
+
+    Pods may request a different number of vCPUs (e.g. Knative annotations),
+    which changes the launch measurement. Provisioning all the digests up
+    front means that scaling a pod never fails attestation.
+    """
+    if num_workers is not None:
+        num_workers = int(num_workers)
+
+    start_ts = time()
+    all_inputs = get_allowed_launch_digest_inputs()
+    digests = get_launch_digests(list(all_inputs.values()), num_workers=num_workers)
+    print(
+        "Calculated {} launch digests in {:.2f} s".format(
+            len(digests), time() - start_ts
+        )
+    )
+
+    for (mode, sev_mode, vcpus), ld in zip(all_inputs, digests):
+        print(f"{mode:<10} {sev_mode.name:<8} {vcpus:>3} vCPU(s): {ld.hex()}")
+
+    if provision:
+        set_launch_measurement_policy(sorted(set(digests)))
+        print("Provisioned the KBS with {} launch digests".format(len(set(digests))))
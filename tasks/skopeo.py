@@ -1,12 +1,219 @@
 from invoke import task
-from tasks.util.skopeo import encrypt_container_image as do_encrypt_container_image
+from json import loads as json_loads
+from os.path import exists
+from tasks.util.guest_components import (
+    build_coco_keyprovider,
+    start_coco_keyprovider,
+    stop_coco_keyprovider,
+)
+from tasks.util.skopeo import (
+    AA_CTR_ENCRYPTION_KEY,
+    SKOPEO_ENCRYPT_NUM_WORKERS,
+    SKOPEO_ENCRYPTION_KEY,
+    LayerEncryptionPolicy,
+    create_encryption_key,
+    encrypt_container_image as do_encrypt_container_image,
+    encrypt_container_images,
+    get_encrypted_image_tag,
+)
+from tasks.util.k8s_api import K8sApiError, get_k8s_client
+from tasks.util.kubeadm import PodReadinessSpec, wait_for_pods
+from tasks.util.registry import get_local_registry_client
+from tasks.util.registry_api import parse_image_tag
+from time import sleep, time
+
+COLD_START_POD_NAME = "sc2-cold-start-bench"
+COLD_START_POD_LABEL = "apps.sc2.io/name=cold-start-bench"
 
 
 @task
-def encrypt_container_image(ctx, image_tag, sign=False):
+def encrypt_container_image(
+    ctx, image_tag, sign=False, no_cache=False, base=None, match=None
+):
     """
     Encrypt an OCI container image using Skopeo
 
     The image tag must be provided in the format: <registry>/<repo>/<name>:<tag>
+    For images in the local registry, we only encrypt the layers that we have
+    not encrypted before. Pass `--no-cache` to re-encrypt all layers.
+
+    To only encrypt the layers above a base image, pass `--base <image_tag>`.
+    To only encrypt the layers whose build step matches a glob pattern, pass
+    `--match <pattern>` (e.g. `--match "*COPY*"`). Selectively encrypted
+    images are always signed, and pods must run with the `verify` signature
+    policy (see `inv kbs.provision-launch-digest`) to check the integrity of
+    the plaintext layers.
+    """
+    do_encrypt_container_image(
+        image_tag,
+        sign=sign,
+        use_cache=not no_cache,
+        policy=LayerEncryptionPolicy(base, match),
+    )
+
+
+@task
+def encrypt_images(
+    ctx,
+    image_tags,
+    sign=False,
+    num_workers=SKOPEO_ENCRYPT_NUM_WORKERS,
+    no_cache=False,
+    base=None,
+    match=None,
+):
+    """
+    Encrypt (and sign) a comma-separated list of OCI container images
+
+    All images share one keyprovider and one encryption key. Each image tag
+    must be provided in the format: <registry>/<repo>/<name>:<tag>. See
+    `inv skopeo.encrypt-container-image` for the layer selection options.
+    """
+    encrypt_container_images(
+        [tag.strip() for tag in image_tags.split(",")],
+        sign=sign,
+        num_workers=int(num_workers),
+        use_cache=not no_cache,
+        policy=LayerEncryptionPolicy(base, match),
+    )
+
+
+@task
+def build_keyprovider(ctx, nocache=False):
+    """
+    Build the CoCo keyprovider image for the guest-components checkout
+
+    We tag the image with the checkout's commit, so we only re-build it when
+    the guest-components source changes.
+    """
+    print(build_coco_keyprovider(nocache=nocache))
+
+
+@task
+def start_keyprovider(ctx):
+    """
+    Start a long-lived CoCo keyprovider, that all image encryptions will use
+    until we stop it
+    """
+    if not exists(SKOPEO_ENCRYPTION_KEY):
+        create_encryption_key()
+
+    start_coco_keyprovider(SKOPEO_ENCRYPTION_KEY, AA_CTR_ENCRYPTION_KEY)
+
+
+@task
+def stop_keyprovider(ctx):
+    """
+    Stop a long-lived CoCo keyprovider
+    """
+    stop_coco_keyprovider()
+
+
+def tag_encrypted_image(image_tag, tag):
+    """
+    Copy the manifest of the encrypted version of an image (in the local
+    registry) to a new tag, and return the number of encrypted bytes in it.
+    Copying the manifest preserves its digest, and thus its signature
+    """
+    client = get_local_registry_client()
+    registry, repository, reference = parse_image_tag(
+        get_encrypted_image_tag(image_tag)
+    )
+    data, media_type, _ = client.get_manifest(repository, reference)
+    client.put_manifest(repository, tag, data, media_type)
+
+    encrypted_bytes = sum(
+        [
+            layer["size"]
+            for layer in json_loads(data)["layers"]
+            if layer["mediaType"].endswith("+encrypted")
+        ]
+    )
+    return "{}/{}:{}".format(registry, repository, tag), encrypted_bytes
+
+
+def time_cold_start(image_tag, runtime_class):
     """
-    do_encrypt_container_image(image_tag, sign=sign)
+    Time how long it takes for a pod running an image to be ready. Pods in
+    Kata pull (and decrypt) their images inside the guest, so every pod start
+    is a cold start
+    """
+    label_key, label_value = COLD_START_POD_LABEL.split("=")
+    pod = {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": COLD_START_POD_NAME, "labels": {label_key: label_value}},
+        "spec": {
+            "runtimeClassName": f"kata-{runtime_class}",
+            "restartPolicy": "Never",
+            "containers": [
+                {"name": "app", "image": image_tag, "imagePullPolicy": "Always"}
+            ],
+        },
+    }
+
+    client = get_k8s_client()
+    start_ts = time()
+    client.create("pods", pod, namespace="default")
+    try:
+        wait_for_pods([PodReadinessSpec("default", COLD_START_POD_LABEL, 1)])
+        cold_start_secs = time() - start_ts
+    finally:
+        client.delete("pods", COLD_START_POD_NAME, namespace="default")
+        while True:
+            try:
+                client.get("pods", COLD_START_POD_NAME, namespace="default")
+            except K8sApiError as e:
+                if e.status == 404:
+                    break
+                raise e
+            sleep(1)
+
+    return cold_start_secs
+
+
+@task
+def bench_cold_start(
+    ctx, image_tag, base=None, match=None, num_runs=3, runtime_class="qemu-snp-sc2"
+):
+    """
+    Compare the cold-start time of a fully and a selectively encrypted image
+
+    The image must be in the local registry. We encrypt it twice (fully, and
+    with the given `--base` and/or `--match` layer selection) and, for each
+    version, time starting a pod that runs it `num_runs` times. Selectively
+    encrypted images must be signed, so we sign both versions, so that we
+    time them under the same (`verify`) signature policy.
+    """
+    if base is None and match is None:
+        print("Must provide a --base image and/or a --match pattern")
+        raise RuntimeError("No layer selection policy!")
+
+    variants = []
+    do_encrypt_container_image(image_tag, sign=True)
+    variants.append(("full",) + tag_encrypted_image(image_tag, "encrypted-full"))
+    do_encrypt_container_image(
+        image_tag, sign=True, policy=LayerEncryptionPolicy(base, match)
+    )
+    variants.append(
+        ("selective",) + tag_encrypted_image(image_tag, "encrypted-selective")
+    )
+
+    print(
+        "{:<12} {:>16} {:>10} {:>10} {:>10}".format(
+            "Encryption", "Encrypted (MB)", "Mean (s)", "Min (s)", "Max (s)"
+        )
+    )
+    for name, variant_tag, encrypted_bytes in variants:
+        times = [
+            time_cold_start(variant_tag, runtime_class) for _ in range(int(num_runs))
+        ]
+        print(
+            "{:<12} {:>16.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                name,
+                encrypted_bytes / 1e6,
+                sum(times) / len(times),
+                min(times),
+                max(times),
+            )
+        )
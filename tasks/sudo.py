@@ -0,0 +1,86 @@
+from invoke import task
+from os import environ
+from os.path import join
+from tasks.sc2 import deploy, destroy
+from tasks.util.env import CONF_FILES_DIR
+from tasks.util.sudo import (
+    SUDO_HELPER_ENV_VAR,
+    sudo_copy,
+    sudo_mkdir,
+    sudo_remove,
+    sudo_write_file,
+)
+from time import time
+
+
+@task
+def bench(ctx, num_iters=50, work_dir="/tmp/sc2-sudo-bench", full_deploy=False):
+    """
+    Compare privileged file I/O with and without the privileged helper
+
+    Each iteration runs the same mix of operations that a deployment runs
+    (mkdir, copy, write, append, and remove). Pass `--full-deploy` to also
+    compare the wall time of a full deployment (which deploys and destroys
+    SC2 twice, so SC2 must not be deployed). The first deployment warms the
+    caches (e.g. images and manifests) for the second one, so we deploy with
+    the helper first, and the reported speed-up is a lower bound.
+    """
+    src_file = join(CONF_FILES_DIR, "kubeadm.conf")
+    ops_per_iter = 5
+
+    def do_bench():
+        start_ts = time()
+        for i in range(num_iters):
+            iter_dir = join(work_dir, str(i))
+            sudo_mkdir(iter_dir)
+            sudo_copy(src_file, join(iter_dir, "kubeadm.conf"))
+            sudo_write_file(join(iter_dir, "hosts.toml"), 'server = "https://sc2cr.io"')
+            sudo_write_file(join(iter_dir, "hosts"), "127.0.0.1 sc2cr.io", append=True)
+            sudo_remove(iter_dir, recursive=True)
+        return time() - start_ts
+
+    def do_bench_deploy():
+        start_ts = time()
+        deploy(ctx)
+        deploy_secs = time() - start_ts
+        destroy(ctx)
+        return deploy_secs
+
+    results = {}
+    deploy_results = {}
+    prev_mode = environ.get(SUDO_HELPER_ENV_VAR)
+    try:
+        for mode in ["off", "on"]:
+            environ[SUDO_HELPER_ENV_VAR] = mode
+            sudo_remove(work_dir, recursive=True)
+            results[mode] = do_bench()
+            sudo_remove(work_dir, recursive=True)
+
+        if full_deploy:
+            for mode in ["on", "off"]:
+                environ[SUDO_HELPER_ENV_VAR] = mode
+                deploy_results[mode] = do_bench_deploy()
+    finally:
+        if prev_mode is None:
+            environ.pop(SUDO_HELPER_ENV_VAR, None)
+        else:
+            environ[SUDO_HELPER_ENV_VAR] = prev_mode
+
+    num_ops = num_iters * ops_per_iter
+    labels = [("off", "sudo subprocess"), ("on", "privileged helper")]
+    for mode, label in labels:
+        print(
+            "{}: {:.2f} s for {} ops ({:.2f} ms/op)".format(
+                label, results[mode], num_ops, results[mode] / num_ops * 1e3
+            )
+        )
+    print("Speed-up: {:.1f}x".format(results["off"] / results["on"]))
+
+    if full_deploy:
+        for mode, label in labels:
+            print("{}: {:.1f} s to deploy SC2".format(label, deploy_results[mode]))
+        print(
+            "Deploy speed-up: {:.2f}x".format(
+                deploy_results["off"] / deploy_results["on"]
+            )
+        )
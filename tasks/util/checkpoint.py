@@ -0,0 +1,107 @@
+from hashlib import sha256
+from json import dumps as json_dumps, load as json_load
+from os import fdopen, makedirs, remove, replace, walk
+from os.path import dirname, exists, isabs, isdir, isfile, join, relpath
+from tasks.util.env import SC2_DEPLOY_STATE_FILE
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+# Directories that we never include in an input fingerprint (i.e. build
+# outputs)
+FINGERPRINT_IGNORED_DIRS = ["target", "__pycache__"]
+
+
+def hash_path(hasher, path):
+    """
+    Feed the contents of a file, or of all the files in a directory, to a
+    hasher
+    """
+    if isfile(path):
+        with open(path, "rb") as fh:
+            hasher.update(fh.read())
+        return
+
+    for root, dirs, files in walk(path):
+        dirs[:] = sorted([d for d in dirs if d not in FINGERPRINT_IGNORED_DIRS])
+        for file_name in sorted(files):
+            file_path = join(root, file_name)
+            hasher.update(relpath(file_path, path).encode("utf-8"))
+            with open(file_path, "rb") as fh:
+                hasher.update(fh.read())
+
+
+def get_fingerprint(inputs):
+    """
+    Get the fingerprint of a deployment phase's inputs
+
+    Each input is either a string (e.g. a version), or an absolute path to a
+    file or a directory (e.g. a config file), in which case we hash its
+    contents.
+    """
+    hasher = sha256()
+    for node_input in inputs:
+        node_input = str(node_input)
+        hasher.update(node_input.encode("utf-8"))
+        if isabs(node_input) and (isfile(node_input) or isdir(node_input)):
+            hash_path(hasher, node_input)
+
+    return hasher.hexdigest()
+
+
+class DeployState:
+    """
+    Record of the deployment phases that have completed, together with the
+    fingerprint of their inputs at the time they completed
+
+    We persist the state after each phase completes, so that we can resume an
+    interrupted (or failed) deployment. A phase is still valid if it has
+    completed with the same inputs, and all the phases it depends on are also
+    valid. Otherwise we must re-run it (and all the phases that depend on it).
+    """
+
+    def __init__(self, state_file=SC2_DEPLOY_STATE_FILE, resume=False):
+        self.state_file = state_file
+        self.lock = Lock()
+        self.phases = {}
+
+        if resume and exists(state_file):
+            with open(state_file, "r") as fh:
+                self.phases = json_load(fh)
+
+        # Start with a clean slate if not resuming
+        self.write()
+
+    def write(self):
+        makedirs(dirname(self.state_file), exist_ok=True)
+        tmp_fd, tmp_path = mkstemp(dir=dirname(self.state_file))
+        with fdopen(tmp_fd, "w") as fh:
+            fh.write(json_dumps(self.phases, indent=2, sort_keys=True) + "\n")
+        replace(tmp_path, self.state_file)
+
+    def is_valid(self, node, valid_deps=True):
+        """
+        Check if a phase can be skipped. `valid_deps` indicates whether all
+        the phases this one depends on have been skipped
+        """
+        with self.lock:
+            phase = self.phases.get(node.name)
+
+        return (
+            valid_deps
+            and phase is not None
+            and phase["fingerprint"] == get_fingerprint(node.inputs)
+        )
+
+    def mark_done(self, node):
+        with self.lock:
+            self.phases[node.name] = {
+                "fingerprint": get_fingerprint(node.inputs),
+                "completed_at": time(),
+            }
+            self.write()
+
+
+def remove_deploy_state(state_file=SC2_DEPLOY_STATE_FILE):
+    if exists(state_file):
+        remove(state_file)
@@ -0,0 +1,496 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from gzip import GzipFile
+from os import environ
+from os.path import dirname
+from stat import S_IFDIR, S_IFMT, S_IFREG, S_IMODE
+from subprocess import PIPE, Popen
+from time import time
+
+# Minimal streaming reader and writer for cpio archives in the `newc` format
+# (i.e. the format of Linux initramfs images). Each entry is a fixed-size
+# ASCII header (a magic number followed by 13 8-digit hex fields), the entry
+# name, and the entry data, with the name and the data padded to 4 bytes (see
+# the kernel docs: driver-api/early-userspace/buffer-format.rst)
+CPIO_NEWC_MAGIC = b"070701"
+CPIO_NEWC_HEADER_SIZE = 110
+CPIO_TRAILER_NAME = "TRAILER!!!"
+
+CpioEntry = namedtuple(
+    "CpioEntry",
+    [
+        "name",
+        "ino",
+        "mode",
+        "uid",
+        "gid",
+        "nlink",
+        "mtime",
+        "dev_major",
+        "dev_minor",
+        "rdev_major",
+        "rdev_minor",
+        "data",
+    ],
+)
+
+# A file that we want to add to (or replace in) an initrd. If `append` is
+# set, and the file already exists, we append the data to the existing file.
+# If `mode` is not set, we keep the permissions of the existing file (or use
+# 0644 for new files)
+InitrdFile = namedtuple(
+    "InitrdFile", ["data", "append", "mode"], defaults=[False, None]
+)
+
+# Inode numbers for the entries we add, picked from the top of the range to
+# not clash with the existing entries
+CPIO_NEW_INO_BASE = 0xFFFF0000
+
+SOURCE_DATE_EPOCH_ENV_VAR = "SOURCE_DATE_EPOCH"
+
+# Compressors that the kernel can unpack an initrd with, and the command we
+# use for each (we compress gzip in-process). Note that the kernel only
+# supports lz4's legacy frame format, and that the guest kernel must be built
+# with the matching CONFIG_RD_* option
+INITRD_CODECS = {
+    "gzip": None,
+    "lz4": ["lz4", "-l", "-9", "-c", "-q"],
+    "zstd": ["zstd", "-19", "-c", "-q"],
+    "none": None,
+}
+INITRD_CODEC_MAGICS = {
+    "gzip": b"\x1f\x8b",
+    "lz4": b"\x02\x21\x4c\x18",
+    "zstd": b"\x28\xb5\x2f\xfd",
+    "none": CPIO_NEWC_MAGIC,
+}
+
+
+def pad_to_4(length):
+    return (4 - length % 4) % 4
+
+
+def read_exactly(fh, num_bytes):
+    data = fh.read(num_bytes)
+    if len(data) != num_bytes:
+        raise RuntimeError("Truncated cpio archive!")
+
+    return data
+
+
+def read_cpio(fh):
+    """
+    Yield all the entries in a cpio (newc) archive, read from a file object,
+    until the trailer entry
+    """
+    while True:
+        header = read_exactly(fh, CPIO_NEWC_HEADER_SIZE)
+        if header[:6] != CPIO_NEWC_MAGIC:
+            raise RuntimeError(f"Unrecognized cpio magic: {header[:6]}")
+
+        fields = [int(header[6 + 8 * i : 14 + 8 * i], 16) for i in range(13)]
+        (
+            ino,
+            mode,
+            uid,
+            gid,
+            nlink,
+            mtime,
+            file_size,
+            dev_major,
+            dev_minor,
+            rdev_major,
+            rdev_minor,
+            name_size,
+            _,
+        ) = fields
+
+        name = read_exactly(fh, name_size)[:-1].decode("utf-8")
+        read_exactly(fh, pad_to_4(CPIO_NEWC_HEADER_SIZE + name_size))
+        if name == CPIO_TRAILER_NAME:
+            return
+
+        data = read_exactly(fh, file_size)
+        read_exactly(fh, pad_to_4(file_size))
+
+        yield CpioEntry(
+            name,
+            ino,
+            mode,
+            uid,
+            gid,
+            nlink,
+            mtime,
+            dev_major,
+            dev_minor,
+            rdev_major,
+            rdev_minor,
+            data,
+        )
+
+
+def write_cpio_entry(fh, entry):
+    name = entry.name.encode("utf-8") + b"\0"
+    fields = [
+        entry.ino,
+        entry.mode,
+        entry.uid,
+        entry.gid,
+        entry.nlink,
+        entry.mtime,
+        len(entry.data),
+        entry.dev_major,
+        entry.dev_minor,
+        entry.rdev_major,
+        entry.rdev_minor,
+        len(name),
+        0,
+    ]
+    fh.write(CPIO_NEWC_MAGIC + "".join([f"{f:08X}" for f in fields]).encode("ascii"))
+    fh.write(name + b"\0" * pad_to_4(CPIO_NEWC_HEADER_SIZE + len(name)))
+    fh.write(entry.data + b"\0" * pad_to_4(len(entry.data)))
+
+
+def write_cpio_trailer(fh):
+    write_cpio_entry(
+        fh, CpioEntry(CPIO_TRAILER_NAME, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, b"")
+    )
+
+
+def normalize_name(name):
+    """
+    Normalize an entry name (or a guest path) so that `./usr/bin`, `usr/bin`,
+    and `/usr/bin` compare equal
+    """
+    if name.startswith("./"):
+        name = name[2:]
+
+    return name.strip("/") or "."
+
+
+def get_source_date_epoch():
+    """
+    Timestamp that we use for all entries in reproducible archives. We honour
+    the SOURCE_DATE_EPOCH convention (see https://reproducible-builds.org)
+    """
+    return int(environ.get(SOURCE_DATE_EPOCH_ENV_VAR, "0"))
+
+
+def rewrite_cpio_entries(entries, files, mtime):
+    """
+    Rewrite a stream of cpio entries, replacing, appending to, or adding the
+    files in a {guest_path: InitrdFile} dict
+    """
+    files = {normalize_name(path): initrd_file for path, initrd_file in files.items()}
+    pending = dict(files)
+    dirs = set()
+    name_prefix = ""
+    num_entries = 0
+
+    for entry in entries:
+        name = normalize_name(entry.name)
+        if entry.name.startswith("./"):
+            name_prefix = "./"
+        if S_IFMT(entry.mode) == S_IFDIR:
+            dirs.add(name)
+
+        if name in pending:
+            initrd_file = pending.pop(name)
+            is_file = S_IFMT(entry.mode) == S_IFREG
+            data = initrd_file.data
+            if initrd_file.append:
+                # We can not append to a symlink (or a directory) in a stream,
+                # as its target may come earlier in the archive. Rather than
+                # silently dropping the original contents, we bail out
+                if not is_file:
+                    print(f"ERROR: can not append to non-regular file: {name}")
+                    raise RuntimeError("Can not append to initrd entry!")
+                data = entry.data + data
+            perms = initrd_file.mode
+            if perms is None:
+                perms = S_IMODE(entry.mode) if is_file else 0o644
+
+            # Replacing a file always results in a regular file (e.g. even if
+            # the original entry was a symlink). It also gets a new inode, as
+            # it may have been a hard link to other entries in the archive
+            entry = entry._replace(
+                ino=CPIO_NEW_INO_BASE + num_entries,
+                mode=S_IFREG | perms,
+                nlink=1,
+                mtime=mtime,
+                uid=0,
+                gid=0,
+                data=data,
+            )
+
+        yield entry
+        num_entries += 1
+
+    # Add all the files that were not in the original archive, creating any
+    # missing parent directories first
+    for name, initrd_file in sorted(pending.items()):
+        parents = []
+        parent = dirname(name)
+        while parent not in ["", "."] and parent not in dirs:
+            parents.append(parent)
+            parent = dirname(parent)
+        for parent in reversed(parents):
+            yield CpioEntry(
+                name_prefix + parent,
+                CPIO_NEW_INO_BASE + num_entries,
+                S_IFDIR | 0o755,
+                0,
+                0,
+                2,
+                mtime,
+                0,
+                0,
+                0,
+                0,
+                b"",
+            )
+            dirs.add(parent)
+            num_entries += 1
+
+        perms = 0o644 if initrd_file.mode is None else initrd_file.mode
+        yield CpioEntry(
+            name_prefix + name,
+            CPIO_NEW_INO_BASE + num_entries,
+            S_IFREG | perms,
+            0,
+            0,
+            1,
+            mtime,
+            0,
+            0,
+            0,
+            0,
+            initrd_file.data,
+        )
+        num_entries += 1
+
+
+def normalize_cpio_entries(entries, mtime):
+    """
+    Make a stream of cpio entries reproducible: sort the entries by name (so
+    that parents come before their children), and reset all the metadata that
+    depends on when, where, and by whom the archive was built (timestamps,
+    owners, inode, and device numbers)
+
+    Hard links share an inode number, and only the last link in the archive
+    carries the data, so we renumber inodes consistently and move the data to
+    the last link in the new order.
+    """
+    entries = sorted(entries, key=lambda e: normalize_name(e.name))
+
+    inodes = {}
+    link_data = {}
+    last_link = {}
+    for i, entry in enumerate(entries):
+        key = (entry.dev_major, entry.dev_minor, entry.ino)
+        if key not in inodes:
+            inodes[key] = len(inodes) + 1
+        if S_IFMT(entry.mode) == S_IFREG and entry.nlink > 1:
+            link_data[key] = link_data.get(key, b"") or entry.data
+            last_link[key] = i
+
+    for i, entry in enumerate(entries):
+        key = (entry.dev_major, entry.dev_minor, entry.ino)
+        data = entry.data
+        if key in link_data and entry.nlink > 1:
+            data = link_data[key] if last_link[key] == i else b""
+
+        yield entry._replace(
+            ino=inodes[key],
+            uid=0,
+            gid=0,
+            mtime=mtime,
+            dev_major=0,
+            dev_minor=0,
+            data=data,
+        )
+
+
+def read_initrd_allowlist(allowlist_path):
+    """
+    Read an initrd allowlist: one glob pattern (see `fnmatch`) per line,
+    matched against guest paths relative to the root of the initrd. Empty
+    lines and lines starting with `#` are ignored
+    """
+    with open(allowlist_path, "r") as fh:
+        lines = [line.strip() for line in fh.readlines()]
+
+    return [normalize_name(line) for line in lines if line and line[0] != "#"]
+
+
+def prune_cpio_entries(entries, allowlist, keep=()):
+    """
+    Drop all the entries in a stream of cpio entries that do not match any
+    pattern in an allowlist, or the guest paths in `keep`. We always keep the
+    parent directories of the entries that we keep
+    """
+    entries = list(entries)
+    keep = {normalize_name(path) for path in keep}
+
+    kept_names = set()
+    for entry in entries:
+        name = normalize_name(entry.name)
+        if name in keep or any([fnmatch(name, pattern) for pattern in allowlist]):
+            while name not in kept_names and name not in ["", "."]:
+                kept_names.add(name)
+                name = dirname(name)
+    kept_names.add(".")
+
+    for entry in entries:
+        if normalize_name(entry.name) in kept_names:
+            yield entry
+
+
+def rewrite_cpio(in_fh, out_fh, files, reproducible=False, allowlist=None):
+    """
+    Stream a cpio archive from one file object to another, replacing,
+    appending to, or adding the files in a {guest_path: InitrdFile} dict
+
+    If `reproducible` is set, the output only depends on the input entries
+    (and not on their order, or when we rewrite them), at the cost of holding
+    all the entries in memory to sort them. If given an allowlist (a list of
+    glob patterns), we drop all the entries that do not match it (see
+    `prune_cpio_entries`).
+
+    Returns the number of entries written.
+    """
+    mtime = get_source_date_epoch() if reproducible else int(time())
+    entries = rewrite_cpio_entries(read_cpio(in_fh), files, mtime)
+    if allowlist is not None:
+        entries = prune_cpio_entries(entries, allowlist, keep=files)
+    if reproducible:
+        entries = normalize_cpio_entries(entries, mtime)
+
+    num_entries = 0
+    for entry in entries:
+        write_cpio_entry(out_fh, entry)
+        num_entries += 1
+    write_cpio_trailer(out_fh)
+
+    return num_entries
+
+
+def get_initrd_codec(initrd_path):
+    """
+    Work out the codec of an initrd from its magic number
+    """
+    with open(initrd_path, "rb") as fh:
+        magic = fh.read(6)
+
+    for codec, codec_magic in INITRD_CODEC_MAGICS.items():
+        if magic.startswith(codec_magic):
+            return codec
+
+    raise RuntimeError(f"Unrecognized initrd format: {magic}")
+
+
+@contextmanager
+def open_initrd(initrd_path):
+    """
+    Open an initrd compressed with any of the supported codecs, and yield a
+    file object with the (uncompressed) cpio archive
+    """
+    codec = get_initrd_codec(initrd_path)
+    if codec == "gzip":
+        with GzipFile(initrd_path, "rb") as fh:
+            yield fh
+    elif codec == "none":
+        with open(initrd_path, "rb") as fh:
+            yield fh
+    else:
+        proc = Popen([codec, "-d", "-c", "-q", initrd_path], stdout=PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+
+@contextmanager
+def create_initrd(initrd_path, codec="gzip", compress_level=9, reproducible=False):
+    """
+    Create an initrd compressed with a codec, and yield a file object to
+    write the (uncompressed) cpio archive to
+    """
+    if codec not in INITRD_CODECS:
+        print(f"ERROR: unsupported initrd codec: {codec}")
+        print(f"Must be one in: {list(INITRD_CODECS)}")
+        raise RuntimeError("Unsupported initrd codec!")
+
+    with open(initrd_path, "wb") as out_fh:
+        if codec == "gzip":
+            # Never store the file name in the gzip header, and only store a
+            # timestamp for non-reproducible builds
+            with GzipFile(
+                filename="",
+                mode="wb",
+                compresslevel=compress_level,
+                fileobj=out_fh,
+                mtime=get_source_date_epoch() if reproducible else None,
+            ) as fh:
+                yield fh
+        elif codec == "none":
+            yield out_fh
+        else:
+            proc = Popen(INITRD_CODECS[codec], stdin=PIPE, stdout=out_fh)
+            try:
+                yield proc.stdin
+            finally:
+                proc.stdin.close()
+                proc.wait()
+            assert proc.returncode == 0, f"Error compressing initrd with {codec}"
+
+
+def rewrite_initrd(
+    src_initrd_path,
+    dst_initrd_path,
+    files,
+    compress_level=9,
+    reproducible=False,
+    codec="gzip",
+    allowlist=None,
+):
+    """
+    Write a new initrd to `dst_initrd_path`, with the same entries as
+    `src_initrd_path` plus the files in a {guest_path: InitrdFile} dict
+
+    We never unpack the initrd to disk: we decompress, rewrite, and compress
+    the archive one entry at a time, so we do not need root permissions to
+    stage the initrd's filesystem. If `reproducible` is set, the same inputs
+    always result in the same bytes (see `rewrite_cpio`). The compression
+    level only applies to gzip.
+    """
+    with open_initrd(src_initrd_path) as in_fh, create_initrd(
+        dst_initrd_path,
+        codec=codec,
+        compress_level=compress_level,
+        reproducible=reproducible,
+    ) as out_fh:
+        return rewrite_cpio(
+            in_fh, out_fh, files, reproducible=reproducible, allowlist=allowlist
+        )
+
+
+def get_initrd_contents(initrd_path):
+    """
+    Return a {name: (type, permissions, uid, gid, data)} dict describing the
+    contents of an initrd, to compare two initrds irrespective of timestamps,
+    inode numbers, entry order, and compression
+    """
+    with open_initrd(initrd_path) as fh:
+        return {
+            normalize_name(e.name): (
+                S_IFMT(e.mode),
+                S_IMODE(e.mode),
+                e.uid,
+                e.gid,
+                e.data,
+            )
+            for e in read_cpio(fh)
+        }
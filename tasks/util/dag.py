@@ -0,0 +1,227 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import StringIO
+from tasks.util.trace import span
+from threading import local
+from time import time
+import sys
+
+# A node in a deployment graph: a unique name, a function that takes no
+# arguments, the list of names of the nodes that must complete before it can
+# start, and (optionally) the list of inputs that determine the result of the
+# node (see tasks.util.checkpoint)
+DagNode = namedtuple("DagNode", ["name", "fn", "deps", "inputs"], defaults=[()])
+
+# Start and end timestamps (relative to the start of the DAG) of a node
+DagNodeTiming = namedtuple("DagNodeTiming", ["start", "end"])
+
+DAG_DEFAULT_NUM_WORKERS = 4
+
+
+class NodeOutputRouter:
+    """
+    File-like object that we install as `sys.stdout` while running a DAG
+
+    Each node's prints go to a per-thread buffer, that we flush in one go when
+    the node finishes, so that the output of concurrent nodes does not get
+    interleaved. Prints from any other thread go straight to the real stdout.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = local()
+
+    def get_stream(self):
+        return getattr(self.local, "buffer", None) or self.stream
+
+    def write(self, data):
+        return self.get_stream().write(data)
+
+    def flush(self):
+        self.get_stream().flush()
+
+    def start_buffering(self):
+        self.local.buffer = StringIO()
+
+    def stop_buffering(self):
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+
+def check_dag(nodes):
+    """
+    Check that all the dependencies exist, and that there are no cycles
+    """
+    node_names = [node.name for node in nodes]
+    if len(set(node_names)) != len(node_names):
+        raise RuntimeError(f"Duplicate node names in DAG: {node_names}")
+
+    for node in nodes:
+        for dep in node.deps:
+            if dep not in node_names:
+                raise RuntimeError(f"Node {node.name} depends on unknown node {dep}")
+
+    # Kahn's algorithm: if we can not pop all nodes, there is a cycle
+    in_degree = {node.name: len(node.deps) for node in nodes}
+    ready = [name for name, degree in in_degree.items() if degree == 0]
+    num_visited = 0
+    while len(ready) > 0:
+        name = ready.pop()
+        num_visited += 1
+        for node in nodes:
+            if name in node.deps:
+                in_degree[node.name] -= 1
+                if in_degree[node.name] == 0:
+                    ready.append(node.name)
+
+    if num_visited != len(nodes):
+        raise RuntimeError("Deployment DAG has a cycle!")
+
+
+def get_critical_path(nodes, timings):
+    """
+    Work out the critical path of an executed DAG, i.e. the chain of nodes
+    that determined the total execution time
+
+    We start from the node that finished last, and walk back through the
+    dependency that finished last at each step.
+    """
+    nodes_by_name = {node.name: node for node in nodes}
+    name = max(timings, key=lambda n: timings[n].end)
+
+    critical_path = [name]
+    while len(nodes_by_name[name].deps) > 0:
+        name = max(nodes_by_name[name].deps, key=lambda n: timings[n].end)
+        critical_path.append(name)
+
+    return list(reversed(critical_path))
+
+
+def print_dag_report(nodes, timings):
+    nodes_by_name = {node.name: node for node in nodes}
+    total_time = max([t.end for t in timings.values()])
+    serial_time = sum([t.end - t.start for t in timings.values()])
+
+    print(
+        f"Ran {len(timings)} nodes in {total_time:.1f}s "
+        f"(sum of node times: {serial_time:.1f}s)"
+    )
+    print("Critical path:")
+    for name in get_critical_path(nodes, timings):
+        timing = timings[name]
+        # Time between the node being ready and the node starting, i.e. time
+        # spent waiting for a free worker
+        ready_ts = max([0] + [timings[dep].end for dep in nodes_by_name[name].deps])
+        print(
+            f"  {name:<32} {timing.end - timing.start:>8.1f}s "
+            f"(start: {timing.start:.1f}s, queued: {timing.start - ready_ts:.1f}s)"
+        )
+
+
+def run_dag(nodes, num_workers=DAG_DEFAULT_NUM_WORKERS, state=None):
+    """
+    Run the nodes of a DAG in a bounded pool of worker threads, starting each
+    node as soon as all its dependencies have completed
+
+    We stream one status line per node when it starts and finishes, followed
+    by the node's (buffered) output. If a node fails, we stop scheduling new
+    nodes, wait for the in-flight ones to finish (so that we do not leave
+    half-done work behind), and re-raise the first error.
+
+    If given a DeployState, we skip the nodes that are still valid from a
+    previous run, and record each node in it as soon as it completes.
+
+    Returns a dictionary with the DagNodeTiming of each node.
+    """
+    check_dag(nodes)
+
+    real_stdout = sys.stdout
+    start_ts = time()
+    pending = {node.name: node for node in nodes}
+    done = set()
+    skipped = set()
+    timings = {}
+    failed = []
+
+    def log(message):
+        real_stdout.write(f"[{time() - start_ts:7.1f}s] {message}\n")
+        real_stdout.flush()
+
+    def run_node(node, router):
+        router.start_buffering()
+        node_start = time() - start_ts
+        error = None
+        try:
+            with span(node.name, category="phase"):
+                node.fn()
+        except Exception as e:
+            error = e
+        output = router.stop_buffering()
+        timings[node.name] = DagNodeTiming(node_start, time() - start_ts)
+
+        return output, error
+
+    router = NodeOutputRouter(real_stdout)
+    sys.stdout = router
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            in_flight = {}
+            while len(pending) > 0 or len(in_flight) > 0:
+                # Schedule all the nodes whose dependencies are met, unless
+                # a node has already failed
+                if len(failed) == 0:
+                    ready = True
+                    while ready:
+                        ready = [
+                            node
+                            for node in pending.values()
+                            if all([dep in done for dep in node.deps])
+                        ]
+                        for node in ready:
+                            del pending[node.name]
+                            valid_deps = all([dep in skipped for dep in node.deps])
+                            if state is not None and state.is_valid(node, valid_deps):
+                                log(f"{node.name}: already done, skipping")
+                                ts = time() - start_ts
+                                timings[node.name] = DagNodeTiming(ts, ts)
+                                done.add(node.name)
+                                skipped.add(node.name)
+                                continue
+
+                            log(f"{node.name}: started")
+                            in_flight[pool.submit(run_node, node, router)] = node
+
+                if len(in_flight) == 0:
+                    break
+
+                finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = in_flight.pop(future)
+                    output, error = future.result()
+                    node_time = timings[node.name].end - timings[node.name].start
+                    if error is None:
+                        log(f"{node.name}: done in {node_time:.1f}s")
+                        done.add(node.name)
+                        if state is not None:
+                            state.mark_done(node)
+                    else:
+                        log(f"{node.name}: FAILED after {node_time:.1f}s")
+                        failed.append((node.name, error))
+
+                    if output:
+                        real_stdout.write(output.rstrip("\n") + "\n")
+    finally:
+        sys.stdout = real_stdout
+
+    if len(failed) > 0:
+        for name in pending:
+            log(f"{name}: not started")
+
+        name, error = failed[0]
+        print(f"ERROR: deployment node {name} failed: {error}")
+        raise error
+
+    print_dag_report(nodes, timings)
+
+    return timings
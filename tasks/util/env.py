@@ -10,6 +10,10 @@ GLOBAL_INSTALL_DIR = "/opt"
 COMPONENTS_DIR = join(PROJ_ROOT, "components")
 CONF_FILES_DIR = join(PROJ_ROOT, "conf-files")
 TEMPLATED_FILES_DIR = join(PROJ_ROOT, "templated")
+CACHE_DIR = join(PROJ_ROOT, ".cache")
+MANIFESTS_CACHE_DIR = join(CACHE_DIR, "manifests")
+INITRDS_CACHE_DIR = join(CACHE_DIR, "initrds")
+REGISTRY_MIRRORS_CACHE_DIR = join(CACHE_DIR, "registry-mirrors")
 
 # K8s Config
 
@@ -57,6 +61,10 @@ KATA_RUNTIMES = ["qemu-coco-dev", "qemu-snp", "qemu-tdx"]
 
 SC2_CONFIG_DIR = join(expanduser("~"), ".config", "sc2")
 SC2_DEPLOYMENT_FILE = join(SC2_CONFIG_DIR, "DEPLOYED")
+SC2_DEPLOY_STATE_FILE = join(SC2_CONFIG_DIR, "deploy_state.json")
+SC2_DEPLOY_TRACE_FILE = join(SC2_CONFIG_DIR, "deploy_trace.json")
+SC2_LAUNCH_DIGESTS_FILE = join(SC2_CONFIG_DIR, "launch_digests.json")
+SC2_ENCRYPTED_LAYERS_FILE = join(SC2_CONFIG_DIR, "encrypted_layers.json")
 SC2_RUNTIMES = ["qemu-snp-sc2", "qemu-tdx-sc2"]
 
 # ---------- Apps config ----------
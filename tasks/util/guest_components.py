@@ -1,7 +1,12 @@
+from contextlib import contextmanager
+from hashlib import sha256
 from os.path import join
+from socket import create_connection
 from subprocess import run
-from tasks.util.env import COMPONENTS_DIR
-from time import sleep
+from tasks.util.docker import is_ctr_running
+from tasks.util.env import COMPONENTS_DIR, PROJ_ROOT
+from threading import Lock
+from time import sleep, time
 
 GUEST_COMPONENTS_DIR = join(COMPONENTS_DIR, "guest-components")
 COCO_KEYPROVIDER_DIR = join(
@@ -10,38 +15,124 @@ COCO_KEYPROVIDER_DIR = join(
 
 COCO_KEYPROVIDER_CTR_NAME = "coco-keyprovider"
 COCO_KEYPROVIDER_CTR_PORT = 50000
+COCO_KEYPROVIDER_IMAGE_NAME = "sc2/coco-keyprovider"
+COCO_KEYPROVIDER_DOCKERFILE = join(PROJ_ROOT, "docker", "coco_keyprovider.dockerfile")
+COCO_KEYPROVIDER_READY_TIMEOUT_SECS = 60
+COCO_KEYPROVIDER_POLL_PERIOD_SECS = 0.1
+
+# Encryption sessions currently using the keyprovider (see `coco_keyprovider`)
+COCO_KEYPROVIDER_LOCK = Lock()
+COCO_KEYPROVIDER_REFS = 0
+COCO_KEYPROVIDER_STARTED = False
+
+
+def get_guest_components_version():
+    """
+    Get the version of our guest-components checkout: its commit, plus a hash
+    of any uncommitted changes
+    """
+    result = run(
+        "git rev-parse HEAD", shell=True, capture_output=True, cwd=GUEST_COMPONENTS_DIR
+    )
+    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+    version = result.stdout.decode("utf-8").strip()[:12]
+
+    result = run(
+        "git diff HEAD", shell=True, capture_output=True, cwd=GUEST_COMPONENTS_DIR
+    )
+    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+    if len(result.stdout) > 0:
+        version += "-dirty-{}".format(sha256(result.stdout).hexdigest()[:12])
+
+    return version
+
+
+def get_coco_keyprovider_image_tag():
+    return "{}:{}".format(COCO_KEYPROVIDER_IMAGE_NAME, get_guest_components_version())
+
+
+def build_coco_keyprovider(nocache=False):
+    """
+    Build the CoCo keyprovider image for the current guest-components checkout,
+    unless we have already built it. Returns the image tag
+    """
+    image_tag = get_coco_keyprovider_image_tag()
+    result = run(f"docker image inspect {image_tag}", shell=True, capture_output=True)
+    if result.returncode == 0 and not nocache:
+        return image_tag
+
+    docker_cmd = "docker build {} -t {} -f {} {}".format(
+        "--no-cache" if nocache else "",
+        image_tag,
+        COCO_KEYPROVIDER_DOCKERFILE,
+        GUEST_COMPONENTS_DIR,
+    )
+    run(docker_cmd, shell=True, check=True)
+
+    return image_tag
+
+
+def is_coco_keyprovider_ready():
+    """
+    Check if the keyprovider's gRPC server accepts connections
+    """
+    try:
+        with create_connection(("127.0.0.1", COCO_KEYPROVIDER_CTR_PORT), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_coco_keyprovider(timeout_secs=COCO_KEYPROVIDER_READY_TIMEOUT_SECS):
+    start_ts = time()
+    while not is_coco_keyprovider_ready():
+        if time() - start_ts > timeout_secs:
+            print("ERROR: timed-out waiting for the keyprovider's gRPC server")
+            raise RuntimeError("Keyprovider not ready!")
+
+        if not is_ctr_running(COCO_KEYPROVIDER_CTR_NAME):
+            print("ERROR: keyprovider container is not running")
+            raise RuntimeError("Keyprovider not running!")
+
+        sleep(COCO_KEYPROVIDER_POLL_PERIOD_SECS)
+
+    print("gRPC server ready!")
 
 
 def start_coco_keyprovider(host_key_path, guest_key_path):
     """
     Start the CoCo key-provider to encrypt a docker image using Skopeo
+
+    We run the pre-built keyprovider image for our guest-components checkout
+    (building it if necessary), and wait until its gRPC server is ready.
     """
+    image_tag = build_coco_keyprovider()
+
+    # Remove any exited keyprovider container (e.g. from a crashed session),
+    # as it would clash with the name of the new one
+    if not is_ctr_running(COCO_KEYPROVIDER_CTR_NAME):
+        run(
+            "docker rm -f {}".format(COCO_KEYPROVIDER_CTR_NAME),
+            shell=True,
+            capture_output=True,
+        )
+
     docker_cmd = [
         "docker run -d",
         "--net host",
         "--name {}".format(COCO_KEYPROVIDER_CTR_NAME),
-        "-v {}:/usr/src/guest-components".format(GUEST_COMPONENTS_DIR),
         "-v {}:{}".format(host_key_path, guest_key_path),
-        "-w /usr/src/guest-components/attestation-agent/coco-keyprovider",
-        "rust:1.72",
-        "bash -c 'rustup component add rustfmt && cargo run --release --bin",
-        "coco_keyprovider -- --socket 127.0.0.1:{}'".format(COCO_KEYPROVIDER_CTR_PORT),
+        image_tag,
+        "--socket 127.0.0.1:{}".format(COCO_KEYPROVIDER_CTR_PORT),
     ]
     docker_cmd = " ".join(docker_cmd)
     run(docker_cmd, shell=True, check=True)
 
-    # Wait for the gRPC server to be ready
-    poll_period = 2
-    string_to_check = "listening to socket addr"
-    while True:
-        sleep(poll_period)
-        logs_cmd = "docker logs {}".format(COCO_KEYPROVIDER_CTR_NAME)
-        ctr_logs = run(logs_cmd, shell=True, capture_output=True).stderr.decode("utf-8")
-        if string_to_check in ctr_logs:
-            print("gRPC server ready!")
-            break
-
-        print("Waiting for keyprovider's gRPC server to be ready...")
+    try:
+        wait_for_coco_keyprovider()
+    except RuntimeError:
+        stop_coco_keyprovider()
+        raise
 
 
 def stop_coco_keyprovider():
@@ -50,3 +141,34 @@ def stop_coco_keyprovider():
     """
     docker_cmd = "docker rm -f {}".format(COCO_KEYPROVIDER_CTR_NAME)
     run(docker_cmd, shell=True, check=True)
+
+
+@contextmanager
+def coco_keyprovider(host_key_path, guest_key_path):
+    """
+    Use the CoCo keyprovider within a block of code
+
+    Sessions are reference-counted: the first session starts the keyprovider
+    (unless it is already running, e.g. from `inv skopeo.start-keyprovider`),
+    concurrent and nested sessions share it, and the last session to finish
+    stops it (only if we started it).
+    """
+    global COCO_KEYPROVIDER_REFS, COCO_KEYPROVIDER_STARTED
+
+    with COCO_KEYPROVIDER_LOCK:
+        if COCO_KEYPROVIDER_REFS == 0:
+            COCO_KEYPROVIDER_STARTED = not is_ctr_running(COCO_KEYPROVIDER_CTR_NAME)
+            if COCO_KEYPROVIDER_STARTED:
+                start_coco_keyprovider(host_key_path, guest_key_path)
+            else:
+                wait_for_coco_keyprovider()
+        COCO_KEYPROVIDER_REFS += 1
+
+    try:
+        yield
+    finally:
+        with COCO_KEYPROVIDER_LOCK:
+            COCO_KEYPROVIDER_REFS -= 1
+            if COCO_KEYPROVIDER_REFS == 0 and COCO_KEYPROVIDER_STARTED:
+                stop_coco_keyprovider()
+                COCO_KEYPROVIDER_STARTED = False
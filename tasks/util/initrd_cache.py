@@ -0,0 +1,136 @@
+from hashlib import sha256
+from json import dumps as json_dumps, load as json_load
+from os import chmod, fdopen, listdir, makedirs, remove, replace, utime
+from os.path import exists, getmtime, join
+from tasks.util.env import INITRDS_CACHE_DIR
+from tempfile import mkstemp
+from threading import Lock
+
+# Building an initrd with our kata-agent takes a while, and changes the
+# launch measurement of every confidential VM. We keep a content-addressed
+# store of the initrds we build under the project directory: the fingerprint
+# of all the inputs to an initrd build (the base initrd, and the contents and
+# permissions of each file we swap in) maps to the SHA256 of the resulting
+# image in an index file, and the image lives in a file named after its
+# digest. As long as the inputs do not change, we re-use the exact same image
+# (and so the launch measurement stays the same).
+INITRDS_INDEX_FILE = join(INITRDS_CACHE_DIR, "index.json")
+INITRDS_BLOBS_DIR = join(INITRDS_CACHE_DIR, "sha256")
+
+# Each initrd is a few tens of MBs, so we only keep the most recently used
+# ones
+INITRDS_CACHE_MAX_ENTRIES = 8
+
+# Bump this version whenever we change how we build initrds from the same
+# inputs, to invalidate all the cached images
+INITRDS_CACHE_VERSION = "2"
+
+INITRDS_INDEX_LOCK = Lock()
+
+
+def get_blob_path(digest):
+    return join(INITRDS_BLOBS_DIR, f"{digest}.img")
+
+
+def read_index():
+    if not exists(INITRDS_INDEX_FILE):
+        return {}
+
+    with open(INITRDS_INDEX_FILE, "r") as fh:
+        return json_load(fh)
+
+
+def write_index(index):
+    tmp_fd, tmp_path = mkstemp(dir=INITRDS_CACHE_DIR)
+    with fdopen(tmp_fd, "w") as fh:
+        fh.write(json_dumps(index, indent=2, sort_keys=True) + "\n")
+    replace(tmp_path, INITRDS_INDEX_FILE)
+
+
+def get_file_digest(file_path):
+    hasher = sha256()
+    with open(file_path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def get_initrd_fingerprint(base_initrd_path, files, build_args=()):
+    """
+    Get the fingerprint of an initrd build from its base initrd, the files
+    that we add to it (a {guest_path: InitrdFile} dict), and any other
+    arguments that change the resulting image (e.g. the compression level)
+    """
+    hasher = sha256()
+    hasher.update(f"version={INITRDS_CACHE_VERSION}\n".encode("utf-8"))
+    hasher.update(f"base={get_file_digest(base_initrd_path)}\n".encode("utf-8"))
+    for guest_path in sorted(files):
+        initrd_file = files[guest_path]
+        hasher.update(
+            "file={},{},{},{}\n".format(
+                guest_path,
+                sha256(initrd_file.data).hexdigest(),
+                initrd_file.append,
+                initrd_file.mode,
+            ).encode("utf-8")
+        )
+    for build_arg in build_args:
+        hasher.update(f"arg={build_arg}\n".encode("utf-8"))
+
+    return hasher.hexdigest()
+
+
+def evict_initrds(max_entries=INITRDS_CACHE_MAX_ENTRIES):
+    """
+    Remove the least recently used images until there are at most
+    `max_entries` in the store, and drop any dangling index entries. Must be
+    called with the index lock held
+    """
+    blobs = sorted(
+        [join(INITRDS_BLOBS_DIR, b) for b in listdir(INITRDS_BLOBS_DIR)],
+        key=getmtime,
+        reverse=True,
+    )
+    for blob_path in blobs[max_entries:]:
+        remove(blob_path)
+
+    index = read_index()
+    index = {fp: d for fp, d in index.items() if exists(get_blob_path(d))}
+    write_index(index)
+
+
+def get_cached_initrd(fingerprint, build_fn):
+    """
+    Return the path to the cached initrd for a fingerprint, and whether it was
+    a cache hit. On a cache miss, we build the initrd by calling `build_fn`
+    with the path to write it to
+    """
+    makedirs(INITRDS_BLOBS_DIR, exist_ok=True)
+
+    with INITRDS_INDEX_LOCK:
+        digest = read_index().get(fingerprint)
+        if digest is not None and exists(get_blob_path(digest)):
+            # Touch the image to mark it as recently used
+            utime(get_blob_path(digest))
+            return get_blob_path(digest), True
+
+    tmp_fd, tmp_path = mkstemp(dir=INITRDS_CACHE_DIR, suffix=".img")
+    fdopen(tmp_fd).close()
+    try:
+        build_fn(tmp_path)
+        chmod(tmp_path, 0o644)
+        digest = get_file_digest(tmp_path)
+        blob_path = get_blob_path(digest)
+        replace(tmp_path, blob_path)
+    finally:
+        if exists(tmp_path):
+            remove(tmp_path)
+
+    with INITRDS_INDEX_LOCK:
+        index = read_index()
+        index[fingerprint] = digest
+        write_index(index)
+        evict_initrds()
+
+    return blob_path, False
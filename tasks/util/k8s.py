@@ -1,6 +1,6 @@
 from jinja2 import Environment, FileSystemLoader
 from os.path import basename, dirname
-from tasks.util.kubeadm import run_kubectl_command
+from tasks.util.k8s_api import get_k8s_client
 
 
 def template_k8s_file(template_file_path, output_file_path, template_vars):
@@ -25,7 +25,13 @@ def get_container_id_from_pod(pod_name, container_name):
     Get the container ID from a pod. The container name must be something in the
     style of 'user-container'
     """
-    kubectl_cmd = "kubectl get pod {} -o jsonpath='{{..status.contain".format(pod_name)
-    kubectl_cmd += 'erStatuses[?@(.name=="{}")].containerID}}'.format(container_name)
-    out = run_kubectl_command(kubectl_cmd, capture_output=True)
-    return out.removeprefix("containerd://")
+    pod = get_k8s_client().get("pods", pod_name, namespace="default")
+    container_ids = [
+        status["containerID"]
+        for status in pod["status"].get("containerStatuses", [])
+        if status["name"] == container_name
+    ]
+    assert len(container_ids) == 1, "Container {} not found in pod {}".format(
+        container_name, pod_name
+    )
+    return container_ids[0].removeprefix("containerd://")
@@ -0,0 +1,279 @@
+from base64 import b64decode
+from http.client import HTTPException, HTTPSConnection
+from json import dumps as json_dumps, loads as json_loads
+from os import stat
+from os.path import join
+from queue import Empty, LifoQueue
+from ssl import create_default_context
+from subprocess import run
+from tasks.util.env import KUBEADM_KUBECONFIG_FILE
+from tasks.util.trace import get_current_span
+from tempfile import TemporaryDirectory
+from threading import Lock
+from urllib.parse import urlencode, urlparse
+
+# Map each resource kind we use to its API prefix, and whether it is a
+# namespaced resource or not
+K8S_API_RESOURCES = {
+    "configmaps": ("api/v1", True),
+    "deployments": ("apis/apps/v1", True),
+    "namespaces": ("api/v1", False),
+    "nodes": ("api/v1", False),
+    "pods": ("api/v1", True),
+    "runtimeclasses": ("apis/node.k8s.io/v1", False),
+    "secrets": ("api/v1", True),
+    "services": ("api/v1", True),
+}
+
+K8S_API_FIELD_MANAGER = "sc2-deploy"
+K8S_API_POOL_SIZE = 4
+K8S_API_TIMEOUT_SECS = 30
+
+
+class K8sApiError(RuntimeError):
+    def __init__(self, method, path, status, reason, body):
+        self.status = status
+        super().__init__(
+            f"K8s API error: {method} {path} returned {status} ({reason}): {body}"
+        )
+
+
+class K8sClient:
+    """
+    Minimal client for the Kubernetes API server
+
+    The client reads the credentials from the kubeconfig file once, and keeps
+    a pool of keep-alive HTTPS connections to the API server, so that repeated
+    queries (e.g. in wait loops) do not re-negotiate TLS. It only covers the
+    typed operations that we need. For anything else (e.g. `apply -k`) we
+    still use `run_kubectl_command`.
+    """
+
+    def __init__(self, kubeconfig=KUBEADM_KUBECONFIG_FILE):
+        # Let kubectl parse the (YAML) kubeconfig file for us, and give us the
+        # current context with all the credentials inlined
+        kubectl_cmd = (
+            f"kubectl --kubeconfig={kubeconfig} config view --raw --minify -o json"
+        )
+        result = run(kubectl_cmd, shell=True, capture_output=True)
+        assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+        config = json_loads(result.stdout.decode("utf-8"))
+        cluster = config["clusters"][0]["cluster"]
+        user = config["users"][0]["user"]
+
+        server_url = urlparse(cluster["server"])
+        self.host = server_url.hostname
+        self.port = server_url.port or 443
+
+        self.ssl_context = create_default_context()
+        if "certificate-authority-data" in cluster:
+            self.ssl_context.load_verify_locations(
+                cadata=b64decode(cluster["certificate-authority-data"]).decode("utf-8")
+            )
+        elif "certificate-authority" in cluster:
+            self.ssl_context.load_verify_locations(
+                cafile=cluster["certificate-authority"]
+            )
+
+        # The SSL module can only load client certificates from files, so we
+        # stage them in a private temporary directory while we load them
+        self.headers = {"Accept": "application/json"}
+        if "client-certificate-data" in user:
+            with TemporaryDirectory() as tmp_dir:
+                cert_path = join(tmp_dir, "client.crt")
+                key_path = join(tmp_dir, "client.key")
+                with open(cert_path, "wb") as fh:
+                    fh.write(b64decode(user["client-certificate-data"]))
+                with open(key_path, "wb") as fh:
+                    fh.write(b64decode(user["client-key-data"]))
+                self.ssl_context.load_cert_chain(cert_path, key_path)
+        elif "token" in user:
+            self.headers["Authorization"] = "Bearer {}".format(user["token"])
+
+        self.pool = LifoQueue(maxsize=K8S_API_POOL_SIZE)
+
+    def new_connection(self, timeout=K8S_API_TIMEOUT_SECS):
+        return HTTPSConnection(
+            self.host, self.port, context=self.ssl_context, timeout=timeout
+        )
+
+    def get_connection(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            return self.new_connection()
+
+    def put_connection(self, conn):
+        if self.pool.full():
+            conn.close()
+        else:
+            self.pool.put_nowait(conn)
+
+    def request(self, method, path, body=None, query=None, content_type=None):
+        """
+        Send a request to the API server, and return the decoded JSON response
+        """
+        if query:
+            path = "{}?{}".format(path, urlencode(query))
+
+        headers = dict(self.headers)
+        if body is not None:
+            body = json_dumps(body).encode("utf-8")
+            headers["Content-Type"] = content_type or "application/json"
+
+        # Retry once with a new connection, as the server may have closed an
+        # idle connection in the pool
+        for attempt in range(2):
+            conn = self.get_connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, HTTPException):
+                conn.close()
+                if attempt == 1:
+                    raise
+
+                # Record the retry in the enclosing trace span (if any)
+                current_span = get_current_span()
+                if current_span is not None:
+                    current_span.incr("k8s_api_retries")
+        self.put_connection(conn)
+
+        if response.status >= 400:
+            raise K8sApiError(
+                method, path, response.status, response.reason, data.decode("utf-8")
+            )
+
+        return json_loads(data) if data else None
+
+    def get_path(self, kind, name=None, namespace=None):
+        api_prefix, namespaced = K8S_API_RESOURCES[kind]
+        path = "/" + api_prefix
+        if namespaced and namespace is not None:
+            path += f"/namespaces/{namespace}"
+        path += f"/{kind}"
+        if name is not None:
+            path += f"/{name}"
+
+        return path
+
+    def get(self, kind, name, namespace=None):
+        return self.request("GET", self.get_path(kind, name, namespace))
+
+    def list(self, kind, namespace=None, label_selector=None):
+        """
+        List all resources of a kind (in a namespace, if namespaced) and return
+        the list of items
+        """
+        return self.list_with_resource_version(kind, namespace, label_selector)[0]
+
+    def list_with_resource_version(self, kind, namespace=None, label_selector=None):
+        """
+        List all resources of a kind, and also return the resource version of
+        the list, so that we can start watching for changes from it
+        """
+        query = {"labelSelector": label_selector} if label_selector else None
+        response = self.request(
+            "GET", self.get_path(kind, namespace=namespace), query=query
+        )
+        return response["items"], response["metadata"]["resourceVersion"]
+
+    def watch(self, kind, namespace=None, resource_version=None, timeout_secs=30):
+        """
+        Yield the watch events for a kind of resource (in a namespace, if
+        namespaced) until the server closes the stream after `timeout_secs`
+
+        Watch streams are long-lived, so each one uses its own connection
+        rather than one from the pool.
+        """
+        query = {"watch": "true", "timeoutSeconds": timeout_secs}
+        if resource_version is not None:
+            query["resourceVersion"] = resource_version
+        path = "{}?{}".format(
+            self.get_path(kind, namespace=namespace), urlencode(query)
+        )
+
+        conn = self.new_connection(timeout=timeout_secs + K8S_API_TIMEOUT_SECS)
+        try:
+            conn.request("GET", path, headers=self.headers)
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise K8sApiError(
+                    "GET",
+                    path,
+                    response.status,
+                    response.reason,
+                    response.read().decode("utf-8"),
+                )
+
+            # The API server sends one JSON-encoded event per line
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+
+                yield json_loads(line)
+        finally:
+            conn.close()
+
+    def create(self, kind, body, namespace=None):
+        return self.request("POST", self.get_path(kind, namespace=namespace), body)
+
+    def patch(self, kind, name, patch, namespace=None):
+        """
+        Apply a JSON merge patch to a resource
+        """
+        return self.request(
+            "PATCH",
+            self.get_path(kind, name, namespace),
+            patch,
+            content_type="application/merge-patch+json",
+        )
+
+    def apply(self, kind, body, namespace=None):
+        """
+        Server-side apply a resource (i.e. create it or update it)
+        """
+        return self.request(
+            "PATCH",
+            self.get_path(kind, body["metadata"]["name"], namespace),
+            body,
+            query={"fieldManager": K8S_API_FIELD_MANAGER, "force": "true"},
+            content_type="application/apply-patch+yaml",
+        )
+
+    def delete(self, kind, name, namespace=None, tolerate_missing=False):
+        try:
+            return self.request("DELETE", self.get_path(kind, name, namespace))
+        except K8sApiError as e:
+            if tolerate_missing and e.status == 404:
+                return None
+            raise e
+
+
+K8S_CLIENT = None
+K8S_CLIENT_KUBECONFIG_MTIME = None
+K8S_CLIENT_LOCK = Lock()
+
+
+def get_k8s_client():
+    """
+    Get the session-wide K8s client, re-creating it if the kubeconfig file has
+    changed (e.g. after re-creating the cluster)
+    """
+    global K8S_CLIENT, K8S_CLIENT_KUBECONFIG_MTIME
+
+    with K8S_CLIENT_LOCK:
+        kubeconfig_mtime = stat(KUBEADM_KUBECONFIG_FILE).st_mtime_ns
+        if K8S_CLIENT is None or K8S_CLIENT_KUBECONFIG_MTIME != kubeconfig_mtime:
+            K8S_CLIENT = K8sClient()
+            K8S_CLIENT_KUBECONFIG_MTIME = kubeconfig_mtime
+
+    return K8S_CLIENT
+
+
+def is_pod_ready(pod):
+    conditions = pod.get("status", {}).get("conditions", [])
+    return any(c["type"] == "Ready" and c["status"] == "True" for c in conditions)
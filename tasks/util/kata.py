@@ -1,8 +1,13 @@
-from os import makedirs
-from os.path import dirname, exists, join
-from subprocess import run
+from os import chmod, makedirs, stat
+from os.path import basename, dirname, exists, getsize, join
+from shutil import copyfile, copyfileobj, copymode, rmtree
+from stat import S_IMODE
+from subprocess import PIPE, Popen, run
+from tarfile import open as tar_open
+from tasks.util.cpio import InitrdFile, read_initrd_allowlist, rewrite_initrd
 from tasks.util.docker import is_ctr_running
 from tasks.util.env import (
+    CONF_FILES_DIR,
     CONTAINERD_CONFIG_FILE,
     KATA_CONFIG_DIR,
     KATA_IMG_DIR,
@@ -12,8 +17,12 @@ from tasks.util.env import (
     KATA_IMAGE_TAG,
     SC2_RUNTIMES,
 )
+from tasks.util.initrd_cache import get_cached_initrd, get_initrd_fingerprint
 from tasks.util.registry import HOST_CERT_PATH
-from tasks.util.toml import remove_entry_from_toml, update_toml
+from tasks.util.sudo import sudo_copy, sudo_mkdir, sudo_remove, sudo_write_file
+from tasks.util.toml import TomlTransaction
+from tasks.util.trace import span
+from tempfile import mkdtemp
 
 # These paths are hardcoded in the docker image: ./docker/kata.dockerfile
 KATA_SOURCE_DIR = "/go/src/github.com/kata-containers/kata-containers-sc2"
@@ -23,6 +32,19 @@ KATA_BASELINE_SOURCE_DIR = "/go/src/github.com/kata-containers/kata-containers-b
 KATA_BASELINE_AGENT_SOURCE_DIR = join(KATA_BASELINE_SOURCE_DIR, "src", "agent")
 KATA_BASELINE_SHIM_SOURCE_DIR = join(KATA_BASELINE_SOURCE_DIR, "src", "runtime")
 
+# We always start from a _clean_ initrd when replacing the agent
+BASE_INITRD_PATH = join(KATA_IMG_DIR, "kata-containers-initrd-confidential.img")
+
+# Allowlist of the initrd entries that we keep in slim initrds
+INITRD_ALLOWLIST_FILE = join(CONF_FILES_DIR, "initrd_allowlist.txt")
+
+# Host files that we want to _always_ include in our custom agent builds,
+# either replacing ("w") or appending to ("a") the file in the guest
+INITRD_EXTRA_FILES = {
+    "/etc/hosts": {"path": "/etc/hosts", "mode": "w"},
+    HOST_CERT_PATH: {"path": "/etc/ssl/certs/ca-certificates.crt", "mode": "a"},
+}
+
 
 def run_kata_workon_ctr(mount_path=None):
     """
@@ -63,170 +85,350 @@ def stop_kata_workon_ctr():
     assert result.returncode == 0
 
 
-# TODO: differentiate between a hot-replace and a regular replace
-def copy_from_kata_workon_ctr(ctr_path, host_path, sudo=False, debug=False):
-    ctr_started = run_kata_workon_ctr()
+def copy_files_from_kata_workon_ctr(paths, sudo=False, debug=False):
+    """
+    Copy a list of (ctr_path, host_path) pairs out of the Kata workon
+    container
 
-    docker_cmd = "docker cp {}:{} {}".format(
-        KATA_WORKON_CTR_NAME,
-        ctr_path,
-        host_path,
-    )
-    if sudo:
-        docker_cmd = "sudo {}".format(docker_cmd)
-    result = run(docker_cmd, shell=True, capture_output=True)
-    if debug:
-        print(result.stdout.decode("utf-8").strip())
+    We pull all the files in a single tar stream from one container instance
+    (i.e. one `docker exec`), and write each entry to its host path(s) as we
+    read it. The same container path may be copied to more than one host
+    path. If `sudo` is set, we write the files as root.
+    """
+    # Map each path in the tar stream (relative to the container's root) to
+    # all the host paths we must copy it to
+    host_paths = {}
+    for ctr_path, host_path in paths:
+        host_paths.setdefault(ctr_path.lstrip("/"), []).append(host_path)
 
-    # If the Kata workon ctr was not running before, make sure we delete it
-    if ctr_started:
-        stop_kata_workon_ctr()
+    ctr_started = run_kata_workon_ctr()
+    tmp_dir = mkdtemp(prefix="sc2-kata-cp-") if sudo else None
+    try:
+        # Follow symlinks (-h), as we only ever want the files' contents
+        tar_cmd = "docker exec {} tar -chf - -C / {}".format(
+            KATA_WORKON_CTR_NAME, " ".join(sorted(host_paths))
+        )
+        if debug:
+            print(tar_cmd)
+
+        copied = set()
+        with span("copy-from-workon-ctr", num_files=len(paths)) as copy_span:
+            proc = Popen(tar_cmd, shell=True, stdout=PIPE, stderr=PIPE)
+            with tar_open(fileobj=proc.stdout, mode="r|") as tar:
+                for member in tar:
+                    if member.name not in host_paths or not member.isfile():
+                        continue
+
+                    # If writing as root, stage the file in a temporary
+                    # directory first, and copy it into place from there
+                    staging_path = (
+                        join(tmp_dir, str(len(copied)))
+                        if sudo
+                        else host_paths[member.name][0]
+                    )
+                    with open(staging_path, "wb") as fh:
+                        copyfileobj(tar.extractfile(member), fh)
+                    chmod(staging_path, member.mode)
+
+                    dst_paths = host_paths[member.name]
+                    for host_path in dst_paths if sudo else dst_paths[1:]:
+                        if sudo:
+                            sudo_copy(staging_path, host_path)
+                        else:
+                            copyfile(staging_path, host_path)
+                            copymode(staging_path, host_path)
+
+                    copied.add(member.name)
+                    copy_span.incr("bytes", member.size)
+
+            stderr = proc.stderr.read().decode("utf-8").strip()
+            proc.wait()
+            missing = sorted(set(host_paths) - copied)
+            if proc.returncode != 0 or len(missing) > 0:
+                print(f"ERROR: copying {missing} from Kata workon ctr: {stderr}")
+                raise RuntimeError("Error copying files from Kata workon ctr!")
+    finally:
+        if tmp_dir is not None:
+            rmtree(tmp_dir)
+
+        # If the Kata workon ctr was not running before, make sure we delete it
+        if ctr_started:
+            stop_kata_workon_ctr()
 
 
-def replace_agent(
-    dst_initrd_path=join(KATA_IMG_DIR, "kata-containers-initrd-confidential-sc2.img"),
-    debug=False,
-    sc2=False,
-):
-    """
-    Replace the kata-agent with a custom-built one
+def copy_from_kata_workon_ctr(ctr_path, host_path, sudo=False, debug=False):
+    copy_files_from_kata_workon_ctr([(ctr_path, host_path)], sudo=sudo, debug=debug)
 
-    Replacing the kata-agent is a bit fiddly, as the kata-agent binary lives
-    inside the initrd guest image that we load to the VM. The replacement
-    includes the following steps:
-    1. Find the initrd file - should be pointed in the Kata config file
-    2. Unpack the initrd
-    3. Replace the init process by the new kata agent
-    4. Re-build the initrd
-    5. Update the kata config to point to the new initrd
 
-    By using the extra_flags optional argument, you can pass a dictionary of
-    host_path: guest_path pairs of files you want to be included in the initrd.
-    """
-    # This is a list of files that we want to _always_ include in our custom
-    # agent builds
-    extra_files = {
-        "/etc/hosts": {"path": "/etc/hosts", "mode": "w"},
-        HOST_CERT_PATH: {"path": "/etc/ssl/certs/ca-certificates.crt", "mode": "a"},
-    }
+def get_agent_ctr_path(sc2=False):
+    return join(
+        KATA_AGENT_SOURCE_DIR if sc2 else KATA_BASELINE_AGENT_SOURCE_DIR,
+        "target",
+        "x86_64-unknown-linux-musl",
+        "release",
+        "kata-agent",
+    )
 
-    # Use a hardcoded path, as we want to always start from a _clean_ initrd
-    initrd_path = join(KATA_IMG_DIR, "kata-containers-initrd-confidential.img")
 
+def build_initrd_legacy(dst_initrd_path, agent_ctr_path, debug=False):
+    """
+    Build an initrd with our kata-agent by unpacking the base initrd to a
+    temporary directory (as root), copying the files in, and re-packing it
+    with Kata's initrd_builder.sh script
+    """
     # Make empty temporary dir to expand the initrd filesystem
     workdir = "/tmp/qemu-sev-initrd"
-    run("sudo rm -rf {}".format(workdir), shell=True, check=True)
+    sudo_remove(workdir, recursive=True)
     makedirs(workdir)
 
     # sudo unpack the initrd filesystem
-    zcat_cmd = "sudo bash -c 'zcat {} | cpio -idmv'".format(initrd_path)
-    out = run(zcat_cmd, shell=True, capture_output=True, cwd=workdir)
-    assert out.returncode == 0, "Error unpacking initrd: {}".format(out.stderr)
+    zcat_cmd = "sudo bash -c 'zcat {} | cpio -idmv'".format(BASE_INITRD_PATH)
+    with span("unpack-initrd", cmd=zcat_cmd, bytes=getsize(BASE_INITRD_PATH)):
+        out = run(zcat_cmd, shell=True, capture_output=True, cwd=workdir)
+        assert out.returncode == 0, "Error unpacking initrd: {}".format(out.stderr)
 
     # Copy the kata-agent in our docker image into `/usr/bin/kata-agent` as
-    # this is the path expected by the kata initrd_builder.sh script
-    agent_host_path = join(
-        KATA_AGENT_SOURCE_DIR if sc2 else KATA_BASELINE_AGENT_SOURCE_DIR,
-        "target",
-        "x86_64-unknown-linux-musl",
-        "release",
-        "kata-agent",
-    )
-    agent_initrd_path = join(workdir, "usr/bin/kata-agent")
-    copy_from_kata_workon_ctr(
-        agent_host_path, agent_initrd_path, sudo=True, debug=debug
-    )
-
-    # We also need to manually copy the agent to <root_fs>/sbin/init (note that
-    # <root_fs>/init is a symlink to <root_fs>/sbin/init)
-    alt_agent_initrd_path = join(workdir, "sbin", "init")
-    run("sudo rm {}".format(alt_agent_initrd_path), shell=True, check=True)
-    copy_from_kata_workon_ctr(
-        agent_host_path, alt_agent_initrd_path, sudo=True, debug=debug
-    )
+    # this is the path expected by the kata initrd_builder.sh script. We also
+    # need to manually copy the agent to <root_fs>/sbin/init (note that
+    # <root_fs>/init is a symlink to <root_fs>/sbin/init). Lastly, to pack the
+    # initrd again, we need Kata's initrd_builder.sh script. Annoyingly, we
+    # also need to copy a bash script in the same relative directory structure
+    # (cuz bash). We copy all the files in one go.
+    kata_tmp_scripts = "/tmp/osbuilder"
+    initrd_builder_path = join(kata_tmp_scripts, "initrd-builder", "initrd_builder.sh")
+    with span("copy-agent"):
+        sudo_remove(kata_tmp_scripts, recursive=True)
+        makedirs(join(kata_tmp_scripts, "scripts"))
+        makedirs(join(kata_tmp_scripts, "initrd-builder"))
+
+        alt_agent_initrd_path = join(workdir, "sbin", "init")
+        sudo_remove(alt_agent_initrd_path)
+        copy_files_from_kata_workon_ctr(
+            [
+                (agent_ctr_path, join(workdir, "usr/bin/kata-agent")),
+                (agent_ctr_path, alt_agent_initrd_path),
+                (
+                    join(
+                        KATA_SOURCE_DIR,
+                        "tools",
+                        "osbuilder",
+                        "initrd-builder",
+                        "initrd_builder.sh",
+                    ),
+                    initrd_builder_path,
+                ),
+                (
+                    join(KATA_SOURCE_DIR, "tools", "osbuilder", "scripts", "lib.sh"),
+                    join(kata_tmp_scripts, "scripts", "lib.sh"),
+                ),
+            ],
+            sudo=True,
+            debug=debug,
+        )
 
     # Include any extra files that the caller may have provided
-    if extra_files is not None:
-        for host_path in extra_files:
+    with span("copy-extra-files", num_files=len(INITRD_EXTRA_FILES)):
+        for host_path in INITRD_EXTRA_FILES:
             # Trim any absolute paths expressed as "guest" paths to be able to
             # append the rootfs
-            rel_guest_path = extra_files[host_path]["path"]
+            rel_guest_path = INITRD_EXTRA_FILES[host_path]["path"]
             if rel_guest_path.startswith("/"):
                 rel_guest_path = rel_guest_path[1:]
 
             guest_path = join(workdir, rel_guest_path)
             if not exists(dirname(guest_path)):
-                run(
-                    "sudo mkdir -p {}".format(dirname(guest_path)),
-                    shell=True,
-                    check=True,
+                sudo_mkdir(dirname(guest_path))
+
+            if exists(guest_path) and INITRD_EXTRA_FILES[host_path]["mode"] == "a":
+                with open(host_path, "rb") as fh:
+                    sudo_write_file(guest_path, fh.read(), append=True)
+            else:
+                sudo_copy(host_path, guest_path)
+
+    with span("pack-initrd") as pack_span:
+        work_env = {"AGENT_INIT": "yes"}
+        initrd_pack_cmd = "sudo {} -o {} {}".format(
+            initrd_builder_path,
+            dst_initrd_path,
+            workdir,
+        )
+        out = run(initrd_pack_cmd, shell=True, env=work_env, capture_output=True)
+        assert out.returncode == 0, "Error packing initrd: {}".format(
+            out.stderr.decode("utf-8")
+        )
+        pack_span.set("cmd", initrd_pack_cmd)
+        pack_span.set("bytes", getsize(dst_initrd_path))
+
+
+def build_initrd(
+    dst_initrd_path,
+    agent_ctr_path,
+    debug=False,
+    use_cache=True,
+    reproducible=True,
+    codec="gzip",
+    allowlist_file=None,
+):
+    """
+    Build an initrd with our kata-agent by streaming the base initrd through
+    a cpio rewriter (see tasks.util.cpio), swapping the files in on the fly
+
+    The resulting initrd has the same contents as the one we would get with
+    `build_initrd_legacy`, but we never unpack it to disk, and only need root
+    to install the final image. Unless `use_cache` is unset, we re-use a
+    previously built image if all the inputs are the same (see
+    tasks.util.initrd_cache). If `reproducible` is set, rebuilding the initrd
+    from the same inputs results in the same image (and launch measurement)
+    on any host. We can also pick the compression codec (see
+    tasks.util.cpio.INITRD_CODECS), and only keep the initrd entries that
+    match an allowlist file (e.g. INITRD_ALLOWLIST_FILE) to slim the initrd
+    """
+    tmp_dir = mkdtemp(prefix="sc2-initrd-")
+    try:
+        with span("copy-agent"):
+            agent_host_path = join(tmp_dir, "kata-agent")
+            copy_from_kata_workon_ctr(agent_ctr_path, agent_host_path, debug=debug)
+            with open(agent_host_path, "rb") as fh:
+                agent_file = InitrdFile(
+                    fh.read(), mode=S_IMODE(stat(agent_host_path).st_mode)
                 )
 
-            if exists(guest_path) and extra_files[host_path]["mode"] == "a":
-                run(
-                    'sudo sh -c "cat {} >> {}"'.format(host_path, guest_path),
-                    shell=True,
-                    check=True,
+        files = {
+            "/usr/bin/kata-agent": agent_file,
+            "/sbin/init": agent_file,
+        }
+        for host_path in INITRD_EXTRA_FILES:
+            with open(host_path, "rb") as fh:
+                files[INITRD_EXTRA_FILES[host_path]["path"]] = InitrdFile(
+                    fh.read(),
+                    append=INITRD_EXTRA_FILES[host_path]["mode"] == "a",
+                    mode=S_IMODE(stat(host_path).st_mode),
                 )
-            else:
-                run(
-                    "sudo cp {} {}".format(host_path, guest_path),
-                    shell=True,
-                    check=True,
+
+        allowlist = None
+        if allowlist_file is not None:
+            allowlist = read_initrd_allowlist(allowlist_file)
+
+        def do_rewrite_initrd(initrd_path):
+            with span(
+                "rewrite-initrd", bytes=getsize(BASE_INITRD_PATH), codec=codec
+            ) as rewrite_span:
+                num_entries = rewrite_initrd(
+                    BASE_INITRD_PATH,
+                    initrd_path,
+                    files,
+                    reproducible=reproducible,
+                    codec=codec,
+                    allowlist=allowlist,
+                )
+                rewrite_span.set("num_entries", num_entries)
+                rewrite_span.set("out_bytes", getsize(initrd_path))
+
+        if use_cache:
+            with span("lookup-initrd-cache") as cache_span:
+                fingerprint = get_initrd_fingerprint(
+                    BASE_INITRD_PATH,
+                    files,
+                    build_args=[
+                        f"reproducible={reproducible}",
+                        f"codec={codec}",
+                        f"allowlist={allowlist}",
+                    ],
                 )
+                initrd_path, cache_hit = get_cached_initrd(
+                    fingerprint, do_rewrite_initrd
+                )
+                cache_span.set("hit", cache_hit)
+            if debug:
+                print(
+                    "Initrd cache {} for fingerprint {}".format(
+                        "hit" if cache_hit else "miss", fingerprint
+                    )
+                )
+        else:
+            initrd_path = join(tmp_dir, basename(dst_initrd_path))
+            do_rewrite_initrd(initrd_path)
 
-    # Pack the initrd again (copy the script from the container into a
-    # temporarly location). Annoyingly, we also need to copy a bash script in
-    # the same relative directory structure (cuz bash).
-    kata_tmp_scripts = "/tmp/osbuilder"
-    run(
-        "rm -rf {} && mkdir -p {} {}".format(
-            kata_tmp_scripts,
-            join(kata_tmp_scripts, "scripts"),
-            join(kata_tmp_scripts, "initrd-builder"),
-        ),
-        shell=True,
-        check=True,
-    )
-    ctr_initrd_builder_path = join(
-        KATA_SOURCE_DIR, "tools", "osbuilder", "initrd-builder", "initrd_builder.sh"
-    )
-    ctr_lib_path = join(KATA_SOURCE_DIR, "tools", "osbuilder", "scripts", "lib.sh")
-    initrd_builder_path = join(kata_tmp_scripts, "initrd-builder", "initrd_builder.sh")
-    copy_from_kata_workon_ctr(ctr_initrd_builder_path, initrd_builder_path, debug=debug)
-    copy_from_kata_workon_ctr(
-        ctr_lib_path, join(kata_tmp_scripts, "scripts", "lib.sh"), debug=debug
-    )
-    work_env = {"AGENT_INIT": "yes"}
-    initrd_pack_cmd = "sudo {} -o {} {}".format(
-        initrd_builder_path,
-        dst_initrd_path,
-        workdir,
-    )
-    out = run(initrd_pack_cmd, shell=True, env=work_env, capture_output=True)
-    assert out.returncode == 0, "Error packing initrd: {}".format(
-        out.stderr.decode("utf-8")
-    )
+        with span("install-initrd"):
+            sudo_copy(initrd_path, dst_initrd_path)
+    finally:
+        rmtree(tmp_dir)
 
-    # Lastly, update the Kata config to point to the new initrd
-    target_runtimes = SC2_RUNTIMES if sc2 else KATA_RUNTIMES
-    for runtime in target_runtimes:
-        # QEMU uses an optimized image file (no initrd) so we keep it that way
-        # also, for the time being, the QEMU baseline requires no patches
-        if runtime == "qemu":
-            continue
-
-        conf_file_path = join(KATA_CONFIG_DIR, "configuration-{}.toml".format(runtime))
-        updated_toml_str = """
-        [hypervisor.qemu]
-        initrd = "{new_initrd_path}"
-        """.format(
-            new_initrd_path=dst_initrd_path
+
+def update_kata_config_initrd(initrd_path, sc2=False):
+    """
+    Point the Kata config files of all our runtimes to a new initrd
+    """
+    with span("update-kata-config"):
+        target_runtimes = SC2_RUNTIMES if sc2 else KATA_RUNTIMES
+        with TomlTransaction() as txn:
+            for runtime in target_runtimes:
+                # QEMU uses an optimized image file (no initrd) so we keep it that
+                # way also, for the time being, the QEMU baseline requires no
+                # patches
+                if runtime == "qemu":
+                    continue
+
+                conf_file_path = join(
+                    KATA_CONFIG_DIR, "configuration-{}.toml".format(runtime)
+                )
+                updated_toml_str = """
+                [hypervisor.qemu]
+                initrd = "{new_initrd_path}"
+                """.format(
+                    new_initrd_path=initrd_path
+                )
+                txn.update_toml(conf_file_path, updated_toml_str)
+
+                if runtime == "qemu-coco-dev" or "tdx" in runtime:
+                    txn.remove_entry_from_toml(conf_file_path, "hypervisor.qemu.image")
+
+
+def replace_agent(
+    dst_initrd_path=join(KATA_IMG_DIR, "kata-containers-initrd-confidential-sc2.img"),
+    debug=False,
+    sc2=False,
+    legacy=False,
+    use_cache=True,
+    reproducible=True,
+    codec="gzip",
+    slim=False,
+):
+    """
+    Replace the kata-agent with a custom-built one
+
+    Replacing the kata-agent is a bit fiddly, as the kata-agent binary lives
+    inside the initrd guest image that we load to the VM. The replacement
+    includes the following steps:
+    1. Start from the clean initrd shipped with Kata
+    2. Replace the init process by the new kata agent
+    3. Add the extra files we always include (INITRD_EXTRA_FILES)
+    4. Re-build the initrd
+    5. Update the kata config to point to the new initrd
+
+    By default we do steps 2-4 in one pass over the compressed initrd. Set
+    `legacy` to unpack and re-pack the initrd with Kata's tooling instead
+    (which never uses the initrd cache). Set `slim` to prune the initrd
+    entries that SC2 guests do not use (see INITRD_ALLOWLIST_FILE), and
+    `codec` to pick how we compress the initrd. Neither applies to legacy
+    builds.
+    """
+    agent_ctr_path = get_agent_ctr_path(sc2=sc2)
+    if legacy:
+        build_initrd_legacy(dst_initrd_path, agent_ctr_path, debug=debug)
+    else:
+        build_initrd(
+            dst_initrd_path,
+            agent_ctr_path,
+            debug=debug,
+            use_cache=use_cache,
+            reproducible=reproducible,
+            codec=codec,
+            allowlist_file=INITRD_ALLOWLIST_FILE if slim else None,
         )
-        update_toml(conf_file_path, updated_toml_str)
 
-        if runtime == "qemu-coco-dev" or "tdx" in runtime:
-            remove_entry_from_toml(conf_file_path, "hypervisor.qemu.image")
+    # Lastly, update the Kata config to point to the new initrd
+    update_kata_config_initrd(dst_initrd_path, sc2=sc2)
 
 
 def replace_shim(
@@ -239,28 +441,31 @@ def replace_shim(
 
     To replace the agent, we just need to change the soft-link from the right
     shim to our re-built one
-    """
-    # First, copy the binary from the source tree
-    src_shim_binary = join(
-        KATA_SHIM_SOURCE_DIR if sc2 else KATA_BASELINE_SHIM_SOURCE_DIR,
-        "containerd-shim-kata-v2",
-    )
-    copy_from_kata_workon_ctr(src_shim_binary, dst_shim_binary, sudo=True)
 
-    # Also copy the kata-runtime binary
-    src_runtime_binary = join(
-        KATA_SHIM_SOURCE_DIR if sc2 else KATA_BASELINE_SHIM_SOURCE_DIR,
-        "kata-runtime",
+    Returns the changes to containerd's config file (if any). containerd
+    spawns a new shim process for each pod, so replacing the binaries alone
+    does not require restarting containerd.
+    """
+    # Copy the shim and the kata-runtime binaries from the source tree
+    src_dir = KATA_SHIM_SOURCE_DIR if sc2 else KATA_BASELINE_SHIM_SOURCE_DIR
+    copy_files_from_kata_workon_ctr(
+        [
+            (join(src_dir, "containerd-shim-kata-v2"), dst_shim_binary),
+            (join(src_dir, "kata-runtime"), dst_runtime_binary),
+        ],
+        sudo=True,
     )
-    copy_from_kata_workon_ctr(src_runtime_binary, dst_runtime_binary, sudo=True)
 
     target_runtimes = SC2_RUNTIMES if sc2 else KATA_RUNTIMES
-    for runtime in target_runtimes:
-        updated_toml_str = """
-        [plugins."io.containerd.grpc.v1.cri".containerd.runtimes.kata-{runtime_name}]
-        runtime_type = "io.containerd.kata-{runtime_name}.v2"
-        runtime_path = "{ctrd_path}"
-        """.format(
-            runtime_name=runtime, ctrd_path=dst_shim_binary
-        )
-        update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+    with TomlTransaction() as txn:
+        for runtime in target_runtimes:
+            updated_toml_str = """
+            [plugins."io.containerd.grpc.v1.cri".containerd.runtimes.kata-{runtime_name}]
+            runtime_type = "io.containerd.kata-{runtime_name}.v2"
+            runtime_path = "{ctrd_path}"
+            """.format(
+                runtime_name=runtime, ctrd_path=dst_shim_binary
+            )
+            txn.update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+
+    return txn.changes.get(CONTAINERD_CONFIG_FILE, [])
@@ -1,13 +1,23 @@
 from base64 import b64encode
-from json import dumps as json_dumps
-from os import makedirs
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from json import dumps as json_dumps, loads as json_loads
+from os import environ, makedirs
 from os.path import join
 from pymysql import connect as mysql_connect
 from pymysql.cursors import DictCursor
+from pymysql.err import IntegrityError, OperationalError
+from sqlite3 import (
+    IntegrityError as SqliteIntegrityError,
+    OperationalError as SqliteOperationalError,
+    Row as SqliteRow,
+    connect as sqlite_connect,
+)
 from subprocess import run
 from tasks.util.cosign import COSIGN_PUB_KEY
-from tasks.util.env import COMPONENTS_DIR
+from tasks.util.env import COMPONENTS_DIR, SC2_CONFIG_DIR
 from tasks.util.sev import get_launch_digest
+from threading import Lock, local
 
 SIMPLE_KBS_DIR = join(COMPONENTS_DIR, "simple-kbs")
 # WARNING: this resource path depends on the KBS' `server` service working
@@ -16,8 +26,67 @@ SIMPLE_KBS_DIR = join(COMPONENTS_DIR, "simple-kbs")
 SIMPLE_KBS_RESOURCE_PATH = join(SIMPLE_KBS_DIR, "resources")
 SIMPLE_KBS_KEYS_RESOURCE_PATH = join(SIMPLE_KBS_RESOURCE_PATH, "keys")
 
+# Set this environment variable to `local` to provision an in-process
+# stand-in for the KBS (see LocalKbsStore) instead of the simple KBS' DB
+KBS_BACKEND_ENV_VAR = "SC2_KBS_BACKEND"
+KBS_BACKEND_SIMPLE_KBS = "simple-kbs"
+KBS_BACKEND_LOCAL = "local"
+LOCAL_KBS_DIR = join(SC2_CONFIG_DIR, "local-kbs")
+LOCAL_KBS_BUSY_TIMEOUT_SECS = 30
+
+# Errors when creating a resource or a secret that already exists
+KBS_INTEGRITY_ERRORS = (IntegrityError, SqliteIntegrityError)
+
+# Schema of the simple KBS' DB (MySQL), translated to SQLite
+LOCAL_KBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS policy (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    allowed_digests TEXT,
+    allowed_policies TEXT,
+    min_fw_api_major INTEGER,
+    min_fw_api_minor INTEGER,
+    allowed_build_ids TEXT,
+    create_date DATETIME,
+    delete_date DATETIME,
+    valid INTEGER
+);
+CREATE TABLE IF NOT EXISTS resources (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    resource_type TEXT,
+    resource_id TEXT UNIQUE,
+    resource_path TEXT,
+    polid INTEGER
+);
+CREATE TABLE IF NOT EXISTS secrets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    secret_id TEXT UNIQUE,
+    secret TEXT,
+    polid INTEGER
+);
+CREATE TABLE IF NOT EXISTS keysets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    keysetid TEXT UNIQUE,
+    kskeys TEXT,
+    polid INTEGER
+);
+"""
+
 DEFAULT_LAUNCH_POLICY_ID = 10
 
+# A KBS resource lives in a file (relative to SIMPLE_KBS_RESOURCE_PATH), and a
+# KBS secret lives in the DB. Both are only released to guests whose launch
+# measurement is allowed by the launch policy
+KbsResource = namedtuple(
+    "KbsResource",
+    ["id", "kbs_path", "contents", "launch_policy_id"],
+    defaults=[DEFAULT_LAUNCH_POLICY_ID],
+)
+KbsSecret = namedtuple(
+    "KbsSecret",
+    ["id", "contents", "launch_policy_id"],
+    defaults=[DEFAULT_LAUNCH_POLICY_ID],
+)
+
 # --------
 # Signature Verification Policy
 # --------
@@ -54,12 +123,13 @@ def get_kbs_db_ip():
     return db_ip
 
 
-def connect_to_kbs_db():
+def connect_to_kbs_db(db_ip=None):
     """
     Get a working MySQL connection to the KBS DB
     """
     # Get the database IP
-    db_ip = get_kbs_db_ip()
+    if db_ip is None:
+        db_ip = get_kbs_db_ip()
 
     # Connect to the database
     connection = mysql_connect(
@@ -73,38 +143,255 @@ def connect_to_kbs_db():
     return connection
 
 
-def clear_kbs_db(skip_secrets=False):
+class KbsStore:
     """
-    Clear the contents of the KBS DB
+    Access layer to the KBS DB (and the resources directory)
+
+    We cache the DB's endpoint (finding it requires inspecting the docker
+    network) and hold one connection open for all operations. If an
+    operation fails with a connection error (e.g. after restarting the KBS),
+    we drop both, and look them up again on the next operation.
+
+    All the bulk methods run in a single transaction, with one parameterized
+    `executemany` statement per table.
     """
-    connection = connect_to_kbs_db()
-    with connection:
-        with connection.cursor() as cursor:
-            cursor.execute("DELETE from policy")
-            cursor.execute("DELETE from resources")
+
+    # Errors after which we must re-connect to the DB
+    CONNECTION_ERRORS = (OperationalError,)
+    # Placeholder for query parameters. We write all queries with `%s`
+    PARAM_PLACEHOLDER = "%s"
+
+    def __init__(self, resource_path=SIMPLE_KBS_RESOURCE_PATH):
+        self.resource_path = resource_path
+        self.db_ip = None
+        self.connection = None
+        self.lock = Lock()
+
+    def get_connection(self):
+        if self.db_ip is None:
+            self.db_ip = get_kbs_db_ip()
+
+        if self.connection is None or not self.connection.open:
+            self.connection = connect_to_kbs_db(db_ip=self.db_ip)
+
+        return self.connection
+
+    def invalidate(self):
+        if self.connection is not None and self.connection.open:
+            self.connection.close()
+
+        self.connection = None
+        self.db_ip = None
+
+    def sql(self, query):
+        return query.replace("%s", self.PARAM_PLACEHOLDER)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block of statements in one transaction, and yield a cursor
+        """
+        with self.lock:
+            connection = None
+            try:
+                connection = self.get_connection()
+                cursor = connection.cursor()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+                connection.commit()
+            except self.CONNECTION_ERRORS as e:
+                self.invalidate()
+                raise e
+            except Exception as e:
+                # We may not have managed to get a connection at all
+                if connection is not None:
+                    connection.rollback()
+                raise e
+
+    def clear(self, skip_secrets=False):
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM policy")
+            cursor.execute("DELETE FROM resources")
             if not skip_secrets:
-                cursor.execute("DELETE from secrets")
+                cursor.execute("DELETE FROM secrets")
+
+    def set_launch_policy(self, policy_id, launch_digests):
+        """
+        Replace a launch policy with one that allows any of the given launch
+        digests
+        """
+        ld_b64s = [b64encode(ld).decode() for ld in launch_digests]
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("DELETE FROM policy WHERE id = %s"), (policy_id,))
+            cursor.execute(
+                self.sql(
+                    "INSERT INTO policy VALUES "
+                    "(%s, %s, '[]', 0, 0, '[]', CURRENT_TIMESTAMP, NULL, 1)"
+                ),
+                (policy_id, json_dumps(ld_b64s)),
+            )
+
+    def create_resources(self, resources):
+        """
+        Create many KBS resources, given as a list of KbsResource
+        """
+        # First, dump the resource contents in their resource paths, so that
+        # the KBS never sees a resource without contents
+        makedirs(self.resource_path, exist_ok=True)
+        for resource in resources:
+            with open(join(self.resource_path, resource.kbs_path), "w") as fh:
+                fh.write(resource.contents)
+
+        with self.transaction() as cursor:
+            cursor.executemany(
+                self.sql("INSERT INTO resources VALUES (NULL, NULL, %s, %s, %s)"),
+                [(r.id, r.kbs_path, r.launch_policy_id) for r in resources],
+            )
 
-        connection.commit()
+    def create_secrets(self, secrets):
+        """
+        Create many KBS secrets, given as a list of KbsSecret
+        """
+        with self.transaction() as cursor:
+            cursor.executemany(
+                self.sql("INSERT INTO secrets VALUES (NULL, %s, %s, %s)"),
+                [(s.id, s.contents, s.launch_policy_id) for s in secrets],
+            )
+
+    def is_launch_digest_allowed(self, row, launch_digest):
+        return b64encode(launch_digest).decode() in json_loads(row["allowed_digests"])
+
+    def get_resource(self, resource_id, launch_digest):
+        """
+        Look-up a resource like the KBS does when a guest requests it: return
+        its contents if the guest's launch digest is allowed by the
+        resource's launch policy, or `None` otherwise
+        """
+        with self.transaction() as cursor:
+            cursor.execute(
+                self.sql(
+                    "SELECT resources.resource_path, policy.allowed_digests "
+                    "FROM resources JOIN policy ON resources.polid = policy.id "
+                    "WHERE resources.resource_id = %s AND policy.valid = 1"
+                ),
+                (resource_id,),
+            )
+            row = cursor.fetchone()
+
+        if row is None or not self.is_launch_digest_allowed(row, launch_digest):
+            return None
+
+        with open(join(self.resource_path, row["resource_path"]), "r") as fh:
+            return fh.read()
+
+    def get_secret(self, secret_id, launch_digest):
+        """
+        Look-up a secret like the KBS does when a guest requests it
+        """
+        with self.transaction() as cursor:
+            cursor.execute(
+                self.sql(
+                    "SELECT secrets.secret, policy.allowed_digests "
+                    "FROM secrets JOIN policy ON secrets.polid = policy.id "
+                    "WHERE secrets.secret_id = %s AND policy.valid = 1"
+                ),
+                (secret_id,),
+            )
+            row = cursor.fetchone()
 
+        if row is None or not self.is_launch_digest_allowed(row, launch_digest):
+            return None
 
-def set_launch_measurement_policy():
+        return row["secret"]
+
+
+class LocalKbsStore(KbsStore):
     """
-    This method configures and sets the launch measurement policy
+    In-process stand-in for the simple KBS, backed by SQLite
+
+    It implements the same DB schema as the simple KBS (or, at least, the
+    tables and columns we use), and the same layout of resources in a
+    `resources` directory. We use it to provision and look-up resources
+    without running the KBS in docker (e.g. to benchmark our provisioning
+    path). Each thread gets its own connection, so that look-ups can run
+    concurrently.
     """
-    # Get the launch measurement
-    ld = get_launch_digest("sev")
-    ld_b64 = b64encode(ld).decode()
 
-    # Create a policy associated to this measurement in the KBS DB
-    connection = connect_to_kbs_db()
-    with connection:
-        with connection.cursor() as cursor:
-            sql = "INSERT INTO policy VALUES ({}, ".format(DEFAULT_LAUNCH_POLICY_ID)
-            sql += "'[\"{}\"]', '[]', 0, 0, '[]', now(), NULL, 1)".format(ld_b64)
-            cursor.execute(sql)
+    CONNECTION_ERRORS = (SqliteOperationalError,)
+    PARAM_PLACEHOLDER = "?"
+
+    def __init__(self, kbs_dir=LOCAL_KBS_DIR):
+        super().__init__(resource_path=join(kbs_dir, "resources"))
+        self.db_path = join(kbs_dir, "simple_kbs.db")
+        self.local = local()
+        self.lock = nullcontext()
+
+        makedirs(kbs_dir, exist_ok=True)
+        connection = sqlite_connect(self.db_path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(LOCAL_KBS_SCHEMA)
+        connection.close()
+
+    def get_connection(self):
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = sqlite_connect(
+                self.db_path, timeout=LOCAL_KBS_BUSY_TIMEOUT_SECS
+            )
+            self.local.connection.row_factory = SqliteRow
+
+        return self.local.connection
+
+    def invalidate(self):
+        if getattr(self.local, "connection", None) is not None:
+            self.local.connection.close()
+
+        self.local.connection = None
 
-        connection.commit()
+
+KBS_STORE = None
+KBS_STORE_LOCK = Lock()
+
+
+def is_local_kbs():
+    return environ.get(KBS_BACKEND_ENV_VAR, KBS_BACKEND_SIMPLE_KBS) == KBS_BACKEND_LOCAL
+
+
+def get_kbs_store():
+    """
+    Get the session-wide KBS store (for the backend in SC2_KBS_BACKEND)
+    """
+    global KBS_STORE
+
+    with KBS_STORE_LOCK:
+        if KBS_STORE is None:
+            KBS_STORE = LocalKbsStore() if is_local_kbs() else KbsStore()
+
+    return KBS_STORE
+
+
+def clear_kbs_db(skip_secrets=False):
+    """
+    Clear the contents of the KBS DB
+    """
+    get_kbs_store().clear(skip_secrets=skip_secrets)
+
+
+def set_launch_measurement_policy(launch_digests=None):
+    """
+    This method configures and sets the launch measurement policy
+
+    The policy allows any of the given launch digests (by default, only the
+    digest for the current node's SEV runtime). We replace any previous
+    policy in a single transaction, so that there is never a window in which
+    the KBS has no launch policy
+    """
+    if launch_digests is None:
+        launch_digests = [get_launch_digest("sev")]
+
+    # Create a policy associated to these measurements in the KBS DB
+    get_kbs_store().set_launch_policy(DEFAULT_LAUNCH_POLICY_ID, launch_digests)
 
 
 def create_kbs_resource(
@@ -125,24 +412,26 @@ def create_kbs_resource(
     directory** from which we call the KBS binary. This value can be checked
     in the simple KBS' docker-compose.yml file. The `resource_path` argument is
     a relative directory from the base `resources` directory.
-    """
-    makedirs(SIMPLE_KBS_RESOURCE_PATH, exist_ok=True)
 
-    # First, insert the resource in the SQL database
-    connection = connect_to_kbs_db()
-    with connection:
-        with connection.cursor() as cursor:
-            sql = "INSERT INTO resources VALUES(NULL, NULL, "
-            sql += "'{}', '{}', {})".format(
-                resource_id, resource_kbs_path, resource_launch_policy_id
+    To create many resources at once, use `create_kbs_resources`.
+    """
+    create_kbs_resources(
+        [
+            KbsResource(
+                resource_id,
+                resource_kbs_path,
+                resource_contents,
+                resource_launch_policy_id,
             )
-            cursor.execute(sql)
+        ]
+    )
 
-        connection.commit()
 
-    # Second, dump the resource contents in the specified resource path
-    with open(join(SIMPLE_KBS_RESOURCE_PATH, resource_kbs_path), "w") as fh:
-        fh.write(resource_contents)
+def create_kbs_resources(resources):
+    """
+    Create a list of KbsResource in one transaction
+    """
+    get_kbs_store().create_resources(resources)
 
 
 def create_kbs_secret(
@@ -151,17 +440,16 @@ def create_kbs_secret(
     """
     Create a KBS secret for the kata-agent to consume
     """
-    # First, insert the resource in the SQL database
-    connection = connect_to_kbs_db()
-    with connection:
-        with connection.cursor() as cursor:
-            sql = "INSERT INTO secrets VALUES(NULL, "
-            sql += "'{}', '{}', {})".format(
-                secret_id, secret_contents, resource_launch_policy_id
-            )
-            cursor.execute(sql)
+    create_kbs_secrets(
+        [KbsSecret(secret_id, secret_contents, resource_launch_policy_id)]
+    )
 
-        connection.commit()
+
+def create_kbs_secrets(secrets):
+    """
+    Create a list of KbsSecret in one transaction
+    """
+    get_kbs_store().create_secrets(secrets)
 
 
 def validate_signature_verification_policy(signature_policy):
@@ -197,7 +485,10 @@ def populate_signature_verification_policy(signature_policy, policy_details=None
 
 
 def provision_launch_digest(
-    images_to_sign, signature_policy=SIGNATURE_POLICY_NONE, clean=False
+    images_to_sign,
+    signature_policy=SIGNATURE_POLICY_NONE,
+    clean=False,
+    launch_digests=None,
 ):
     """
     For details on this method check the main entrypoint task with the same
@@ -210,9 +501,10 @@ def provision_launch_digest(
 
     # First, we provision a launch digest policy that only allows to
     # boot confidential VMs with the launch measurement that we have
-    # just calculated. We will associate signature verification and
-    # image encryption policies to this launch digest policy.
-    set_launch_measurement_policy()
+    # just calculated (or with any of the digests we are given). We will
+    # associate signature verification and image encryption policies to this
+    # launch digest policy.
+    set_launch_measurement_policy(launch_digests)
 
     # To make sure the launch policy is enforced, we must enable
     # signature verification. This means that we also need to provide a
@@ -221,6 +513,7 @@ def provision_launch_digest(
     # which points to a config file that specifies how to validate
     # signatures
     resource_path = "signature_policy_{}.json".format(signature_policy)
+    resources = []
 
     if signature_policy == SIGNATURE_POLICY_NONE:
         # If we set a `none` signature policy, it means that we don't
@@ -245,9 +538,14 @@ def provision_launch_digest(
 
         # Create a resource for the signing key
         with open(COSIGN_PUB_KEY) as fh:
-            create_kbs_resource(signing_key_resource_id, "cosign.pub", fh.read())
+            resources.append(
+                KbsResource(signing_key_resource_id, "cosign.pub", fh.read())
+            )
 
     # Finally, create a resource for the image signing policy. Note that the
     # resource ID for the image signing policy is hardcoded in the kata agent
     # (particularly in the attestation agent)
-    create_kbs_resource(SIGNATURE_POLICY_STRING_ID, resource_path, policy_json_str)
+    resources.append(
+        KbsResource(SIGNATURE_POLICY_STRING_ID, resource_path, policy_json_str)
+    )
+    create_kbs_resources(resources)
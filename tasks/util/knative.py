@@ -4,7 +4,12 @@ from subprocess import run
 from tasks.util.env import CONF_FILES_DIR, LOCAL_REGISTRY_URL, TEMPLATED_FILES_DIR
 from tasks.util.k8s import template_k8s_file
 from tasks.util.kubeadm import run_kubectl_command
-from tasks.util.registry import K8S_SECRET_NAME
+from tasks.util.registry import (
+    K8S_SECRET_NAME,
+    get_client_for_registry,
+    mirror_images,
+)
+from tasks.util.registry_api import RegistryApiError, parse_image_tag
 from time import sleep
 
 # Knative Serving Side-Car Tag
@@ -17,15 +22,6 @@ KNATIVE_SIDECAR_IMAGE_TAG += (
 def replace_sidecar(
     reset_default=False, image_repo=LOCAL_REGISTRY_URL, quiet=False, skip_push=False
 ):
-    def do_run(cmd, quiet):
-        if quiet:
-            out = run(cmd, shell=True, capture_output=True)
-            assert out.returncode == 0, "Error running cmd: {} (error: {})".format(
-                cmd, out.stderr
-            )
-        else:
-            out = run(cmd, shell=True, check=True)
-
     k8s_filename = "knative_replace_sidecar.yaml"
 
     if reset_default:
@@ -39,42 +35,31 @@ def replace_sidecar(
         run_kubectl_command("apply -f {}".format(out_k8s_file), capture_output=quiet)
         return
 
-    # Pull the right Knative Serving side-car image tag
-    docker_cmd = "docker pull {}".format(KNATIVE_SIDECAR_IMAGE_TAG)
-    do_run(docker_cmd, quiet)
-
-    # Re-tag it, and push it to our controlled registry
+    # Mirror the Knative Serving side-car image to our controlled registry
     image_name = "system/knative-sidecar"
     image_tag = "unencrypted"
     new_image_url = "{}/{}:{}".format(image_repo, image_name, image_tag)
-    docker_cmd = "docker tag {} {}".format(KNATIVE_SIDECAR_IMAGE_TAG, new_image_url)
-    do_run(docker_cmd, quiet)
-
-    if not skip_push:
-        docker_cmd = "docker push {}".format(new_image_url)
-
+    if skip_push:
+        _, repository, reference = parse_image_tag(new_image_url)
+        image_digest = get_client_for_registry(image_repo).get_manifest(
+            repository, reference
+        )[2]
+    else:
         # Retry a few times, as the registry may be booting up
         num_retries = 3
         for i in range(num_retries):
             try:
-                do_run(docker_cmd, quiet)
+                image_digest = mirror_images(
+                    [(KNATIVE_SIDECAR_IMAGE_TAG, new_image_url)]
+                )[new_image_url].digest
                 break
-            except AssertionError:
-                sleep(3)
+            except (RegistryApiError, OSError) as e:
+                # Error if we have not managed to break
+                if i == num_retries - 1:
+                    print(f"ERROR: mirroring {KNATIVE_SIDECAR_IMAGE_TAG}: {e}")
+                    raise RuntimeError("Error pushing image to registry")
 
-            # Error if we have not managed to break
-            if i == num_retries - 1:
-                raise RuntimeError("Error pushing image to registry")
-
-    # Get the digest for the recently pulled image, and use it to update
-    # Knative's deployment configmap
-    docker_cmd = 'docker images {} --digests --format "{{{{.Digest}}}}"'.format(
-        join(image_repo, image_name),
-    )
-    image_digest = (
-        run(docker_cmd, shell=True, capture_output=True).stdout.decode("utf-8").strip()
-    )
-    assert len(image_digest) > 0
+                sleep(3)
 
     if not exists(TEMPLATED_FILES_DIR):
         makedirs(TEMPLATED_FILES_DIR)
@@ -98,13 +83,6 @@ def replace_sidecar(
     if not quiet:
         print(result.stdout.decode("utf-8").strip())
 
-    # Finally, make sure to remove all pulled container images to avoid
-    # unintended caching issues with CoCo
-    docker_cmd = "docker rmi {}".format(KNATIVE_SIDECAR_IMAGE_TAG)
-    do_run(docker_cmd, quiet)
-    docker_cmd = "docker rmi {}".format(new_image_url)
-    do_run(docker_cmd, quiet)
-
 
 def configure_self_signed_certs(
     path_to_certs_dir, secret_name=K8S_SECRET_NAME, debug=False
@@ -1,6 +1,10 @@
+from collections import namedtuple
+from re import fullmatch, split
 from subprocess import run
 from tasks.util.env import KUBEADM_KUBECONFIG_FILE
-from time import sleep
+from tasks.util.k8s_api import get_k8s_client, is_pod_ready
+from threading import Condition, Event, Thread
+from time import time
 
 
 def run_kubectl_command(cmd, capture_output=False):
@@ -14,56 +18,215 @@ def run_kubectl_command(cmd, capture_output=False):
     run(k8s_cmd, shell=True, check=True)
 
 
-def wait_for_pods_in_ns(ns=None, expected_num_of_pods=0, label=None, debug=False):
+# A set of pods that we want to wait on, identified by a namespace and a label
+# selector. If the expected number of pods is 0, we wait for all the pods that
+# match to be ready, irrespective of how many there are
+PodReadinessSpec = namedtuple(
+    "PodReadinessSpec", ["namespace", "label", "expected_num_of_pods"]
+)
+
+POD_READINESS_TIMEOUT_SECS = 900
+
+
+# A requirement in a label selector: an operator (`=`, `!=`, `in`, `notin`,
+# `exists`, or `!exists`), a label key, and the set of values it applies to
+LabelRequirement = namedtuple("LabelRequirement", ["op", "key", "values"])
+
+LABEL_KEY_REGEX = r"[A-Za-z0-9][-A-Za-z0-9_./]*"
+
+
+def parse_label_selector(label_selector):
     """
-    Wait for pods in a namespace to be ready
+    Parse a label selector into a list of LabelRequirement. We support both
+    equality-based (e.g. `app=foo`, `app!=bar`) and set-based (e.g.
+    `env in (a,b)`, `tier`, `!tier`) requirements, and raise a ValueError for
+    any other syntax
     """
-    while True:
-        if debug:
-            print(
-                f"Waiting for {expected_num_of_pods} pods to be ready in ns: "
-                f"{ns} (label: {label})"
-            )
-
-        cmd = [
-            "-n {}".format(ns) if ns else "",
-            "get pods",
-            "-l {}".format(label) if label else "",
-            "-o jsonpath='{..status.conditions[?(@.type==\"Ready\")].status}'",
-        ]
-
-        output = run_kubectl_command(
-            " ".join(cmd),
-            capture_output=True,
+    if not label_selector:
+        return []
+
+    requirements = []
+    # Commas separate requirements, except inside the value set of `in`
+    for requirement in split(r",(?![^()]*\))", label_selector):
+        requirement = requirement.strip()
+        set_match = fullmatch(
+            rf"({LABEL_KEY_REGEX})\s+(in|notin)\s+\(([^()]*)\)", requirement
         )
+        eq_match = fullmatch(rf"({LABEL_KEY_REGEX})\s*(!=|==|=)\s*(\S*)", requirement)
+        if set_match:
+            key, op, values = set_match.groups()
+            values = set([v.strip() for v in values.split(",")])
+            requirements.append(LabelRequirement(op, key, values))
+        elif eq_match:
+            key, op, value = eq_match.groups()
+            op = "!=" if op == "!=" else "="
+            requirements.append(LabelRequirement(op, key, set([value])))
+        elif fullmatch(rf"!\s*{LABEL_KEY_REGEX}", requirement):
+            key = requirement[1:].strip()
+            requirements.append(LabelRequirement("!exists", key, set()))
+        elif fullmatch(LABEL_KEY_REGEX, requirement):
+            requirements.append(LabelRequirement("exists", requirement, set()))
+        else:
+            raise ValueError(f"Unsupported label selector: {label_selector}")
+
+    return requirements
+
+
+def matches_label_selector(pod, label_selector):
+    """
+    Check if a pod matches a label selector (see `parse_label_selector`)
+    """
+    labels = pod["metadata"].get("labels", {})
+    for requirement in parse_label_selector(label_selector):
+        value = labels.get(requirement.key)
+        if requirement.op == "exists":
+            matches = requirement.key in labels
+        elif requirement.op == "!exists":
+            matches = requirement.key not in labels
+        elif requirement.op in ["=", "in"]:
+            matches = value in requirement.values
+        else:
+            # As in K8s, `!=` and `notin` also match pods without the label
+            matches = value not in requirement.values
+
+        if not matches:
+            return False
+
+    return True
+
+
+def wait_for_pods(pod_specs, timeout_secs=POD_READINESS_TIMEOUT_SECS, debug=False):
+    """
+    Wait for all the pods in a list of PodReadinessSpec to be ready
 
-        statuses = [o.strip() for o in output.split(" ") if o.strip()]
-        if expected_num_of_pods > 0 and len(statuses) != expected_num_of_pods:
-            if debug:
-                print(
-                    "Expecting {} pods, have {}".format(
-                        expected_num_of_pods, len(statuses)
-                    )
+    Instead of polling each spec in turn, we open one watch stream per
+    namespace, keep an up-to-date view of the pods in it, and re-evaluate all
+    the specs on every event. This means that we return as soon as the last
+    spec is satisfied, and that we wait on independent components
+    concurrently. The timeout applies to the whole barrier.
+    """
+    client = get_k8s_client()
+    pod_specs = [
+        PodReadinessSpec(
+            spec.namespace or "default", spec.label, spec.expected_num_of_pods
+        )
+        for spec in pod_specs
+    ]
+    namespaces = set([spec.namespace for spec in pod_specs])
+
+    # Fail early on label selectors we can not evaluate, rather than time out
+    for spec in pod_specs:
+        parse_label_selector(spec.label)
+
+    cv = Condition()
+    pods_in_ns = {ns: {} for ns in namespaces}
+    errors = []
+    done = Event()
+
+    def watch_ns(ns):
+        try:
+            while not done.is_set():
+                # (Re-)list the pods in the namespace, and watch for changes
+                # from there. We re-list whenever the watch stream expires, or
+                # the server tells us that our resource version is too old
+                pods, resource_version = client.list_with_resource_version(
+                    "pods", namespace=ns
                 )
-        elif all([s == "True" for s in statuses]):
-            if debug:
-                print("All pods ready, continuing...")
+                with cv:
+                    pods_in_ns[ns] = {p["metadata"]["uid"]: p for p in pods}
+                    cv.notify_all()
+
+                for event in client.watch(
+                    "pods", namespace=ns, resource_version=resource_version
+                ):
+                    if done.is_set() or event["type"] == "ERROR":
+                        break
+
+                    pod = event["object"]
+                    with cv:
+                        if event["type"] == "DELETED":
+                            pods_in_ns[ns].pop(pod["metadata"]["uid"], None)
+                        else:
+                            pods_in_ns[ns][pod["metadata"]["uid"]] = pod
+                        cv.notify_all()
+        except Exception as e:
+            with cv:
+                errors.append(e)
+                cv.notify_all()
+
+    def is_spec_ready(spec):
+        pods = [
+            pod
+            for pod in pods_in_ns[spec.namespace].values()
+            if matches_label_selector(pod, spec.label)
+        ]
+        if spec.expected_num_of_pods > 0 and len(pods) != spec.expected_num_of_pods:
+            return False
+
+        return all([is_pod_ready(pod) for pod in pods])
+
+    for ns in namespaces:
+        Thread(target=watch_ns, args=(ns,), daemon=True).start()
+
+    deadline = time() + timeout_secs
+    pending_specs = None
+    try:
+        with cv:
+            while True:
+                if len(errors) > 0:
+                    raise errors[0]
 
-            break
+                new_pending_specs = [s for s in pod_specs if not is_spec_ready(s)]
+                if len(new_pending_specs) == 0:
+                    break
 
-        if debug:
-            print("Pods not ready, waiting ({})".format(output))
+                if debug and new_pending_specs != pending_specs:
+                    for spec in new_pending_specs:
+                        print(
+                            f"Waiting for {spec.expected_num_of_pods} pods to be "
+                            f"ready in ns: {spec.namespace} (label: {spec.label})"
+                        )
+                pending_specs = new_pending_specs
 
-        sleep(5)
+                remaining_secs = deadline - time()
+                if remaining_secs <= 0:
+                    print(f"ERROR: timed-out waiting for pods: {pending_specs}")
+                    raise RuntimeError("Timed-out waiting for pods to be ready!")
+
+                cv.wait(timeout=remaining_secs)
+    finally:
+        done.set()
+
+    if debug:
+        print("All pods ready, continuing...")
+
+
+def wait_for_pods_in_ns(ns=None, expected_num_of_pods=0, label=None, debug=False):
+    """
+    Wait for pods in a namespace to be ready
+
+    To wait on more than one set of pods, prefer `wait_for_pods`
+    """
+    wait_for_pods(
+        [PodReadinessSpec(ns, label, expected_num_of_pods)],
+        debug=debug,
+    )
 
 
 def get_pod_names_in_ns(ns):
-    kubectl_cmd = "get pods -n {} -o jsonpath='{{..metadata.name}}'".format(ns)
-    pods = run_kubectl_command(kubectl_cmd, capture_output=True).split(" ")
-    return [p for p in pods if len(p) > 0]
+    pods = get_k8s_client().list("pods", namespace=ns)
+    return [pod["metadata"]["name"] for pod in pods]
 
 
 def get_node_name():
-    cmd = "get nodes -o jsonpath="
-    cmd += "'{.items..status..addresses[?(@.type==\"Hostname\")].address}'"
-    return run_kubectl_command(cmd, capture_output=True)
+    hostnames = [
+        address["address"]
+        for node in get_k8s_client().list("nodes")
+        for address in node["status"]["addresses"]
+        if address["type"] == "Hostname"
+    ]
+    return " ".join(hostnames)
+
+
+def get_runtime_class_handlers():
+    return [rc["handler"] for rc in get_k8s_client().list("runtimeclasses")]
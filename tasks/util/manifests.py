@@ -0,0 +1,138 @@
+from hashlib import sha256
+from json import dumps as json_dumps, load as json_load
+from os import environ, fdopen, makedirs, replace
+from os.path import exists, join
+from subprocess import run
+from tasks.util.env import MANIFESTS_CACHE_DIR
+from tasks.util.trace import span
+from tempfile import mkstemp
+from threading import Lock
+from time import sleep
+from urllib.request import urlopen
+
+# We apply many K8s manifests straight from GitHub releases (Knative, Calico,
+# MetalLB, the CoCo operator, ...). Instead of fetching them every time, we
+# keep a content-addressed cache of manifests under the project directory:
+# each source (i.e. a versioned URL, or a rendered kustomization) maps to the
+# SHA256 of its contents in an index file, and the contents live in a file
+# named after the digest. A pre-populated cache (see `inv manifests.prefetch`)
+# allows deploying SC2 fully offline.
+MANIFESTS_INDEX_FILE = join(MANIFESTS_CACHE_DIR, "index.json")
+MANIFESTS_BLOBS_DIR = join(MANIFESTS_CACHE_DIR, "sha256")
+
+# Set this environment variable to `on` to never hit the network, and fail if
+# a manifest is not in the cache
+MANIFESTS_OFFLINE_ENV_VAR = "SC2_OFFLINE"
+
+MANIFESTS_FETCH_NUM_RETRIES = 3
+MANIFESTS_FETCH_TIMEOUT_SECS = 30
+
+# Kustomize sources are prefixed in the index, to tell them apart from
+# plain URLs
+KUSTOMIZE_SOURCE_PREFIX = "kustomize:"
+
+MANIFESTS_INDEX_LOCK = Lock()
+
+
+def is_offline():
+    return environ.get(MANIFESTS_OFFLINE_ENV_VAR, "off").lower() == "on"
+
+
+def get_blob_path(digest):
+    return join(MANIFESTS_BLOBS_DIR, f"{digest}.yaml")
+
+
+def read_index():
+    if not exists(MANIFESTS_INDEX_FILE):
+        return {}
+
+    with open(MANIFESTS_INDEX_FILE, "r") as fh:
+        return json_load(fh)
+
+
+def write_file_atomically(file_path, contents):
+    tmp_fd, tmp_path = mkstemp(dir=MANIFESTS_CACHE_DIR)
+    with fdopen(tmp_fd, "wb") as fh:
+        fh.write(contents)
+    replace(tmp_path, file_path)
+
+
+def fetch_url(url):
+    with span("fetch-manifest", url=url) as fetch_span:
+        for attempt in range(MANIFESTS_FETCH_NUM_RETRIES):
+            try:
+                with urlopen(url, timeout=MANIFESTS_FETCH_TIMEOUT_SECS) as response:
+                    contents = response.read()
+                    fetch_span.set("bytes", len(contents))
+                    return contents
+            except OSError as e:
+                if attempt == MANIFESTS_FETCH_NUM_RETRIES - 1:
+                    raise e
+
+                print(f"WARNING: error fetching manifest {url} ({e}), retrying...")
+                fetch_span.incr("retries")
+                sleep(2**attempt)
+
+
+def render_kustomization(url):
+    kustomize_cmd = f"kubectl kustomize {url}"
+    with span("render-kustomization", cmd=kustomize_cmd) as render_span:
+        result = run(kustomize_cmd, shell=True, capture_output=True)
+        assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+        render_span.set("bytes", len(result.stdout))
+
+    return result.stdout
+
+
+def get_cached_manifest(source, fetch_fn, refresh=False):
+    """
+    Return the path to the cached manifest for a source, fetching (and
+    caching) its contents with `fetch_fn` on a cache miss
+    """
+    with MANIFESTS_INDEX_LOCK:
+        digest = read_index().get(source)
+    if not refresh and digest is not None and exists(get_blob_path(digest)):
+        return get_blob_path(digest)
+
+    if is_offline():
+        print(f"ERROR: manifest for {source} not in cache and running offline")
+        raise RuntimeError("Manifest not in cache!")
+
+    contents = fetch_fn()
+    digest = sha256(contents).hexdigest()
+
+    makedirs(MANIFESTS_BLOBS_DIR, exist_ok=True)
+    blob_path = get_blob_path(digest)
+    if not exists(blob_path):
+        write_file_atomically(blob_path, contents)
+
+    # Re-read the index under the lock, as other threads may be populating it
+    # concurrently
+    with MANIFESTS_INDEX_LOCK:
+        index = read_index()
+        index[source] = digest
+        write_file_atomically(
+            MANIFESTS_INDEX_FILE,
+            (json_dumps(index, indent=2, sort_keys=True) + "\n").encode("utf-8"),
+        )
+
+    return blob_path
+
+
+def get_manifest(url, refresh=False):
+    """
+    Return the path to a local copy of the manifest at a (versioned) URL
+    """
+    return get_cached_manifest(url, lambda: fetch_url(url), refresh=refresh)
+
+
+def get_kustomize_manifest(url, refresh=False):
+    """
+    Return the path to a local copy of a kustomization (e.g. a GitHub `-k`
+    URL) rendered to a single manifest
+    """
+    return get_cached_manifest(
+        KUSTOMIZE_SOURCE_PREFIX + url,
+        lambda: render_kustomization(url),
+        refresh=refresh,
+    )
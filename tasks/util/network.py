@@ -2,6 +2,7 @@ from os.path import exists, join
 from os import makedirs
 from subprocess import run
 from tasks.util.env import BIN_DIR, GLOBAL_BIN_DIR
+from tasks.util.sudo import sudo_symlink
 
 
 def download_binary(url, binary_name, debug=False):
@@ -20,20 +21,8 @@ def download_binary(url, binary_name, debug=False):
 
 def symlink_global_bin(binary_path, name, debug=False):
     global_path = join(GLOBAL_BIN_DIR, name)
-    if exists(global_path):
-        if debug:
-            print("Removing existing binary at {}".format(global_path))
-        run(
-            "sudo rm -f {}".format(global_path),
-            shell=True,
-            check=True,
-        )
-
     if debug:
+        if exists(global_path):
+            print("Replacing existing binary at {}".format(global_path))
         print("Symlinking {} -> {}".format(global_path, binary_path))
-    run(
-        "sudo ln -sf {} {}".format(binary_path, name),
-        shell=True,
-        check=True,
-        cwd=GLOBAL_BIN_DIR,
-    )
+    sudo_symlink(binary_path, global_path)
@@ -1,6 +1,10 @@
+from os.path import join
+from tasks.util.env import KATA_ROOT
 from tasks.util.pid import get_pid
 from time import sleep
 
+QEMU_STANDALONE_SERIAL_LOG = "/tmp/qemu-serial-direct.log"
+
 
 def get_qemu_pid(poll_period):
     """
@@ -12,3 +16,31 @@ def get_qemu_pid(poll_period):
             return pid
 
         sleep(poll_period)
+
+
+def get_standalone_qemu_cmd(initrd_path, serial_log_path=QEMU_STANDALONE_SERIAL_LOG):
+    """
+    Get the QEMU command line to boot a standalone (non-confidential) VM
+    with a given initrd, logging the serial console to a file
+    """
+    qemu_path = join(KATA_ROOT, "bin", "qemu-system-x86_64-csg")
+    fw_path = join(KATA_ROOT, "share", "ovmf", "OVMF.fd")
+    kernel_path = join(KATA_ROOT, "share", "kata-containers", "vmlinuz-5.19.2-109cc+")
+
+    qemu_cmd = [
+        "sudo",
+        qemu_path,
+        "-machine q35,accel=kvm",
+        "-m 2048M,slots=10,maxmem=257720M",
+        "-kernel {}".format(kernel_path),
+        '-append "console=ttyS0 root=/dev/sda2 debug"',
+        "-initrd {}".format(initrd_path),
+        "-no-user-config",
+        "-nodefaults",
+        "-nographic",
+        "--no-reboot",
+        "-drive if=pflash,format=raw,readonly=on,file={}".format(fw_path),
+        "--serial file:{}".format(serial_log_path),
+    ]
+
+    return " ".join(qemu_cmd)
@@ -1,6 +1,10 @@
-from os import makedirs
-from os.path import exists, join
-from subprocess import CalledProcessError, run
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps as json_dumps, loads as json_loads
+from os import environ, makedirs
+from os.path import dirname, exists, join
+from subprocess import run
+from textwrap import dedent
 from tasks.util.docker import is_ctr_running
 from tasks.util.env import (
     CONF_FILES_DIR,
@@ -8,12 +12,23 @@ from tasks.util.env import (
     CONTAINERD_CONFIG_ROOT,
     K8S_CONFIG_DIR,
     LOCAL_REGISTRY_URL,
+    REGISTRY_MIRRORS_CACHE_DIR,
     get_node_url,
     print_dotted_line,
 )
-from tasks.util.kubeadm import run_kubectl_command
+from tasks.util.k8s_api import K8sApiError, get_k8s_client
+from tasks.util.registry_api import copy_image, get_registry_client, parse_image_tag
+from tasks.util.sudo import (
+    sudo_copy,
+    sudo_mkdir,
+    sudo_read_file,
+    sudo_remove,
+    sudo_write_file,
+)
 from tasks.util.toml import update_toml
+from tasks.util.trace import span
 from tasks.util.versions import REGISTRY_VERSION
+from urllib.request import urlopen
 
 REGISTRY_CERT_FILE = "domain.crt"
 REGISTRY_CTR_NAME = "sc2-registry"
@@ -26,31 +41,42 @@ HOST_CERT_PATH = join(HOST_CERT_DIR, REGISTRY_CERT_FILE)
 HOST_KEY_PATH = join(HOST_CERT_DIR, REGISTRY_KEY_FILE)
 K8S_SECRET_NAME = "sc2-registry-customca"
 
-
-def start(debug=False, clean=False):
-    this_ip = get_node_url()
-    print_dotted_line(
-        "Configuring local docker registry (v{}) at IP: {} (name: {})".format(
-            REGISTRY_VERSION, this_ip, LOCAL_REGISTRY_URL
-        )
-    )
-
-    # ----------
-    # Docker Registry Config
-    # ----------
-
-    if clean and is_ctr_running(REGISTRY_CTR_NAME):
-        if debug:
-            print(f"WARNING: stopping registry container: {REGISTRY_CTR_NAME}")
-
-        result = run(
-            f"docker rm -f {REGISTRY_CTR_NAME}", shell=True, capture_output=True
-        )
-        assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
-        if debug:
-            print(result.stdout.decode("utf-8").strip())
-
-    # Create certificates for registry
+# We only run images for one platform, so we only mirror that platform's image
+# from multi-platform images
+MIRROR_PLATFORM = "linux/amd64"
+MIRROR_NUM_WORKERS = 8
+
+# Pull-through cache registries (i.e. mirrors) for the upstream registries we
+# pull images from. Each mirror is a registry container listening on a local
+# port, that stores the cached images in a persistent directory, and exposes
+# its cache statistics on a separate (debug) port
+RegistryMirror = namedtuple(
+    "RegistryMirror", ["host", "remote_url", "port", "debug_port"]
+)
+REGISTRY_MIRRORS = [
+    RegistryMirror("docker.io", "https://registry-1.docker.io", 5001, 5101),
+    RegistryMirror("ghcr.io", "https://ghcr.io", 5002, 5102),
+    RegistryMirror("gcr.io", "https://gcr.io", 5003, 5103),
+    RegistryMirror("quay.io", "https://quay.io", 5004, 5104),
+]
+REGISTRY_MIRRORS_ENV_VAR = "SC2_REGISTRY_MIRRORS"
+REGISTRY_MIRROR_CTR_PREFIX = "sc2-registry-mirror"
+
+# Docker only supports mirrors for Docker Hub, so it is the only mirror we can
+# configure for the docker daemon (e.g. for `docker pull` or `docker build`)
+DOCKER_DAEMON_CONFIG_FILE = "/etc/docker/daemon.json"
+DOCKER_MIRRORED_REGISTRY = "docker.io"
+
+# Result of mirroring an image: the digest of its manifest in the destination
+# registry, and the number of bytes we had to copy
+MirroredImage = namedtuple("MirroredImage", ["digest", "copied_bytes"])
+
+
+def generate_certs(debug=False):
+    """
+    Generate the self-signed certificate for the local registry, unless it
+    already exists
+    """
     if not exists(HOST_CERT_DIR):
         makedirs(HOST_CERT_DIR)
 
@@ -72,99 +98,355 @@ def start(debug=False, clean=False):
         if debug:
             print(result.stdout.decode("utf-8").strip())
 
-    # Start self-hosted local registry with HTTPS
-    docker_cmd = [
-        "docker run -d",
-        "--restart=always",
-        "--name {}".format(REGISTRY_CTR_NAME),
-        "-v {}:{}".format(HOST_CERT_DIR, GUEST_CERT_DIR),
-        "-e REGISTRY_HTTP_ADDR=0.0.0.0:443",
-        "-e REGISTRY_HTTP_TLS_CERTIFICATE={}".format(
-            join(GUEST_CERT_DIR, REGISTRY_CERT_FILE)
-        ),
-        "-e REGISTRY_HTTP_TLS_KEY={}".format(join(GUEST_CERT_DIR, REGISTRY_KEY_FILE)),
-        "-p 443:443",
-        REGISTRY_IMAGE_TAG,
-    ]
-    docker_cmd = " ".join(docker_cmd)
-    if not is_ctr_running(REGISTRY_CTR_NAME):
-        out = run(docker_cmd, shell=True, capture_output=True)
-        assert out.returncode == 0, "Failed starting docker container: {}".format(
-            out.stderr
-        )
-        if debug:
-            print(out.stdout.decode("utf-8").strip())
+
+def get_local_registry_client():
+    """
+    Get the API client for the local registry, that trusts its self-signed
+    certificate
+    """
+    return get_registry_client(LOCAL_REGISTRY_URL, cafile=HOST_CERT_PATH)
+
+
+def get_client_for_registry(registry):
+    if registry == LOCAL_REGISTRY_URL:
+        return get_local_registry_client()
+
+    return get_registry_client(registry)
+
+
+def get_source_client_for_registry(registry):
+    """
+    Get the client to pull images from a registry, which goes through the
+    registry's mirror, if we have one and mirrors are enabled
+    """
+    mirror = get_registry_mirror(registry)
+    if mirror is not None and is_registry_mirrors_enabled():
+        return get_registry_client("127.0.0.1", port=mirror.port, secure=False)
+
+    return get_client_for_registry(registry)
+
+
+def mirror_images(images, platform=MIRROR_PLATFORM, num_workers=MIRROR_NUM_WORKERS):
+    """
+    Mirror a list of (source, destination) image tags between registries
+
+    Instead of pulling, re-tagging, and pushing each image with docker (which
+    unpacks every layer in docker's storage only to re-upload it), we copy the
+    manifests and blobs directly between registries, preserving their digests.
+    We skip the blobs that the destination already has, and transfer the rest
+    in a pool of workers shared by all images. For private source images, we
+    use the credentials in the docker config (i.e. from `docker login`). If
+    registry mirrors are enabled, we pull the source images through them.
+
+    Returns a dictionary with the MirroredImage for each destination tag.
+    """
+    if len(images) == 0:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=num_workers) as blob_pool, ThreadPoolExecutor(
+        max_workers=len(images)
+    ) as image_pool:
+        futures = {}
+        for src_image_tag, dst_image_tag in images:
+            src_registry, src_repository, src_reference = parse_image_tag(src_image_tag)
+            dst_registry, dst_repository, dst_reference = parse_image_tag(dst_image_tag)
+            futures[dst_image_tag] = image_pool.submit(
+                copy_image,
+                get_source_client_for_registry(src_registry),
+                src_repository,
+                src_reference,
+                get_client_for_registry(dst_registry),
+                dst_repository,
+                dst_reference,
+                blob_pool,
+                platform,
+            )
+
+        return {
+            dst_image_tag: MirroredImage(*future.result())
+            for dst_image_tag, future in futures.items()
+        }
+
+
+def get_containerd_hosts_dir(registry):
+    return join(CONTAINERD_CONFIG_ROOT, "certs.d", registry)
+
+
+def set_containerd_registry_config_path():
+    """
+    Make containerd read the per-registry host configuration in `certs.d`, and
+    return the list of changes to its config file
+    """
+    updated_toml_str = """
+    [plugins."io.containerd.grpc.v1.cri".registry]
+    config_path = "{containerd_base_certs_dir}"
+    """.format(
+        containerd_base_certs_dir=join(CONTAINERD_CONFIG_ROOT, "certs.d")
+    )
+    return update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+
+
+def is_registry_mirrors_enabled():
+    return environ.get(REGISTRY_MIRRORS_ENV_VAR, "off") == "on"
+
+
+def get_registry_mirror(registry):
+    for mirror in REGISTRY_MIRRORS:
+        if mirror.host == registry:
+            return mirror
+
+    return None
+
+
+def get_registry_mirror_ctr_name(mirror):
+    return "{}-{}".format(REGISTRY_MIRROR_CTR_PREFIX, mirror.host.replace(".", "-"))
+
+
+def update_docker_registry_mirrors(mirror_urls):
+    """
+    Set the registry mirrors in the docker daemon's config, and reload the
+    daemon if they changed. Docker reloads its mirrors on SIGHUP, so we do not
+    need to restart it (and the containers it runs)
+    """
+    daemon_config = {}
+    if exists(DOCKER_DAEMON_CONFIG_FILE):
+        daemon_config = json_loads(sudo_read_file(DOCKER_DAEMON_CONFIG_FILE) or "{}")
+
+    if daemon_config.get("registry-mirrors", []) == mirror_urls:
+        return
+
+    if len(mirror_urls) == 0:
+        daemon_config.pop("registry-mirrors", None)
     else:
-        if debug:
-            print("WARNING: skipping starting container as it is already running...")
+        daemon_config["registry-mirrors"] = mirror_urls
 
-    # ----------
-    # DNS Config
-    # ----------
+    sudo_mkdir(dirname(DOCKER_DAEMON_CONFIG_FILE))
+    sudo_write_file(DOCKER_DAEMON_CONFIG_FILE, json_dumps(daemon_config, indent=2))
+    result = run("sudo systemctl reload docker", shell=True, capture_output=True)
+    assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
 
-    # Add DNS entry (careful to be able to sudo-edit the file)
-    dns_file = "/etc/hosts"
-    dns_contents = (
-        run("sudo cat {}".format(dns_file), shell=True, capture_output=True)
-        .stdout.decode("utf-8")
-        .strip()
-        .split("\n")
+
+def start_mirrors(debug=False):
+    """
+    Start a pull-through cache registry for each upstream registry, and
+    configure containerd (and docker, for Docker Hub) to pull through them
+
+    The mirrors keep their cache in a persistent directory, so re-creating the
+    cluster does not re-fetch every image from the upstream registries. We
+    list each mirror in containerd's `hosts.toml` for its upstream registry,
+    so containerd falls back to the upstream registry if the mirror fails.
+    Docker also falls back to Docker Hub if its mirror fails.
+
+    Returns the list of changes to containerd's config file.
+    """
+    print_dotted_line(
+        "Starting {} registry mirrors (v{})".format(
+            len(REGISTRY_MIRRORS), REGISTRY_VERSION
+        )
     )
 
-    # Only write the DNS entry if it is not there yet
-    dns_line = "{} {}".format(this_ip, LOCAL_REGISTRY_URL)
-    must_write = not any([dns_line in line for line in dns_contents])
+    for mirror in REGISTRY_MIRRORS:
+        ctr_name = get_registry_mirror_ctr_name(mirror)
+        if is_ctr_running(ctr_name):
+            if debug:
+                print(f"WARNING: registry mirror {ctr_name} already running...")
+            continue
+
+        cache_dir = join(REGISTRY_MIRRORS_CACHE_DIR, mirror.host)
+        makedirs(cache_dir, exist_ok=True)
+        docker_cmd = [
+            "docker run -d",
+            "--restart=always",
+            "--name {}".format(ctr_name),
+            "-v {}:/var/lib/registry".format(cache_dir),
+            "-e REGISTRY_PROXY_REMOTEURL={}".format(mirror.remote_url),
+            "-e REGISTRY_HTTP_DEBUG_ADDR=0.0.0.0:5001",
+            "-p 127.0.0.1:{}:5000".format(mirror.port),
+            "-p 127.0.0.1:{}:5001".format(mirror.debug_port),
+            REGISTRY_IMAGE_TAG,
+        ]
+        docker_cmd = " ".join(docker_cmd)
+        result = run(docker_cmd, shell=True, capture_output=True)
+        assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+        if debug:
+            print(result.stdout.decode("utf-8").strip())
+
+    containerd_changes = set_containerd_registry_config_path()
+    for mirror in REGISTRY_MIRRORS:
+        containerd_hosts_dir = get_containerd_hosts_dir(mirror.host)
+        sudo_mkdir(containerd_hosts_dir)
+
+        containerd_hosts_file = """
+        server = "{remote_url}"
+
+        [host."http://127.0.0.1:{port}"]
+        capabilities = ["pull", "resolve"]
+        """.format(
+            remote_url=mirror.remote_url, port=mirror.port
+        )
+        sudo_write_file(
+            join(containerd_hosts_dir, "hosts.toml"),
+            dedent(containerd_hosts_file).strip() + "\n",
+        )
 
-    if must_write:
-        actual_dns_line = "\n# CSG: DNS entry for local registry\n{}".format(dns_line)
-        write_cmd = "sudo sh -c \"echo '{}' >> {}\"".format(actual_dns_line, dns_file)
-        run(write_cmd, shell=True, check=True)
+    docker_mirror = get_registry_mirror(DOCKER_MIRRORED_REGISTRY)
+    update_docker_registry_mirrors([f"http://127.0.0.1:{docker_mirror.port}"])
 
-        # If creating a new registry, also update the local SSL certificates
-        system_cert_path = "/usr/share/ca-certificates/sc2_registry.crt"
-        run(
-            "sudo cp {} {}".format(HOST_CERT_PATH, system_cert_path),
+    print("Success!")
+
+    return containerd_changes
+
+
+def stop_mirrors(debug=False):
+    """
+    Stop the registry mirrors, and stop pulling through them. We keep their
+    cached images
+    """
+    update_docker_registry_mirrors([])
+
+    for mirror in REGISTRY_MIRRORS:
+        sudo_remove(get_containerd_hosts_dir(mirror.host), recursive=True)
+
+        result = run(
+            "docker rm -f {}".format(get_registry_mirror_ctr_name(mirror)),
             shell=True,
-            check=True,
+            capture_output=True,
+        )
+        assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+        if debug:
+            print(result.stdout.decode("utf-8").strip())
+
+
+def get_mirror_stats(mirror):
+    """
+    Get the cache statistics of a registry mirror, for blobs and manifests,
+    since the mirror started. Each one has the number of requests, hits, and
+    misses, and the bytes pulled from upstream and pushed to clients
+    """
+    stats_url = "http://127.0.0.1:{}/debug/vars".format(mirror.debug_port)
+    with urlopen(stats_url, timeout=5) as response:
+        debug_vars = json_loads(response.read())
+
+    return debug_vars.get("registry", {}).get("proxy", {})
+
+
+def start(debug=False, clean=False):
+    """
+    Start a local docker registry, and configure the host to trust it
+
+    Returns the list of changes to containerd's config file, so that callers
+    can decide whether they need to restart containerd.
+    """
+    this_ip = get_node_url()
+    print_dotted_line(
+        "Configuring local docker registry (v{}) at IP: {} (name: {})".format(
+            REGISTRY_VERSION, this_ip, LOCAL_REGISTRY_URL
         )
+    )
+
+    # ----------
+    # Docker Registry Config
+    # ----------
+
+    if clean and is_ctr_running(REGISTRY_CTR_NAME):
+        if debug:
+            print(f"WARNING: stopping registry container: {REGISTRY_CTR_NAME}")
+
         result = run(
-            "sudo dpkg-reconfigure ca-certificates", shell=True, capture_output=True
+            f"docker rm -f {REGISTRY_CTR_NAME}", shell=True, capture_output=True
         )
         assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
         if debug:
             print(result.stdout.decode("utf-8").strip())
 
+    # Create certificates for registry
+    with span("registry-certs"):
+        generate_certs(debug=debug)
+
+    # Start self-hosted local registry with HTTPS
+    with span("registry-start-ctr"):
+        docker_cmd = [
+            "docker run -d",
+            "--restart=always",
+            "--name {}".format(REGISTRY_CTR_NAME),
+            "-v {}:{}".format(HOST_CERT_DIR, GUEST_CERT_DIR),
+            "-e REGISTRY_HTTP_ADDR=0.0.0.0:443",
+            "-e REGISTRY_HTTP_TLS_CERTIFICATE={}".format(
+                join(GUEST_CERT_DIR, REGISTRY_CERT_FILE)
+            ),
+            "-e REGISTRY_HTTP_TLS_KEY={}".format(
+                join(GUEST_CERT_DIR, REGISTRY_KEY_FILE)
+            ),
+            # Let us clean-up temporary tags (e.g. when encrypting images)
+            "-e REGISTRY_STORAGE_DELETE_ENABLED=true",
+            "-p 443:443",
+            REGISTRY_IMAGE_TAG,
+        ]
+        docker_cmd = " ".join(docker_cmd)
+        if not is_ctr_running(REGISTRY_CTR_NAME):
+            out = run(docker_cmd, shell=True, capture_output=True)
+            assert out.returncode == 0, "Failed starting docker container: {}".format(
+                out.stderr
+            )
+            if debug:
+                print(out.stdout.decode("utf-8").strip())
+        else:
+            if debug:
+                print(
+                    "WARNING: skipping starting container as it is already running..."
+                )
+
+    # ----------
+    # DNS Config
+    # ----------
+
+    # Add DNS entry (careful to be able to sudo-edit the file)
+    with span("registry-dns"):
+        dns_file = "/etc/hosts"
+        dns_contents = sudo_read_file(dns_file).decode("utf-8").strip().split("\n")
+
+        # Only write the DNS entry if it is not there yet
+        dns_line = "{} {}".format(this_ip, LOCAL_REGISTRY_URL)
+        must_write = not any([dns_line in line for line in dns_contents])
+
+        if must_write:
+            actual_dns_line = "\n# CSG: DNS entry for local registry\n{}\n".format(
+                dns_line
+            )
+            sudo_write_file(dns_file, actual_dns_line, append=True)
+
+            # If creating a new registry, also update the local SSL certificates
+            system_cert_path = "/usr/share/ca-certificates/sc2_registry.crt"
+            sudo_copy(HOST_CERT_PATH, system_cert_path)
+            result = run(
+                "sudo dpkg-reconfigure ca-certificates", shell=True, capture_output=True
+            )
+            assert result.returncode == 0, print(result.stderr.decode("utf-8").strip())
+            if debug:
+                print(result.stdout.decode("utf-8").strip())
+
     # ----------
     # dockerd config
     # ----------
 
     # Configure docker to be able to push to this registry
     docker_certs_dir = join("/etc/docker/certs.d", LOCAL_REGISTRY_URL)
-    run("sudo mkdir -p {}".format(docker_certs_dir), shell=True, check=True)
-
-    docker_ca_cert_file = join(docker_certs_dir, "ca.crt")
-    cp_cmd = "sudo cp {} {}".format(HOST_CERT_PATH, docker_ca_cert_file)
-    run(cp_cmd, shell=True, check=True)
+    sudo_mkdir(docker_certs_dir)
+    sudo_copy(HOST_CERT_PATH, join(docker_certs_dir, "ca.crt"))
 
     # Re-start docker to pick up the new certificates
-    run("sudo service docker restart", shell=True, check=True)
+    with span("registry-restart-docker"):
+        run("sudo service docker restart", shell=True, check=True)
 
     # ----------
     # containerd config
     # ----------
 
-    containerd_base_certs_dir = join(CONTAINERD_CONFIG_ROOT, "certs.d")
-    updated_toml_str = """
-    [plugins."io.containerd.grpc.v1.cri".registry]
-    config_path = "{containerd_base_certs_dir}"
-    """.format(
-        containerd_base_certs_dir=containerd_base_certs_dir
-    )
-    update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+    containerd_changes = set_containerd_registry_config_path()
 
     # Add the correspnding configuration to containerd
-    containerd_certs_dir = join(containerd_base_certs_dir, LOCAL_REGISTRY_URL)
-    run(f"sudo mkdir -p {containerd_certs_dir}", shell=True, check=True)
+    containerd_certs_dir = get_containerd_hosts_dir(LOCAL_REGISTRY_URL)
+    sudo_mkdir(containerd_certs_dir)
 
     containerd_cert_path = join(containerd_certs_dir, "sc2_registry.crt")
     containerd_certs_file = """
@@ -177,18 +459,13 @@ def start(debug=False, clean=False):
         registry_url=LOCAL_REGISTRY_URL, containerd_cert_path=containerd_cert_path
     )
 
-    cmd = """
-    sudo sh -c 'cat <<EOF > {destination_file}
-    {file_contents}
-    EOF'
-    """.format(
-        destination_file=join(containerd_certs_dir, "hosts.toml"),
-        file_contents=containerd_certs_file.strip(),
+    sudo_write_file(
+        join(containerd_certs_dir, "hosts.toml"),
+        dedent(containerd_certs_file).strip() + "\n",
     )
-    run(cmd, shell=True, check=True)
 
     # Copy the certificate to the corresponding containerd directory
-    run(f"sudo cp {HOST_CERT_PATH} {containerd_cert_path}", shell=True, check=True)
+    sudo_copy(HOST_CERT_PATH, containerd_cert_path)
 
     # ----------
     # Kata config
@@ -215,15 +492,18 @@ def start(debug=False, clean=False):
 
     print("Success!")
 
+    # containerd re-reads the per-registry host configuration in `certs.d` on
+    # every pull, so only changes to the main config file require a restart
+    return containerd_changes
+
 
 def stop(debug=False):
     # For Knative, we only need to delete the secret, as the other bit is a
     # patch to the controller deployment that can be applied again
-    kube_cmd = "-n knative-serving delete secret {}".format(K8S_SECRET_NAME)
     try:
-        run_kubectl_command(kube_cmd, capture_output=not debug)
-    except CalledProcessError:
-        print("WARNING: deleting knative-serving secret failed")
+        get_k8s_client().delete("secrets", K8S_SECRET_NAME, namespace="knative-serving")
+    except (K8sApiError, OSError) as e:
+        print("WARNING: deleting knative-serving secret failed: {}".format(e))
 
     # For Kata and containerd, all configuration is reversible, so we only
     # need to sop the container image
@@ -0,0 +1,504 @@
+from contextlib import contextmanager
+from hashlib import sha256
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from json import load as json_load, loads as json_loads
+from os.path import exists, expanduser, join
+from queue import Empty, LifoQueue
+from re import findall, match
+from ssl import create_default_context
+from tasks.util.trace import get_current_span
+from threading import Lock
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urljoin, urlparse
+from urllib.request import Request, urlopen
+
+REGISTRY_API_POOL_SIZE = 8
+REGISTRY_API_TIMEOUT_SECS = 60
+
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+DOCKER_MANIFEST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+DOCKER_MANIFEST_LIST_MEDIA_TYPE = (
+    "application/vnd.docker.distribution.manifest.list.v2+json"
+)
+MANIFEST_MEDIA_TYPES = [
+    OCI_MANIFEST_MEDIA_TYPE,
+    OCI_INDEX_MEDIA_TYPE,
+    DOCKER_MANIFEST_MEDIA_TYPE,
+    DOCKER_MANIFEST_LIST_MEDIA_TYPE,
+]
+INDEX_MEDIA_TYPES = [OCI_INDEX_MEDIA_TYPE, DOCKER_MANIFEST_LIST_MEDIA_TYPE]
+
+# Some registries serve their API from a different host than the one in image
+# tags
+REGISTRY_API_HOSTS = {"docker.io": "registry-1.docker.io"}
+
+# We read the same credentials that `docker login` stores, where Docker Hub's
+# are under its legacy index URL
+DOCKER_CONFIG_FILE = join(expanduser("~"), ".docker", "config.json")
+DOCKER_CONFIG_HOSTS = {"docker.io": "https://index.docker.io/v1/"}
+
+
+class RegistryApiError(RuntimeError):
+    def __init__(self, method, path, status, reason, body):
+        self.status = status
+        super().__init__(
+            f"Registry API error: {method} {path} returned {status} ({reason}): {body}"
+        )
+
+
+def parse_image_tag(image_tag):
+    """
+    Split an image tag in the format <registry>/<repo>/<name>:<tag> (or
+    <registry>/<repo>/<name>@<digest>) into the registry host, the repository,
+    and the reference
+    """
+    registry, repository = image_tag.split("/", 1)
+    if "@" in repository:
+        repository, reference = repository.split("@", 1)
+    elif ":" in repository:
+        repository, reference = repository.rsplit(":", 1)
+    else:
+        reference = "latest"
+
+    return registry, repository, reference
+
+
+def get_location_path(location):
+    """
+    Get the path (and query) of the Location header in an upload response,
+    which may be an absolute URL
+    """
+    location = urlparse(location)
+    return location.path + ("?" + location.query if location.query else "")
+
+
+def get_path_repository(path):
+    """
+    Get the repository that an API path refers to (if any)
+    """
+    path_match = match(r"^/v2/(.+)/(manifests|blobs|tags)/", path)
+    return path_match.group(1) if path_match else None
+
+
+def get_digest(data):
+    return "sha256:{}".format(sha256(data).hexdigest())
+
+
+def get_docker_credentials(host):
+    """
+    Get the (base64-encoded) basic credentials for a registry host from the
+    docker config file, if any. We do not support credential helpers, only
+    the credentials that `docker login` stores in the file itself
+    """
+    if not exists(DOCKER_CONFIG_FILE):
+        return None
+
+    with open(DOCKER_CONFIG_FILE, "r") as fh:
+        auths = json_load(fh).get("auths", {})
+
+    for key in [DOCKER_CONFIG_HOSTS.get(host, host), host, f"https://{host}"]:
+        if auths.get(key, {}).get("auth"):
+            return auths[key]["auth"]
+
+    return None
+
+
+class RegistryClient:
+    """
+    Minimal client for the OCI distribution (i.e. docker registry v2) API
+
+    Like the K8s client, we keep a pool of keep-alive HTTPS connections to the
+    registry. It only covers the manifest and blob operations that we need to
+    re-assemble and copy images, without round-tripping them through docker.
+    For public registries, we get (pull) tokens on demand, using the docker
+    credentials for the registry if we have any, or anonymously otherwise.
+    We only talk plain HTTP to local registries (e.g. the registry mirrors).
+    """
+
+    def __init__(self, host, port=443, cafile=None, secure=True):
+        self.registry = host
+        self.host = REGISTRY_API_HOSTS.get(host, host)
+        self.credentials = get_docker_credentials(host)
+        self.port = port
+        self.secure = secure
+
+        self.ssl_context = None
+        if secure:
+            self.ssl_context = create_default_context()
+            if cafile is not None:
+                self.ssl_context.load_verify_locations(cafile=cafile)
+
+        self.pool = LifoQueue(maxsize=REGISTRY_API_POOL_SIZE)
+
+        # Bearer tokens, per repository
+        self.tokens = {}
+        self.tokens_lock = Lock()
+
+    def new_connection(self):
+        if not self.secure:
+            return HTTPConnection(
+                self.host, self.port, timeout=REGISTRY_API_TIMEOUT_SECS
+            )
+
+        return HTTPSConnection(
+            self.host,
+            self.port,
+            context=self.ssl_context,
+            timeout=REGISTRY_API_TIMEOUT_SECS,
+        )
+
+    def get_connection(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            return self.new_connection()
+
+    def put_connection(self, conn):
+        if self.pool.full():
+            conn.close()
+        else:
+            self.pool.put_nowait(conn)
+
+    def get_auth_headers(self, path):
+        with self.tokens_lock:
+            token = self.tokens.get(get_path_repository(path))
+
+        return {"Authorization": f"Bearer {token}"} if token else {}
+
+    def authenticate(self, path, challenge):
+        """
+        Get a token to access the repository in a path, following the registry's
+        `WWW-Authenticate` challenge
+        """
+        if challenge is None or not challenge.startswith("Bearer "):
+            raise RegistryApiError("GET", path, 401, "unsupported auth", challenge)
+
+        repository = get_path_repository(path)
+        params = dict(findall(r'(\w+)="([^"]*)"', challenge))
+        query = {"scope": params.get("scope", f"repository:{repository}:pull")}
+        if "service" in params:
+            query["service"] = params["service"]
+        token_request = Request("{}?{}".format(params["realm"], urlencode(query)))
+        if self.credentials is not None:
+            token_request.add_header("Authorization", f"Basic {self.credentials}")
+        try:
+            with urlopen(token_request, timeout=REGISTRY_API_TIMEOUT_SECS) as response:
+                token_json = json_loads(response.read())
+        except HTTPError as e:
+            if e.code != 401:
+                raise
+
+            raise RegistryApiError(
+                "GET",
+                path,
+                401,
+                self.get_unauthorized_reason(),
+                e.read().decode("utf-8"),
+            )
+
+        with self.tokens_lock:
+            self.tokens[repository] = token_json.get("token") or token_json.get(
+                "access_token"
+            )
+
+    def request(self, method, path, body=None, headers=None, query=None):
+        """
+        Send a request to the registry, and return the response status, headers,
+        and body. Unlike the K8s client, we let callers handle error statuses, as
+        a 404 is an expected answer to most registry queries
+        """
+        if query:
+            path = "{}?{}".format(path, urlencode(query))
+
+        status, response_headers, data = self.send(method, path, body, headers)
+        if status == 401:
+            self.authenticate(path, response_headers.get("WWW-Authenticate"))
+            status, response_headers, data = self.send(method, path, body, headers)
+
+        # A 401 with a fresh token means that our credentials (if any) do not
+        # grant access to the repository
+        if status == 401:
+            raise RegistryApiError(
+                method, path, 401, self.get_unauthorized_reason(), data.decode("utf-8")
+            )
+
+        return status, response_headers, data
+
+    def get_unauthorized_reason(self):
+        if self.credentials is None:
+            return "no credentials for {} in {}, run `docker login {}`".format(
+                self.registry, DOCKER_CONFIG_FILE, self.registry
+            )
+
+        return "credentials for {} in {} were rejected".format(
+            self.registry, DOCKER_CONFIG_FILE
+        )
+
+    def send(self, method, path, body, headers):
+        headers = dict(self.get_auth_headers(path), **(headers or {}))
+
+        # Retry once with a new connection, as the server may have closed an
+        # idle connection in the pool
+        for attempt in range(2):
+            conn = self.get_connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, HTTPException):
+                conn.close()
+                if attempt == 1:
+                    raise
+
+                current_span = get_current_span()
+                if current_span is not None:
+                    current_span.incr("registry_api_retries")
+        self.put_connection(conn)
+
+        return response.status, response.headers, data
+
+    def get_manifest(self, repository, reference):
+        """
+        Get an image manifest, and return its raw bytes (so that we preserve its
+        digest), its media type, and its digest
+        """
+        path = f"/v2/{repository}/manifests/{reference}"
+        status, headers, data = self.request(
+            "GET", path, headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        )
+        if status != 200:
+            raise RegistryApiError("GET", path, status, "", data.decode("utf-8"))
+
+        return data, headers["Content-Type"], get_digest(data)
+
+    def put_manifest(self, repository, reference, data, media_type):
+        path = f"/v2/{repository}/manifests/{reference}"
+        status, _, body = self.request(
+            "PUT", path, body=data, headers={"Content-Type": media_type}
+        )
+        if status != 201:
+            raise RegistryApiError("PUT", path, status, "", body.decode("utf-8"))
+
+        return get_digest(data)
+
+    def delete_manifest(self, repository, digest):
+        """
+        Delete a manifest (and thus all the tags that point to it), returning
+        whether the registry deleted it. Registries only support deleting
+        manifests by digest, and only if deletes are enabled
+        """
+        path = f"/v2/{repository}/manifests/{digest}"
+        status, _, body = self.request("DELETE", path)
+        if status not in [202, 404, 405]:
+            raise RegistryApiError("DELETE", path, status, "", body.decode("utf-8"))
+
+        return status == 202
+
+    def has_blob(self, repository, digest):
+        path = f"/v2/{repository}/blobs/{digest}"
+        status, _, _ = self.request("HEAD", path)
+        if status not in [200, 404]:
+            raise RegistryApiError("HEAD", path, status, "", "")
+
+        return status == 200
+
+    def mount_blob(self, repository, digest, from_repository):
+        """
+        Mount a blob from another repository in the same registry, returning
+        whether the registry could mount it
+        """
+        path = f"/v2/{repository}/blobs/uploads/"
+        status, headers, _ = self.request(
+            "POST", path, query={"mount": digest, "from": from_repository}
+        )
+        if status == 202:
+            # The registry could not mount the blob, and started a regular
+            # upload instead. Cancel it
+            self.request("DELETE", get_location_path(headers["Location"]))
+
+        return status == 201
+
+    @contextmanager
+    def open_blob(self, repository, digest):
+        """
+        Open a blob for streaming. Blobs are large, so each stream uses its own
+        connection rather than one from the pool
+        """
+        path = f"/v2/{repository}/blobs/{digest}"
+        for attempt in range(2):
+            conn = self.new_connection()
+            conn.request("GET", path, headers=self.get_auth_headers(path))
+            response = conn.getresponse()
+            if response.status != 401 or attempt == 1:
+                break
+
+            response.read()
+            conn.close()
+            self.authenticate(path, response.headers.get("WWW-Authenticate"))
+
+        try:
+            if response.status in [301, 302, 303, 307, 308]:
+                # Public registries serve blobs from a separate storage (e.g. a
+                # CDN), that does not take our registry token
+                location = urljoin(
+                    "{}://{}:{}{}".format(
+                        "https" if self.secure else "http", self.host, self.port, path
+                    ),
+                    response.headers["Location"],
+                )
+                response.read()
+                with urlopen(location, timeout=REGISTRY_API_TIMEOUT_SECS) as stream:
+                    yield stream
+            elif response.status == 200:
+                yield response
+            else:
+                raise RegistryApiError(
+                    "GET", path, response.status, "", response.read().decode("utf-8")
+                )
+        finally:
+            conn.close()
+
+    def upload_blob(self, repository, digest, stream, size):
+        """
+        Upload a blob in one go (i.e. a monolithic upload), streaming its contents
+        from a file-like object
+        """
+        path = f"/v2/{repository}/blobs/uploads/"
+        status, headers, data = self.request("POST", path)
+        if status != 202:
+            raise RegistryApiError("POST", path, status, "", data.decode("utf-8"))
+
+        path = get_location_path(headers["Location"])
+        path += ("&" if "?" in path else "?") + urlencode({"digest": digest})
+        upload_headers = self.get_auth_headers(path)
+        upload_headers["Content-Length"] = str(size)
+        upload_headers["Content-Type"] = "application/octet-stream"
+
+        conn = self.new_connection()
+        try:
+            conn.request("PUT", path, body=stream, headers=upload_headers)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+
+        if response.status != 201:
+            raise RegistryApiError(
+                "PUT", path, response.status, "", data.decode("utf-8")
+            )
+
+
+def copy_blob(src_client, src_repository, dst_client, dst_repository, descriptor):
+    """
+    Copy a blob between registries (or repositories), unless the destination
+    already has it. Returns the number of bytes copied
+    """
+    digest = descriptor["digest"]
+    if dst_client.has_blob(dst_repository, digest):
+        return 0
+
+    if src_client is dst_client and dst_client.mount_blob(
+        dst_repository, digest, src_repository
+    ):
+        return 0
+
+    with src_client.open_blob(src_repository, digest) as stream:
+        dst_client.upload_blob(dst_repository, digest, stream, descriptor["size"])
+
+    return descriptor["size"]
+
+
+def copy_image(
+    src_client,
+    src_repository,
+    src_reference,
+    dst_client,
+    dst_repository,
+    dst_reference,
+    blob_pool,
+    platform=None,
+):
+    """
+    Copy an image between registries, transferring its blobs concurrently in a
+    pool of workers, and preserving the manifest digests
+
+    For multi-platform images, we copy the image for all platforms, unless we
+    are given one (e.g. `linux/amd64`), in which case we only copy that
+    platform's manifest. Returns the digest of the copied manifest, and the
+    number of bytes copied.
+    """
+    data, media_type, digest = src_client.get_manifest(src_repository, src_reference)
+    manifest = json_loads(data)
+
+    if media_type in INDEX_MEDIA_TYPES:
+        children = manifest["manifests"]
+        if platform is not None:
+            platform_os, arch = platform.split("/")
+            children = [
+                child
+                for child in children
+                if child.get("platform", {}).get("os") == platform_os
+                and child.get("platform", {}).get("architecture") == arch
+            ]
+            if len(children) == 0:
+                print(f"No manifest for platform {platform} in {src_repository}")
+                raise RuntimeError("Platform not found in image index!")
+
+            return copy_image(
+                src_client,
+                src_repository,
+                children[0]["digest"],
+                dst_client,
+                dst_repository,
+                dst_reference,
+                blob_pool,
+            )
+
+        # The registry only accepts an index once it has all its manifests
+        copied_bytes = 0
+        for child in children:
+            copied_bytes += copy_image(
+                src_client,
+                src_repository,
+                child["digest"],
+                dst_client,
+                dst_repository,
+                child["digest"],
+                blob_pool,
+            )[1]
+    else:
+        futures = [
+            blob_pool.submit(
+                copy_blob,
+                src_client,
+                src_repository,
+                dst_client,
+                dst_repository,
+                descriptor,
+            )
+            for descriptor in [manifest["config"]] + manifest["layers"]
+        ]
+        copied_bytes = sum([future.result() for future in futures])
+
+    dst_client.put_manifest(dst_repository, dst_reference, data, media_type)
+
+    return digest, copied_bytes
+
+
+REGISTRY_CLIENTS = {}
+REGISTRY_CLIENTS_LOCK = Lock()
+
+
+def get_registry_client(host, cafile=None, port=443, secure=True):
+    """
+    Get the session-wide client for a registry host (and port)
+    """
+    with REGISTRY_CLIENTS_LOCK:
+        if (host, port) not in REGISTRY_CLIENTS:
+            REGISTRY_CLIENTS[(host, port)] = RegistryClient(
+                host, port=port, cafile=cafile, secure=secure
+            )
+
+    return REGISTRY_CLIENTS[(host, port)]
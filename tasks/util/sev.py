@@ -1,13 +1,45 @@
-from json import loads as json_loads
-from os.path import join
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from hashlib import sha256
+from json import dumps as json_dumps, load as json_load, loads as json_loads
+from os import cpu_count, fdopen, makedirs, replace, stat
+from os.path import dirname, exists, join
 from re import sub as regex_sub
 from sevsnpmeasure import guest
 from sevsnpmeasure.sev_mode import SevMode
 from sevsnpmeasure.vmm_types import VMMType
 from sevsnpmeasure.vcpu_types import cpu_sig as sev_snp_cpu_sig
 from subprocess import run
-from tasks.util.env import KATA_CONFIG_DIR, KBS_PORT, get_node_url
+from tasks.util.env import (
+    KATA_CONFIG_DIR,
+    KBS_PORT,
+    SC2_LAUNCH_DIGESTS_FILE,
+    get_node_url,
+)
 from tasks.util.toml import read_value_from_toml
+from tempfile import mkstemp
+from threading import Lock
+
+# All the inputs to the SEV launch digest calculation (the arguments to
+# sevsnpmeasure's `calc_launch_digest`)
+LaunchDigestInputs = namedtuple(
+    "LaunchDigestInputs",
+    ["sev_mode", "vcpus", "vcpu_sig", "ovmf_file", "kernel", "initrd", "append"],
+)
+
+LAUNCH_DIGESTS_LOCK = Lock()
+
+# SEV runtimes (i.e. the suffix of their Kata config file), and the SEV modes
+# they can launch confidential VMs with
+LAUNCH_DIGEST_RUNTIMES = {
+    "sev": [SevMode.SEV, SevMode.SEV_ES],
+    "snp": [SevMode.SEV_SNP],
+    "snp-sc2": [SevMode.SEV_SNP],
+}
+
+# Upper bound to the number of vCPUs that we pre-compute launch digests for
+LAUNCH_DIGEST_MAX_VCPUS = 16
 
 
 def get_kernel_append():
@@ -47,11 +79,11 @@ def get_kernel_append():
     return kernel_append
 
 
-def get_launch_digest(mode):
+@lru_cache()
+def get_cpu_sig():
     """
-    Calculate the SEV launch digest from configuration files
+    Get the CPU signature (family, model, and stepping) of the host
     """
-    # Get CPU information
     cpu_json_str = (
         run("lscpu --json", shell=True, check=True, capture_output=True)
         .stdout.decode("utf-8")
@@ -68,25 +100,192 @@ def get_launch_digest(mode):
             None,
         )["data"]
         cpu_fields[field] = data
-    cpu_sig = sev_snp_cpu_sig(
+
+    return sev_snp_cpu_sig(
         int(cpu_fields["CPU family:"]),
         int(cpu_fields["Model:"]),
         int(cpu_fields["Stepping:"]),
     )
 
-    # Pick the right configuration file
+
+def get_launch_digest_inputs(mode, vcpus=None, sev_mode=SevMode.SEV):
+    """
+    Gather all the inputs to the SEV launch digest of a runtime from its Kata
+    configuration file. Unless we override it, the number of vCPUs is the
+    runtime's default
+    """
     toml_path = join(KATA_CONFIG_DIR, "configuration-qemu-{}.toml".format(mode))
+    if vcpus is None:
+        vcpus = read_value_from_toml(toml_path, "hypervisor.qemu.default_vcpus")
 
-    # Finally, calculate the launch digest
-    ld = guest.calc_launch_digest(
-        mode=SevMode.SEV,
-        vcpus=read_value_from_toml(toml_path, "hypervisor.qemu.default_vcpus"),
-        vcpu_sig=cpu_sig,
+    return LaunchDigestInputs(
+        sev_mode=sev_mode,
+        vcpus=vcpus,
+        vcpu_sig=get_cpu_sig(),
         ovmf_file=read_value_from_toml(toml_path, "hypervisor.qemu.firmware"),
         kernel=read_value_from_toml(toml_path, "hypervisor.qemu.kernel"),
         initrd=read_value_from_toml(toml_path, "hypervisor.qemu.initrd"),
         append=get_kernel_append(),
+    )
+
+
+def get_allowed_launch_digest_inputs():
+    """
+    Enumerate the inputs to all the launch digests that our SEV runtimes may
+    produce: one for each runtime, SEV mode, and number of vCPUs that a pod
+    may request
+
+    Pods can only override the number of vCPUs (i.e. with the
+    `io.katacontainers.config.hypervisor.default_vcpus` annotation) if the
+    runtime allows it, and only up to the runtime's maximum.
+
+    Returns a {(mode, sev_mode, vcpus): LaunchDigestInputs} dictionary.
+    """
+    all_inputs = {}
+    for mode, sev_modes in LAUNCH_DIGEST_RUNTIMES.items():
+        toml_path = join(KATA_CONFIG_DIR, "configuration-qemu-{}.toml".format(mode))
+        if not exists(toml_path):
+            continue
+
+        default_vcpus = read_value_from_toml(toml_path, "hypervisor.qemu.default_vcpus")
+        all_vcpus = [default_vcpus]
+        annotations = read_value_from_toml(
+            toml_path, "hypervisor.qemu.enable_annotations", tolerate_missing=True
+        )
+        if "default_vcpus" in (annotations or []):
+            max_vcpus = read_value_from_toml(
+                toml_path, "hypervisor.qemu.default_maxvcpus", tolerate_missing=True
+            )
+            # Kata interprets a maximum of 0 vCPUs as the number of host CPUs
+            max_vcpus = min(
+                max_vcpus or cpu_count(), LAUNCH_DIGEST_MAX_VCPUS, cpu_count()
+            )
+            all_vcpus = sorted(set(all_vcpus + list(range(1, max_vcpus + 1))))
+
+        for sev_mode in sev_modes:
+            for vcpus in all_vcpus:
+                all_inputs[(mode, sev_mode, vcpus)] = get_launch_digest_inputs(
+                    mode, vcpus=vcpus, sev_mode=sev_mode
+                )
+
+    return all_inputs
+
+
+def get_file_content_digest(file_path, file_digests):
+    """
+    Get the SHA256 of a file's contents. To avoid re-hashing large files
+    (e.g. the initrd), we memoize the digest in `file_digests` together with
+    the file's inode number, size, and modification time
+    """
+    file_stat = stat(file_path)
+    file_id = [file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns]
+    if file_digests.get(file_path, {}).get("id") == file_id:
+        return file_digests[file_path]["sha256"]
+
+    hasher = sha256()
+    with open(file_path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    file_digests[file_path] = {"id": file_id, "sha256": hasher.hexdigest()}
+
+    return file_digests[file_path]["sha256"]
+
+
+def get_launch_digest_cache_key(inputs, file_digests):
+    """
+    Get the key for a launch digest in the cache: a hash of all the inputs
+    to the measurement, including the contents of the measured files
+    """
+    key_dict = inputs._asdict()
+    key_dict["sev_mode"] = inputs.sev_mode.name
+    for file_field in ["ovmf_file", "kernel", "initrd"]:
+        key_dict[file_field] = get_file_content_digest(
+            key_dict[file_field], file_digests
+        )
+
+    return sha256(json_dumps(key_dict, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def read_launch_digests_cache():
+    if not exists(SC2_LAUNCH_DIGESTS_FILE):
+        return {"files": {}, "digests": {}}
+
+    with open(SC2_LAUNCH_DIGESTS_FILE, "r") as fh:
+        return json_load(fh)
+
+
+def write_launch_digests_cache(cache):
+    makedirs(dirname(SC2_LAUNCH_DIGESTS_FILE), exist_ok=True)
+    tmp_fd, tmp_path = mkstemp(dir=dirname(SC2_LAUNCH_DIGESTS_FILE))
+    with fdopen(tmp_fd, "w") as fh:
+        fh.write(json_dumps(cache, indent=2, sort_keys=True) + "\n")
+    replace(tmp_path, SC2_LAUNCH_DIGESTS_FILE)
+
+
+def calc_launch_digest(inputs):
+    return guest.calc_launch_digest(
+        mode=inputs.sev_mode,
+        vcpus=inputs.vcpus,
+        vcpu_sig=inputs.vcpu_sig,
+        ovmf_file=inputs.ovmf_file,
+        kernel=inputs.kernel,
+        initrd=inputs.initrd,
+        append=inputs.append,
         vmm_type=VMMType.QEMU,
     )
 
-    return ld
+
+def get_launch_digests(all_inputs, use_cache=True, num_workers=None):
+    """
+    Calculate the launch digests for a list of LaunchDigestInputs, returning
+    the list of digests in the same order
+
+    Calculating a launch digest hashes the full OVMF, kernel, and initrd, so
+    we keep a persistent cache of launch digests keyed by all their inputs
+    (see `get_launch_digest_cache_key`). Any change to a measured file, the
+    number of vCPUs, the CPU, or the kernel command line results in a
+    different key. We calculate all the missing digests in parallel, in a
+    pool of worker processes.
+    """
+    if not use_cache:
+        cache = {"files": {}, "digests": {}}
+        keys = [None for _ in all_inputs]
+    else:
+        with LAUNCH_DIGESTS_LOCK:
+            cache = read_launch_digests_cache()
+            keys = [
+                get_launch_digest_cache_key(inputs, cache["files"])
+                for inputs in all_inputs
+            ]
+
+    missing = [
+        i for i, key in enumerate(keys) if key is None or key not in cache["digests"]
+    ]
+    digests = {}
+    if len(missing) == 1:
+        digests[missing[0]] = calc_launch_digest(all_inputs[missing[0]])
+    elif len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = pool.map(calc_launch_digest, [all_inputs[i] for i in missing])
+            digests = dict(zip(missing, results))
+
+    if use_cache and len(missing) > 0:
+        # Re-read the cache under the lock, as other threads may have updated it
+        with LAUNCH_DIGESTS_LOCK:
+            new_cache = read_launch_digests_cache()
+            new_cache["files"].update(cache["files"])
+            for i, ld in digests.items():
+                new_cache["digests"][keys[i]] = ld.hex()
+            write_launch_digests_cache(new_cache)
+
+    return [
+        digests[i] if i in digests else bytes.fromhex(cache["digests"][keys[i]])
+        for i in range(len(all_inputs))
+    ]
+
+
+def get_launch_digest(mode, use_cache=True):
+    """
+    Calculate the SEV launch digest from configuration files
+    """
+    return get_launch_digests([get_launch_digest_inputs(mode)], use_cache=use_cache)[0]
@@ -1,20 +1,60 @@
 from base64 import b64encode
-from json import loads as json_loads
-from os.path import exists, join
-from pymysql.err import IntegrityError
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
+from hashlib import sha256
+from json import dumps as json_dumps, load as json_load, loads as json_loads
+from os import fdopen, makedirs, replace
+from os.path import dirname, exists, join
+from re import sub
 from subprocess import run
 from tasks.util.cosign import sign_container_image
-from tasks.util.env import CONF_FILES_DIR, K8S_CONFIG_DIR
-from tasks.util.guest_components import (
-    start_coco_keyprovider,
-    stop_coco_keyprovider,
+from tasks.util.env import (
+    CONF_FILES_DIR,
+    K8S_CONFIG_DIR,
+    LOCAL_REGISTRY_URL,
+    SC2_ENCRYPTED_LAYERS_FILE,
+)
+from tasks.util.guest_components import coco_keyprovider
+from tasks.util.kbs import KBS_INTEGRITY_ERRORS, create_kbs_secret
+from tasks.util.registry import get_local_registry_client
+from tasks.util.registry_api import (
+    INDEX_MEDIA_TYPES,
+    OCI_MANIFEST_MEDIA_TYPE,
+    parse_image_tag,
 )
-from tasks.util.kbs import create_kbs_secret
 from tasks.util.versions import SKOPEO_VERSION
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+from uuid import uuid4
 
 SKOPEO_IMAGE = "quay.io/skopeo/stable:v{}".format(SKOPEO_VERSION)
 SKOPEO_ENCRYPTION_KEY = join(K8S_CONFIG_DIR, "image_enc.key")
+SKOPEO_ENCRYPTION_KEY_RESOURCE_ID = "default/image-encryption-key/1"
 AA_CTR_ENCRYPTION_KEY = "/tmp/image_enc.key"
+SKOPEO_ENCRYPT_NUM_WORKERS = 4
+ENCRYPTED_TAG = "encrypted"
+ENCRYPTED_STAGING_TAG = "encrypted-staging"
+
+# Time (in seconds) spent encrypting, checking, and signing (or None if not
+# signed) an image, and the number of encrypted layers re-used from previous
+# encryptions (or None if we did not use the layer cache)
+EncryptionTiming = namedtuple(
+    "EncryptionTiming", ["encrypt", "check", "sign", "reused"], defaults=[None]
+)
+
+ENCRYPTED_LAYERS_CACHE_LOCK = Lock()
+
+# Which layers of an image to encrypt. By default we encrypt all layers.
+# Otherwise, we only encrypt the layers that are not in a base image (e.g. a
+# public Python or Rust image), and/or the layers whose build step (i.e. the
+# `created_by` entry in the image history) matches a glob pattern (e.g.
+# `*COPY*`). We rely on cosign signatures, and the KBS signature verification
+# policy, for the integrity of the plaintext layers
+LayerEncryptionPolicy = namedtuple(
+    "LayerEncryptionPolicy", ["base_image_tag", "match"], defaults=[None, None]
+)
 
 
 def run_skopeo_cmd(cmd, capture_stdout=False):
@@ -48,66 +88,424 @@ def create_encryption_key():
     run(cmd, shell=True, check=True)
 
 
-def encrypt_container_image(image_tag, sign=False):
-    encryption_key_resource_id = "default/image-encryption-key/1"
-    if not exists(SKOPEO_ENCRYPTION_KEY):
-        create_encryption_key()
+def get_encrypted_image_tag(image_tag):
+    return image_tag.split(":")[0] + ":" + ENCRYPTED_TAG
+
 
-    # We use CoCo's keyprovider server (that implements the ocicrypt protocol)
-    # to encrypt the OCI image. To that extent, we need to mount the encryption
-    # key somewhere that the attestation agent (in the keyprovider) can find
-    # it
-    start_coco_keyprovider(SKOPEO_ENCRYPTION_KEY, AA_CTR_ENCRYPTION_KEY)
+def encrypt_image_layers(image_tag, key_resource_id, dst_image_tag=None, layers=None):
+    """
+    Copy an image to its encrypted tag (or to `dst_image_tag`), encrypting its
+    layers on the way. By default we encrypt all layers, otherwise only the
+    given layer indexes (possibly none)
+
+    We use CoCo's keyprovider server (that implements the ocicrypt protocol)
+    to encrypt the OCI image, so the keyprovider must be running (see
+    `coco_keyprovider`).
+    """
+    if dst_image_tag is None:
+        dst_image_tag = get_encrypted_image_tag(image_tag)
 
-    encrypted_image_tag = image_tag.split(":")[0] + ":encrypted"
     skopeo_cmd = [
         "copy --insecure-policy",
         "--authfile /config.json",
         "--dest-cert-dir=/certs",
         "--src-cert-dir=/certs",
-        "--encryption-key",
-        "provider:attestation-agent:keyid=kbs:///{}::keypath={}".format(
-            encryption_key_resource_id, AA_CTR_ENCRYPTION_KEY
-        ),
+        # Encrypted layers are only supported in OCI manifests
+        "--format oci",
+    ]
+    if layers is None or len(layers) > 0:
+        skopeo_cmd += [
+            "--encryption-key",
+            "provider:attestation-agent:keyid=kbs:///{}::keypath={}".format(
+                key_resource_id, AA_CTR_ENCRYPTION_KEY
+            ),
+        ]
+    if layers is not None:
+        skopeo_cmd += ["--encrypt-layer {}".format(layer) for layer in layers]
+    skopeo_cmd += [
         "docker://{}".format(image_tag),
-        "docker://{}".format(encrypted_image_tag),
+        "docker://{}".format(dst_image_tag),
     ]
     skopeo_cmd = " ".join(skopeo_cmd)
     run_skopeo_cmd(skopeo_cmd)
 
-    # Stop the keyprovider when we are done encrypting layers
-    stop_coco_keyprovider()
+    return dst_image_tag
 
-    # Sanity check that the image is actually encrypted
+
+def check_layers_encrypted(media_types, encrypted_image_tag, layers=None):
+    """
+    Sanity check that all the layers in an image (or all the given layer
+    indexes) are actually encrypted
+    """
+    if layers is None:
+        layers = range(len(media_types))
+
+    if not all([media_types[i].endswith("+encrypted") for i in layers]):
+        print("Some layers in image {} are not encrypted!".format(encrypted_image_tag))
+        raise RuntimeError("Image encryption failed!")
+
+
+def inspect_image(image_tag, config=False):
     inspect_jsonstr = run_skopeo_cmd(
-        "inspect --cert-dir /certs --authfile /config.json docker://{}".format(
-            encrypted_image_tag
+        "inspect {} --cert-dir /certs --authfile /config.json docker://{}".format(
+            "--config" if config else "", image_tag
         ),
         capture_stdout=True,
     )
-    inspect_json = json_loads(inspect_jsonstr)
-    layers = [
-        layer["MIMEType"].endswith("tar+gzip+encrypted")
-        for layer in inspect_json["LayersData"]
+    return json_loads(inspect_jsonstr)
+
+
+def check_image_encrypted(encrypted_image_tag, layers=None):
+    inspect_json = inspect_image(encrypted_image_tag)
+    check_layers_encrypted(
+        [layer["MIMEType"] for layer in inspect_json["LayersData"]],
+        encrypted_image_tag,
+        layers,
+    )
+
+
+def get_layers_to_encrypt(image_tag, policy=None):
+    """
+    Get the indexes of the layers to encrypt in an image according to a
+    LayerEncryptionPolicy, or `None` to encrypt all of them
+    """
+    if policy is None or policy == LayerEncryptionPolicy():
+        return None
+
+    layer_digests = [
+        layer["Digest"] for layer in inspect_image(image_tag)["LayersData"]
     ]
-    if not all(layers):
-        print("Some layers in image {} are not encrypted!".format(encrypted_image_tag))
-        stop_coco_keyprovider()
+    layers = list(range(len(layer_digests)))
+
+    if policy.base_image_tag is not None:
+        base_layers = inspect_image(policy.base_image_tag)["LayersData"]
+        base_digests = set([layer["Digest"] for layer in base_layers])
+        layers = [i for i in layers if layer_digests[i] not in base_digests]
+
+    if policy.match is not None:
+        # Only the history entries that are not empty layers have a layer
+        history = [
+            entry.get("created_by", "")
+            for entry in inspect_image(image_tag, config=True).get("history", [])
+            if not entry.get("empty_layer", False)
+        ]
+        if len(history) != len(layer_digests):
+            print(
+                "Image {} has {} layers but {} history entries".format(
+                    image_tag, len(layer_digests), len(history)
+                )
+            )
+            raise RuntimeError("Can not match layers against the image history!")
+
+        layers = [i for i in layers if fnmatch(history[i], policy.match)]
+
+    if len(layers) == 0:
+        print("Policy {} selects no layers to encrypt in {}".format(policy, image_tag))
+        raise RuntimeError("No layers to encrypt!")
+
+    return layers
+
+
+def get_staging_tag(reference):
+    # Tags may only have alphanumerics, `_`, `.`, and `-`, and 128 characters
+    reference = sub(r"[^A-Za-z0-9_.-]", "-", reference)[:64]
+    return "{}-{}-{}".format(ENCRYPTED_STAGING_TAG, reference, uuid4().hex[:12])
+
+
+def get_encryption_key_id(key_resource_id):
+    """
+    Identify an encryption key by its KBS resource id and its contents, so that
+    re-generating the key invalidates all the layers encrypted with it
+    """
+    with open(SKOPEO_ENCRYPTION_KEY, "rb") as fh:
+        key_digest = sha256(fh.read()).hexdigest()[:16]
+
+    return "{}@{}".format(key_resource_id, key_digest)
+
+
+def get_encrypted_layer_cache_key(layer_digest, key_id):
+    return "{}|{}".format(layer_digest, key_id)
+
+
+def read_encrypted_layers_cache():
+    if not exists(SC2_ENCRYPTED_LAYERS_FILE):
+        return {}
+
+    with open(SC2_ENCRYPTED_LAYERS_FILE, "r") as fh:
+        return json_load(fh)
+
+
+def update_encrypted_layers_cache(entries):
+    """
+    Add entries to the encrypted layers cache. Concurrent encryptions may
+    update the cache, so we merge the entries under a lock
+    """
+    if len(entries) == 0:
+        return
+
+    with ENCRYPTED_LAYERS_CACHE_LOCK:
+        cache = read_encrypted_layers_cache()
+        cache.update(entries)
+
+        makedirs(dirname(SC2_ENCRYPTED_LAYERS_FILE), exist_ok=True)
+        tmp_fd, tmp_path = mkstemp(dir=dirname(SC2_ENCRYPTED_LAYERS_FILE))
+        with fdopen(tmp_fd, "w") as fh:
+            fh.write(json_dumps(cache, indent=2, sort_keys=True) + "\n")
+        replace(tmp_path, SC2_ENCRYPTED_LAYERS_FILE)
+
+
+def encrypt_image_layers_cached(image_tag, key_resource_id, layers=None):
+    """
+    Encrypt an image in the local registry (all its layers, or only the given
+    layer indexes), re-using the encrypted layers from previous encryptions
+    with the same key
+
+    Skopeo knows nothing about previous encryptions, so re-encrypting an image
+    after a one-line change would re-encrypt and re-upload all its layers.
+    Instead, we keep a persistent map from (plaintext layer digest, key) to the
+    encrypted layer's descriptor (including the ocicrypt annotations with the
+    wrapped layer key), and only ask Skopeo to encrypt the layers we have not
+    seen before, copying the image to a staging tag. We then assemble the
+    encrypted manifest by swapping in the cached encrypted layers, whose blobs
+    are already in the registry.
+
+    Returns the encrypted image tag, and the number of re-used layers.
+    """
+    client = get_local_registry_client()
+    registry, repository, reference = parse_image_tag(image_tag)
+    data, media_type, plain_digest = client.get_manifest(repository, reference)
+    if media_type in INDEX_MEDIA_TYPES:
+        # Let Skopeo pick the manifest for our platform
+        encrypted_image_tag = encrypt_image_layers(
+            image_tag, key_resource_id, layers=layers
+        )
+        check_image_encrypted(encrypted_image_tag, layers)
+        return encrypted_image_tag, 0
+    plain_layers = json_loads(data)["layers"]
+    if layers is None:
+        layers = list(range(len(plain_layers)))
+
+    # Work out which layers we have already encrypted, and whose blobs are
+    # still in the registry (it may have been re-created since)
+    key_id = get_encryption_key_id(key_resource_id)
+    cache = read_encrypted_layers_cache()
+    cached_layers = {}
+    for i in layers:
+        entry = cache.get(
+            get_encrypted_layer_cache_key(plain_layers[i]["digest"], key_id)
+        )
+        if entry is None:
+            continue
+
+        if client.has_blob(repository, entry["digest"]) or client.mount_blob(
+            repository, entry["digest"], entry["repository"]
+        ):
+            cached_layers[i] = entry
+    new_layers = [i for i in layers if i not in cached_layers]
+
+    # Each encryption stages its image to a unique tag, so that concurrent
+    # encryptions of images in the same repository do not clash
+    staging_tag = get_staging_tag(reference)
+    staging_image_tag = "{}/{}:{}".format(registry, repository, staging_tag)
+    encrypt_image_layers(
+        image_tag, key_resource_id, dst_image_tag=staging_image_tag, layers=new_layers
+    )
+    data, _, staging_digest = client.get_manifest(repository, staging_tag)
+    # Deleting a manifest deletes all the tags that point to it, so we must
+    # not delete the staged one if it is also the plaintext image (i.e. if
+    # there was nothing to encrypt). The registry does not garbage-collect the
+    # staged layers, so we can still re-use them in the encrypted manifest
+    if staging_digest != plain_digest:
+        if not client.delete_manifest(repository, staging_digest):
+            print(f"WARNING: could not delete staging tag {staging_image_tag}")
+
+    manifest = json_loads(data)
+    if len(manifest["layers"]) != len(plain_layers):
+        print(
+            "Staged image {} has {} layers, expected {}".format(
+                staging_image_tag, len(manifest["layers"]), len(plain_layers)
+            )
+        )
         raise RuntimeError("Image encryption failed!")
 
-    # Create a secret in KBS with the encryption key. Skopeo needs it as raw
-    # bytes, whereas KBS wants it base64 encoded, so we do the conversion first
+    new_entries = {}
+    for i, layer in enumerate(plain_layers):
+        if i in cached_layers:
+            manifest["layers"][i] = {
+                k: v for k, v in cached_layers[i].items() if k != "repository"
+            }
+        elif manifest["layers"][i]["mediaType"].endswith("+encrypted"):
+            cache_key = get_encrypted_layer_cache_key(layer["digest"], key_id)
+            new_entries[cache_key] = dict(manifest["layers"][i], repository=repository)
+
+    encrypted_image_tag = get_encrypted_image_tag(image_tag)
+    check_layers_encrypted(
+        [layer["mediaType"] for layer in manifest["layers"]],
+        encrypted_image_tag,
+        layers,
+    )
+    update_encrypted_layers_cache(new_entries)
+    client.put_manifest(
+        repository,
+        ENCRYPTED_TAG,
+        json_dumps(manifest).encode("utf-8"),
+        manifest.get("mediaType", OCI_MANIFEST_MEDIA_TYPE),
+    )
+
+    return encrypted_image_tag, len(cached_layers)
+
+
+def provision_encryption_key(key_resource_id):
+    """
+    Create a secret in KBS with the encryption key
+    """
+    # Skopeo needs the key as raw bytes, whereas KBS wants it base64 encoded,
+    # so we do the conversion first
     with open(SKOPEO_ENCRYPTION_KEY, "rb") as fh:
         key_b64 = b64encode(fh.read()).decode()
 
-    # When we are encrypting multiple container images, it may happen that the
-    # encryption key is already there. Thus it is safe to ignore this exception
-    # here
+    # The encryption key may already be there from a previous encryption. Thus
+    # it is safe to ignore this exception here
     try:
-        create_kbs_secret(encryption_key_resource_id, key_b64)
-    except IntegrityError:
+        create_kbs_secret(key_resource_id, key_b64)
+    except KBS_INTEGRITY_ERRORS:
         print("WARNING: error creating KBS secret...")
         pass
 
-    if sign:
+
+def print_encryption_timings(timings, total_time):
+    header = "{:<56} {:>12} {:>10} {:>10} {:>8}".format(
+        "Image", "Encrypt (s)", "Check (s)", "Sign (s)", "Reused"
+    )
+    print(header)
+    print("-" * len(header))
+    for image_tag, timing in timings.items():
+        print(
+            "{:<56} {:>12.1f} {:>10.1f} {:>10} {:>8}".format(
+                image_tag[-56:],
+                timing.encrypt,
+                timing.check,
+                "-" if timing.sign is None else "{:.1f}".format(timing.sign),
+                "-" if timing.reused is None else timing.reused,
+            )
+        )
+    serial_time = sum([t.encrypt + t.check + (t.sign or 0) for t in timings.values()])
+    print(
+        "Encrypted {} images in {:.1f}s (sum of image times: {:.1f}s)".format(
+            len(timings), total_time, serial_time
+        )
+    )
+
+
+def encrypt_container_images(
+    image_tags,
+    sign=False,
+    num_workers=SKOPEO_ENCRYPT_NUM_WORKERS,
+    use_cache=True,
+    policy=None,
+):
+    """
+    Encrypt (and optionally sign) a list of container images
+
+    All images are encrypted with the same key, so we provision it in KBS once,
+    and share one keyprovider session among a bounded pool of encryption
+    workers. We sign each image in a separate (single-threaded) pool as soon as
+    it is encrypted, so that signing overlaps with the encryption of the
+    following images.
+
+    For images in the local registry, we also re-use the encrypted layers from
+    previous encryptions (see `encrypt_image_layers_cached`).
+
+    Given a LayerEncryptionPolicy, we only encrypt some layers of each image.
+    The plaintext layers are only protected by the image signature, so we
+    always sign selectively encrypted images.
+
+    Returns a dictionary with the EncryptionTiming of each image.
+    """
+    # Images that map to the same encrypted tag (e.g. two tags of the same
+    # repository) would overwrite each other's encrypted image
+    encrypted_image_tags = {}
+    for image_tag in image_tags:
+        encrypted_image_tag = get_encrypted_image_tag(image_tag)
+        if encrypted_image_tag in encrypted_image_tags:
+            print(
+                "Images {} and {} both encrypt to {}".format(
+                    encrypted_image_tags[encrypted_image_tag],
+                    image_tag,
+                    encrypted_image_tag,
+                )
+            )
+            raise RuntimeError("Conflicting images to encrypt!")
+        encrypted_image_tags[encrypted_image_tag] = image_tag
+
+    if not exists(SKOPEO_ENCRYPTION_KEY):
+        create_encryption_key()
+
+    provision_encryption_key(SKOPEO_ENCRYPTION_KEY_RESOURCE_ID)
+
+    if policy is not None and policy != LayerEncryptionPolicy() and not sign:
+        print("WARNING: signing selectively encrypted images")
+        sign = True
+
+    timings = {}
+
+    def do_encrypt(image_tag):
+        start_ts = time()
+        layers = get_layers_to_encrypt(image_tag, policy)
+        if use_cache and parse_image_tag(image_tag)[0] == LOCAL_REGISTRY_URL:
+            # We check the encrypted manifest before we push it
+            encrypted_image_tag, reused = encrypt_image_layers_cached(
+                image_tag, SKOPEO_ENCRYPTION_KEY_RESOURCE_ID, layers=layers
+            )
+            timings[image_tag] = EncryptionTiming(time() - start_ts, 0, None, reused)
+            return encrypted_image_tag
+
+        encrypted_image_tag = encrypt_image_layers(
+            image_tag, SKOPEO_ENCRYPTION_KEY_RESOURCE_ID, layers=layers
+        )
+        encrypt_ts = time()
+        check_image_encrypted(encrypted_image_tag, layers)
+        timings[image_tag] = EncryptionTiming(
+            encrypt_ts - start_ts, time() - encrypt_ts, None
+        )
+
+        return encrypted_image_tag
+
+    def do_sign(image_tag, encrypted_image_tag):
+        start_ts = time()
         sign_container_image(encrypted_image_tag)
+        timings[image_tag] = timings[image_tag]._replace(sign=time() - start_ts)
+
+    start_ts = time()
+    with coco_keyprovider(SKOPEO_ENCRYPTION_KEY, AA_CTR_ENCRYPTION_KEY):
+        with ThreadPoolExecutor(
+            max_workers=num_workers
+        ) as encrypt_pool, ThreadPoolExecutor(max_workers=1) as sign_pool:
+            encrypt_futures = {
+                encrypt_pool.submit(do_encrypt, image_tag): image_tag
+                for image_tag in image_tags
+            }
+            sign_futures = []
+            for future in as_completed(encrypt_futures):
+                image_tag = encrypt_futures[future]
+                encrypted_image_tag = future.result()
+                print("Encrypted {} -> {}".format(image_tag, encrypted_image_tag))
+                if sign:
+                    sign_futures.append(
+                        sign_pool.submit(do_sign, image_tag, encrypted_image_tag)
+                    )
+
+            for future in sign_futures:
+                future.result()
+
+    # Report the images in the order we were given them
+    timings = {image_tag: timings[image_tag] for image_tag in image_tags}
+    print_encryption_timings(timings, time() - start_ts)
+
+    return timings
+
+
+def encrypt_container_image(image_tag, sign=False, use_cache=True, policy=None):
+    encrypt_container_images(
+        [image_tag], sign=sign, num_workers=1, use_cache=use_cache, policy=policy
+    )
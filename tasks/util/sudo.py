@@ -0,0 +1,290 @@
+from atexit import register as atexit_register
+from base64 import b64decode, b64encode
+from json import dumps as json_dumps, loads as json_loads
+from os import chmod, chown, environ, getpid, makedirs, remove, replace, symlink
+from os.path import abspath, basename, exists, isdir, islink, join
+from shutil import copyfile, copymode, move, rmtree
+from subprocess import PIPE, Popen, run
+from sys import stdin, stdout
+from threading import Lock
+
+# Deploying SC2 requires hundreds of privileged file operations (copies,
+# writes, mkdirs, ...). Running each of them as a separate `sudo` subprocess
+# pays for a fork/exec, sudo's PAM stack, and a shell every time. Instead, we
+# start a single root helper process per `inv` session (i.e. `sudo python3`
+# running this very file) and talk to it over a pipe with a small JSON-lines
+# RPC protocol.
+#
+# WARNING: this file is also the helper's entrypoint, so it must only import
+# from the standard library.
+
+# Set this environment variable to `off` to fall back to running one `sudo`
+# subprocess per operation (e.g. to benchmark the helper)
+SUDO_HELPER_ENV_VAR = "SC2_SUDO_HELPER"
+
+# -----------------------------------------------------------------------------
+# Helper (server) side. All these functions run as root
+# -----------------------------------------------------------------------------
+
+
+def get_staging_path(path):
+    return f"{path}.sc2-{getpid()}"
+
+
+def do_write_file(path, data, append=False, mode=None):
+    contents = b64decode(data)
+
+    if append:
+        with open(path, "ab") as fh:
+            fh.write(contents)
+        return
+
+    # Write to a staging file next to the destination, and rename it in place
+    # so that readers never see a half-written file
+    staging_path = get_staging_path(path)
+    with open(staging_path, "wb") as fh:
+        fh.write(contents)
+    if exists(path):
+        copymode(path, staging_path)
+    elif mode is not None:
+        chmod(staging_path, mode)
+    replace(staging_path, path)
+
+
+def do_copy(src, dst):
+    # Mimic `cp`, and copy into the destination if it is a directory
+    if isdir(dst):
+        dst = join(dst, basename(src))
+
+    staging_path = get_staging_path(dst)
+    copyfile(src, staging_path)
+    copymode(src, staging_path)
+    replace(staging_path, dst)
+
+
+def do_read_file(path):
+    with open(path, "rb") as fh:
+        return b64encode(fh.read()).decode("utf-8")
+
+
+def do_remove(path, recursive=False):
+    if isdir(path) and not islink(path):
+        if not recursive:
+            raise IsADirectoryError(f"{path} is a directory")
+        rmtree(path)
+    elif exists(path) or islink(path):
+        remove(path)
+
+
+def do_symlink(src, dst):
+    if exists(dst) or islink(dst):
+        remove(dst)
+    symlink(src, dst)
+
+
+HELPER_OPS = {
+    "chown": chown,
+    "copy": do_copy,
+    "mkdir": lambda path: makedirs(path, exist_ok=True),
+    "move": move,
+    "ping": lambda: "pong",
+    "read": do_read_file,
+    "remove": do_remove,
+    "symlink": do_symlink,
+    "write": do_write_file,
+}
+
+
+def serve():
+    """
+    Serve requests from stdin until it is closed
+
+    Each request is a JSON object in a single line with an `op` and its `args`,
+    and each response a JSON object in a single line with an `ok` flag and a
+    `result` or an `error`.
+    """
+    for line in stdin:
+        request = json_loads(line)
+        try:
+            result = HELPER_OPS[request["op"]](**request["args"])
+            response = {"ok": True, "result": result}
+        except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        stdout.write(json_dumps(response) + "\n")
+        stdout.flush()
+
+
+# -----------------------------------------------------------------------------
+# Client side
+# -----------------------------------------------------------------------------
+
+
+class SudoHelper:
+    """
+    Client to the privileged helper process
+
+    Requests are serialized with a lock, so a single helper can be shared
+    among threads.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # Run in isolated mode so that the helper does not pick up modules
+        # from this directory (e.g. our `toml.py`) or from the user's env
+        self.proc = Popen(
+            ["sudo", "python3", "-I", "-u", abspath(__file__)],
+            stdin=PIPE,
+            stdout=PIPE,
+            text=True,
+        )
+
+    def request(self, op, **args):
+        with self.lock:
+            if self.proc.poll() is not None:
+                raise RuntimeError(
+                    f"Privileged helper exited (code: {self.proc.returncode})"
+                )
+
+            self.proc.stdin.write(json_dumps({"op": op, "args": args}) + "\n")
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+
+        if not line:
+            raise RuntimeError(f"Privileged helper died running op: {op}")
+
+        response = json_loads(line)
+        if not response["ok"]:
+            raise RuntimeError(
+                f"Privileged helper error running {op}{args}: {response['error']}"
+            )
+
+        return response["result"]
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+SUDO_HELPER = None
+SUDO_HELPER_LOCK = Lock()
+
+
+def is_sudo_helper_enabled():
+    return environ.get(SUDO_HELPER_ENV_VAR, "on").lower() != "off"
+
+
+def get_sudo_helper():
+    """
+    Get the session-wide privileged helper, starting it on first use
+    """
+    global SUDO_HELPER
+
+    with SUDO_HELPER_LOCK:
+        if SUDO_HELPER is None or SUDO_HELPER.proc.poll() is not None:
+            SUDO_HELPER = SudoHelper()
+            SUDO_HELPER.request("ping")
+            atexit_register(SUDO_HELPER.close)
+
+    return SUDO_HELPER
+
+
+def sudo_write_file(path, contents, append=False, mode=None):
+    """
+    Write (or append) a string or bytes to a root-owned file
+    """
+    if isinstance(contents, str):
+        contents = contents.encode("utf-8")
+
+    if is_sudo_helper_enabled():
+        get_sudo_helper().request(
+            "write",
+            path=path,
+            data=b64encode(contents).decode("utf-8"),
+            append=append,
+            mode=mode,
+        )
+        return
+
+    run(
+        f"sudo tee {'-a ' if append else ''}{path} > /dev/null",
+        shell=True,
+        check=True,
+        input=contents,
+    )
+    if mode is not None:
+        run(f"sudo chmod {mode:o} {path}", shell=True, check=True)
+
+
+def sudo_read_file(path):
+    """
+    Read the contents of a root-readable file as bytes
+    """
+    if is_sudo_helper_enabled():
+        return b64decode(get_sudo_helper().request("read", path=path))
+
+    return run(f"sudo cat {path}", shell=True, check=True, capture_output=True).stdout
+
+
+def sudo_copy(src, dst):
+    if is_sudo_helper_enabled():
+        get_sudo_helper().request("copy", src=src, dst=dst)
+        return
+
+    run(f"sudo cp {src} {dst}", shell=True, check=True)
+
+
+def sudo_move(src, dst):
+    if is_sudo_helper_enabled():
+        get_sudo_helper().request("move", src=src, dst=dst)
+        return
+
+    run(f"sudo mv {src} {dst}", shell=True, check=True)
+
+
+def sudo_mkdir(path):
+    """
+    Create a directory and all its parents (i.e. `mkdir -p`)
+    """
+    if is_sudo_helper_enabled():
+        get_sudo_helper().request("mkdir", path=path)
+        return
+
+    run(f"sudo mkdir -p {path}", shell=True, check=True)
+
+
+def sudo_remove(path, recursive=False):
+    """
+    Remove a file or directory, returning silently if it does not exist (i.e.
+    `rm -f`, or `rm -rf` if recursive)
+    """
+    if is_sudo_helper_enabled():
+        get_sudo_helper().request("remove", path=path, recursive=recursive)
+        return
+
+    run(f"sudo rm -f{'r' if recursive else ''} {path}", shell=True, check=True)
+
+
+def sudo_chown(path, uid, gid):
+    if is_sudo_helper_enabled():
+        get_sudo_helper().request("chown", path=path, uid=uid, gid=gid)
+        return
+
+    run(f"sudo chown {uid}:{gid} {path}", shell=True, check=True)
+
+
+def sudo_symlink(src, dst):
+    """
+    Create a symbolic link at `dst` pointing to `src`, replacing `dst` if it
+    already exists (i.e. `ln -sf`)
+    """
+    if is_sudo_helper_enabled():
+        get_sudo_helper().request("symlink", src=src, dst=dst)
+        return
+
+    run(f"sudo ln -sf {src} {dst}", shell=True, check=True)
+
+
+if __name__ == "__main__":
+    serve()
@@ -1,13 +1,80 @@
+from collections import OrderedDict, namedtuple
+from copy import deepcopy
 from re import findall
-from os import remove
-from os.path import basename, join
-from subprocess import run
+from os import fdopen, replace, stat
+from os.path import basename, dirname, realpath
+from tasks.util.sudo import sudo_write_file
+from tempfile import mkstemp
 from toml import (
     dump as toml_dump,
+    dumps as toml_dump_to_string,
     load as toml_load,
     loads as toml_load_from_string,
 )
 
+try:
+    # The standard library parser (Python >= 3.11) is much faster than the
+    # pure-Python `toml` package, but it can only read TOML files
+    from tomllib import load as tomllib_load
+except ImportError:
+    tomllib_load = None
+
+# Cache of parsed TOML files. Each entry is keyed by the (real) file path and
+# the parser we used, and tagged with the (inode, mtime, size) signature of the
+# file at the time we parsed it. An entry is only valid while the signature
+# does not change, and we evict the least-recently-used entries beyond the
+# maximum size
+TOML_CACHE = OrderedDict()
+TOML_CACHE_MAX_ENTRIES = 32
+
+
+# A single change to a TOML file, where `path` is a "." delimited TOML path to
+# a leaf. TOML has no null value, so we use None to represent a missing value
+# (i.e. an added or a removed entry)
+TomlChange = namedtuple("TomlChange", ["path", "old_value", "new_value"])
+
+
+def get_toml_file_signature(toml_path):
+    toml_stat = stat(toml_path)
+    return (toml_stat.st_ino, toml_stat.st_mtime_ns, toml_stat.st_size)
+
+
+def cache_toml(cache_key, signature, toml_dict):
+    TOML_CACHE[cache_key] = (signature, toml_dict)
+    TOML_CACHE.move_to_end(cache_key)
+    while len(TOML_CACHE) > TOML_CACHE_MAX_ENTRIES:
+        TOML_CACHE.popitem(last=False)
+
+
+def load_toml(toml_path, read_only=False):
+    """
+    Load a TOML file, re-using the parsed contents if the file has not changed
+
+    Read-only lookups use the faster standard library parser (if available),
+    and get a reference to the cached document, so they must not modify it.
+    Otherwise, we parse the file with the `toml` package (so that we can dump
+    it back preserving its format) and return a copy of the cached document.
+    """
+    parser = "tomllib" if read_only and tomllib_load is not None else "toml"
+    cache_key = (realpath(toml_path), parser)
+
+    # Stat before parsing, so that a concurrent write can only make us tag
+    # the new contents with an old signature (i.e. a spurious cache miss)
+    signature = get_toml_file_signature(toml_path)
+    cached = TOML_CACHE.get(cache_key)
+    if cached is not None and cached[0] == signature:
+        TOML_CACHE.move_to_end(cache_key)
+        toml_dict = cached[1]
+    else:
+        if parser == "tomllib":
+            with open(toml_path, "rb") as fh:
+                toml_dict = tomllib_load(fh)
+        else:
+            toml_dict = toml_load(toml_path)
+        cache_toml(cache_key, signature, toml_dict)
+
+    return toml_dict if read_only else deepcopy(toml_dict)
+
 
 def merge_dicts_recursively(dict_a, dict_b):
     """
@@ -43,6 +110,155 @@ def merge_dicts_recursively(dict_a, dict_b):
             dict_a[k] = dict_b[k]
 
 
+def diff_tomls(old_toml, new_toml, toml_levels=None):
+    """
+    Compute the semantic difference between two TOML dictionaries
+
+    Returns a list of TomlChange, one per leaf that was added, removed, or
+    modified. Two TOML dictionaries are equivalent if the list is empty.
+    """
+    toml_levels = [] if toml_levels is None else toml_levels
+
+    changes = []
+    for key in list(old_toml) + [k for k in new_toml if k not in old_toml]:
+        old_value = old_toml.get(key)
+        new_value = new_toml.get(key)
+
+        # Recurse into added or removed sub-trees to report individual leaves
+        if isinstance(new_value, dict) and old_value is None:
+            old_value = {}
+        if isinstance(old_value, dict) and new_value is None:
+            new_value = {}
+
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            changes += diff_tomls(old_value, new_value, toml_levels + [key])
+        elif old_value != new_value:
+            changes.append(
+                TomlChange(
+                    join_dot_preserve_quote(toml_levels + [key]), old_value, new_value
+                )
+            )
+
+    return changes
+
+
+def write_toml(toml_path, toml_dict, requires_root=True):
+    """
+    Atomically replace the contents of a TOML file with a TOML dictionary
+
+    We first dump the dictionary to a temporary file next to the destination,
+    and then rename it over the destination file, so that readers never see a
+    half-written file. For root-owned files, the privileged helper does the
+    same on our behalf.
+    """
+    if requires_root:
+        sudo_write_file(toml_path, toml_dump_to_string(toml_dict))
+    else:
+        tmp_fd, tmp_path = mkstemp(
+            prefix=f"{basename(toml_path)}.", dir=dirname(toml_path)
+        )
+        with fdopen(tmp_fd, "w") as fh:
+            toml_dump(toml_dict, fh)
+        replace(tmp_path, toml_path)
+
+    # We know the parsed contents of the file we have just written, so we can
+    # populate the cache straight away
+    cache_toml(
+        (realpath(toml_path), "toml"),
+        get_toml_file_signature(toml_path),
+        deepcopy(toml_dict),
+    )
+
+
+class TomlTransaction:
+    """
+    Batch any number of updates and removals to one or more TOML files, and
+    write each modified file only once, when the transaction commits
+
+    Each file is loaded lazily the first time the transaction touches it, so
+    it is safe to (sudo-)copy a file into place and then edit it as part of
+    the same transaction. Note that files held by an open transaction must
+    not be modified by anyone else until the transaction commits.
+
+    The intended use is as a context manager. The transaction commits when
+    the block exits cleanly, and is discarded if the block raises:
+
+    with TomlTransaction() as txn:
+        txn.update_toml(CONTAINERD_CONFIG_FILE, updated_toml_str)
+        txn.remove_entry_from_toml(conf_file_path, "hypervisor.qemu.image")
+    """
+
+    def __init__(self):
+        # Map each TOML file path to its in-memory contents, to its contents
+        # when we first loaded it, and to whether the file is root-owned
+        self.toml_files = {}
+        self.original_toml_files = {}
+        self.requires_root = {}
+        self.changes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+        return False
+
+    def get_toml(self, toml_path, requires_root=True):
+        if toml_path not in self.toml_files:
+            self.toml_files[toml_path] = load_toml(toml_path)
+            self.original_toml_files[toml_path] = load_toml(toml_path)
+            self.requires_root[toml_path] = requires_root
+
+        return self.toml_files[toml_path]
+
+    def update_toml(self, toml_path, updates_toml, requires_root=True):
+        """
+        Merge a TOML string into a TOML file (see `update_toml`)
+        """
+        merge_dicts_recursively(
+            self.get_toml(toml_path, requires_root),
+            toml_load_from_string(updates_toml),
+        )
+
+    def remove_entry_from_toml(self, toml_path, toml_entry):
+        """
+        Remove an entry from a TOML file (see `remove_entry_from_toml`)
+        """
+        do_remove_entry_from_toml(self.get_toml(toml_path), toml_entry)
+
+    def commit(self):
+        """
+        Write all the modified TOML files, skipping the ones whose contents
+        have not (semantically) changed
+
+        Returns a dictionary mapping the path of each modified file to its
+        list of TomlChange. The same dictionary is kept in `self.changes`, so
+        that callers of the context manager can inspect it after the block.
+        """
+        changes = {}
+        for toml_path, toml_dict in self.toml_files.items():
+            toml_changes = diff_tomls(self.original_toml_files[toml_path], toml_dict)
+            if len(toml_changes) == 0:
+                continue
+
+            write_toml(toml_path, toml_dict, self.requires_root[toml_path])
+            changes[toml_path] = toml_changes
+
+        self.discard()
+        self.changes = changes
+
+        return changes
+
+    def discard(self):
+        self.toml_files = {}
+        self.original_toml_files = {}
+        self.requires_root = {}
+
+
 def update_toml(toml_path, updates_toml, requires_root=True):
     """
     Helper method to update entries in a TOML file
@@ -54,21 +270,18 @@ def update_toml(toml_path, updates_toml, requires_root=True):
     - updates_toml: TOML string with the required updates (simplest way to
                     express arbitrarily complex TOML files)
     - requires_root: whether the TOML file is root-owned (usually the case)
-    """
-    conf_file = toml_load(toml_path)
-    merge_dicts_recursively(conf_file, toml_load_from_string(updates_toml))
 
-    if requires_root:
-        # Dump the TOML contents to a temporary file (can't sudo-write)
-        tmp_conf = "/tmp/{}".format(basename(toml_path))
-        with open(tmp_conf, "w") as fh:
-            toml_dump(conf_file, fh)
+    If you need to apply many updates to the same file(s), prefer batching
+    them in a `TomlTransaction`.
 
-        # sudo-copy the TOML file in place
-        run("sudo mv {} {}".format(tmp_conf, toml_path), shell=True, check=True)
-    else:
-        with open(toml_path, "w") as fh:
-            toml_dump(conf_file, fh)
+    Returns the list of TomlChange applied to the file. If the list is empty,
+    the file has not been re-written, so callers can skip restarting the
+    services that read it.
+    """
+    with TomlTransaction() as txn:
+        txn.update_toml(toml_path, updates_toml, requires_root=requires_root)
+
+    return txn.changes.get(toml_path, [])
 
 
 def split_dot_preserve_quotes(input_string):
@@ -100,8 +313,11 @@ def join_dot_preserve_quote(toml_levels):
 def read_value_from_toml(toml_file_path, toml_path, tolerate_missing=False):
     """
     Return the value in a TOML specified by a "." delimited TOML path
+
+    Repeated lookups to an unchanged file (e.g. in wait loops) are served from
+    the parsed-TOML cache.
     """
-    toml_file = toml_load(toml_file_path)
+    toml_file = load_toml(toml_file_path, read_only=True)
     for toml_level in split_dot_preserve_quotes(toml_path):
         if toml_level not in toml_file:
             if tolerate_missing:
@@ -116,7 +332,8 @@ def read_value_from_toml(toml_file_path, toml_path, tolerate_missing=False):
         print("ERROR: error reading from TOML, must provide a full path")
         raise RuntimeError("Haven't reached TOML leaf!")
 
-    return toml_file
+    # Leaves may be lists, so make sure callers can not modify the cache
+    return deepcopy(toml_file)
 
 
 def do_remove_entry_from_toml(toml_dict, toml_path):
@@ -142,15 +359,10 @@ def remove_entry_from_toml(toml_file_path, toml_path):
     """
     Remove an entry (and all its descendants) from a TOML specified by a path.
     This method returns silently if the specified path does not exist.
-    """
-    toml_file = toml_load(toml_file_path)
-
-    toml_file = do_remove_entry_from_toml(toml_file, toml_path)
 
-    # Dump to temporary file and sudo-copy
-    tmp_toml_file_path = join("/tmp", basename(toml_file_path))
-    with open(tmp_toml_file_path, "w") as fh:
-        toml_dump(toml_file, fh)
+    Returns the list of TomlChange applied to the file (see `update_toml`).
+    """
+    with TomlTransaction() as txn:
+        txn.remove_entry_from_toml(toml_file_path, toml_path)
 
-    run(f"sudo cp {tmp_toml_file_path} {toml_file_path}", shell=True, check=True)
-    remove(tmp_toml_file_path)
+    return txn.changes.get(toml_file_path, [])
@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+from json import dump as json_dump, load as json_load
+from os import getpid, makedirs
+from os.path import dirname
+from threading import Lock, current_thread, get_ident, local
+from time import perf_counter
+
+# Lightweight timeline tracing for deployment steps. Each traced step is a
+# span with a name, a start time and a duration, and an arbitrary dictionary
+# of metadata (e.g. the command it ran, or the number of bytes it copied).
+# Spans nest naturally: a span opened while another one is open in the same
+# thread is its child. We export the trace in Chrome's trace-event format, so
+# that it can be loaded in `chrome://tracing` or https://ui.perfetto.dev
+TRACE_EVENTS = []
+TRACE_LOCK = Lock()
+TRACE_START_TS = perf_counter()
+TRACE_THREADS = {}
+
+# Per-thread stack of open spans
+TRACE_LOCAL = local()
+
+
+class Span:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, key, value):
+        """
+        Attach a piece of metadata to the span
+        """
+        self.args[key] = value
+
+    def incr(self, key, value=1):
+        """
+        Increment a counter in the span's metadata (e.g. a retry count)
+        """
+        self.args[key] = self.args.get(key, 0) + value
+
+
+def get_ts_us():
+    return (perf_counter() - TRACE_START_TS) * 1e6
+
+
+def reset_trace():
+    """
+    Drop all recorded spans, and start counting time from now
+    """
+    global TRACE_START_TS
+
+    with TRACE_LOCK:
+        TRACE_EVENTS.clear()
+        TRACE_THREADS.clear()
+        TRACE_START_TS = perf_counter()
+
+
+def get_current_span():
+    """
+    Return the innermost open span in this thread (or None), so that deeply
+    nested helpers can attach metadata to it
+    """
+    stack = getattr(TRACE_LOCAL, "stack", [])
+    return stack[-1] if len(stack) > 0 else None
+
+
+@contextmanager
+def span(name, category="sc2", **args):
+    """
+    Trace the execution of a block of code as a span
+
+    with span("unpack-initrd", cmd=zcat_cmd) as s:
+        ...
+        s.set("bytes", initrd_size)
+    """
+    if not hasattr(TRACE_LOCAL, "stack"):
+        TRACE_LOCAL.stack = []
+
+    this_span = Span(name, category, args)
+    TRACE_LOCAL.stack.append(this_span)
+    start_us = get_ts_us()
+    try:
+        yield this_span
+    except Exception as e:
+        this_span.set("error", str(e))
+        raise e
+    finally:
+        end_us = get_ts_us()
+        TRACE_LOCAL.stack.pop()
+
+        with TRACE_LOCK:
+            tid = get_ident()
+            if tid not in TRACE_THREADS:
+                TRACE_THREADS[tid] = current_thread().name
+
+            TRACE_EVENTS.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": start_us,
+                    "dur": end_us - start_us,
+                    "pid": getpid(),
+                    "tid": tid,
+                    "args": {k: str(v) for k, v in this_span.args.items()},
+                }
+            )
+
+
+def write_trace(trace_file):
+    """
+    Write all the recorded spans to a file in Chrome's trace-event format
+    """
+    with TRACE_LOCK:
+        events = list(TRACE_EVENTS)
+        events += [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": getpid(),
+                "tid": tid,
+                "args": {"name": thread_name},
+            }
+            for tid, thread_name in TRACE_THREADS.items()
+        ]
+
+    makedirs(dirname(trace_file), exist_ok=True)
+    with open(trace_file, "w") as fh:
+        json_dump({"traceEvents": events, "displayTimeUnit": "ms"}, fh)
+
+
+def read_trace(trace_file):
+    """
+    Read the spans (i.e. complete events) from a trace file, and tag each one
+    with a key that identifies it across runs: its name, and how many spans
+    with the same name started before it (e.g. `replace-agent#1`)
+    """
+    with open(trace_file, "r") as fh:
+        trace = json_load(fh)
+
+    spans = sorted(
+        [e for e in trace["traceEvents"] if e["ph"] == "X"], key=lambda e: e["ts"]
+    )
+    name_counts = {}
+    for event in spans:
+        count = name_counts.get(event["name"], 0)
+        event["key"] = event["name"] if count == 0 else f"{event['name']}#{count}"
+        name_counts[event["name"]] = count + 1
+
+    return spans
+
+
+def print_trace_summary(trace_file, num_spans=10, baseline_trace_file=None):
+    """
+    Print the N slowest spans in a trace. If given a baseline trace (e.g. from
+    a previous deployment), also print how long each span took there
+    """
+    spans = sorted(read_trace(trace_file), key=lambda e: e["dur"], reverse=True)
+
+    baseline_durations = {}
+    if baseline_trace_file is not None:
+        baseline_durations = {
+            event["key"]: event["dur"] for event in read_trace(baseline_trace_file)
+        }
+
+    header = f"{'Span':<48} {'Time (s)':>10}"
+    if baseline_trace_file is not None:
+        header += f" {'Baseline (s)':>14} {'Delta (s)':>10}"
+    print(header)
+    print("-" * len(header))
+
+    for event in spans[:num_spans]:
+        dur_secs = event["dur"] / 1e6
+        line = f"{event['key'][:48]:<48} {dur_secs:>10.2f}"
+        if event["key"] in baseline_durations:
+            baseline_secs = baseline_durations[event["key"]] / 1e6
+            line += f" {baseline_secs:>14.2f} {dur_secs - baseline_secs:>+10.2f}"
+        elif baseline_trace_file is not None:
+            line += f" {'-':>14} {'-':>10}"
+        print(line)
+
+        if len(event.get("args", {})) > 0:
+            args_str = ", ".join([f"{k}={v}" for k, v in event["args"].items()])
+            print(f"    {args_str[:100]}")
@@ -21,3 +21,4 @@ SKOPEO_VERSION = "1.13.0"
 
 # Knative versions
 KNATIVE_VERSION = "1.15.0"
+METALLB_VERSION = "0.13.11"